@@ -1,8 +1,75 @@
+import os
+
 class Constants:
     @staticmethod
     def valid_args(cmd, option):
         return commands[cmd][option]
-        
+
+    # Validates options for a command against the commands table below
+    # Options whose table entry is None accept any value
+    @staticmethod
+    def validate(cmd, options):
+        for k, v in options.items():
+            if k not in commands[cmd]:
+                raise Exception('Invalid option for {}: {}'.format(cmd, k))
+            valid = commands[cmd][k]
+            if valid is not None and v not in valid:
+                raise Exception('Invalid arg for {}: {}. Must be among the following: {}'.format(
+                    k, v, ', '.join(str(arg) for arg in valid)))
+
+    # File-system personality for a volume-kind reported by `hdiutil info`, None if unrecognized
+    @staticmethod
+    def volume_fs(kind):
+        return volume_kinds.get(kind)
+
+    # Extensions denoting an image type
+    @staticmethod
+    def type_extensions(image_type):
+        return [extension for extension, t in extensions.items() if t == image_type]
+
+    # Image type (as used by `create -type`) implied by a path's extension, None if unrecognized
+    @staticmethod
+    def image_type(path):
+        return extensions.get(os.path.normpath(path).split('.')[-1].lower())
+
+    # Formats producing images of an image type, e.g. every UDIF format
+    @staticmethod
+    def type_formats(image_type):
+        return tuple(sorted(format for format, (t, compression, extension) in formats.items() if t == image_type))
+
+    # Image type an hdiutil format produces
+    @staticmethod
+    def format_type(format):
+        return formats[format][0]
+
+    # Compression algorithm of a format, None for uncompressed formats
+    @staticmethod
+    def format_compression(format):
+        return formats[format][1]
+
+    # Extension hdiutil gives images of a format
+    @staticmethod
+    def format_extension(format):
+        return formats[format][2]
+
+    # Formats whose data is compressed, the usual targets for distribution
+    @staticmethod
+    def compressed_formats():
+        return tuple(sorted(format for format in formats if formats[format][1]))
+
+# hdiutil image formats: the image type each produces, its compression and its extension
+formats = {'UDRW' : ('UDIF', None, 'dmg'),
+           'UDRO' : ('UDIF', None, 'dmg'),
+           'UDCO' : ('UDIF', 'adc', 'dmg'),
+           'UDZO' : ('UDIF', 'zlib', 'dmg'),
+           'ULFO' : ('UDIF', 'lzfse', 'dmg'),
+           'ULMO' : ('UDIF', 'lzma', 'dmg'),
+           'UDBZ' : ('UDIF', 'bzip2', 'dmg'),
+           'UDTO' : ('UDIF', None, 'cdr'),
+           'UFBI' : ('UDIF', None, 'dmg'),
+           'UDSP' : ('SPARSE', None, 'sparseimage'),
+           'UDSB' : ('SPARSEBUNDLE', None, 'sparsebundle')}
+
 commands = {'create' : 
                 {   'uid' : None,
                     'gid' : None,
@@ -10,7 +77,20 @@ commands = {'create' :
                     'encryption' : [False, 'AES-128', 'AES-256'], 
                     'type' : ['UDIF', 'SPARSE', 'SPARSEBUNDLE'] , 
                     'volname' : None, 
-                    'fs' : ['HFS+', 'HFS+J' '(JHFS+)', 'HFSX', 'JHFS+X', 'MS-DOS', 'UDF']
+                    'fs' : ['HFS+', 'HFS+J', 'JHFS+', 'HFSX', 'JHFS+X', 'MS-DOS', 'UDF'],
+                    # Images built from a folder, see build_cache.ImageBuilder
+                    'srcfolder' : None,
+                    'format' : sorted(formats)
+                },
+            'resize' :
+                {    'size' : None     },
+            'convert' :
+                {   'format' : sorted(formats),
+                    'o' : None,
+                    # e.g. zlib-level=9
+                    'imagekey' : None,
+                    # Overwrites an existing output
+                    'ov' : None
                 },
             'imageinfo' :
                 {    'plist' : None     },
@@ -18,4 +98,16 @@ commands = {'create' :
                 {    'plist' : None     }
 
             }
-utility = 'hdiutil'
\ No newline at end of file
+utility = 'hdiutil'
+
+# Disk-image extensions and the image type they denote
+extensions = {'dmg' : 'UDIF',
+              'sparse' : 'SPARSE',
+              'sparseimage' : 'SPARSE',
+              'sparsebundle' : 'SPARSEBUNDLE'}
+
+# volume-kind values in `hdiutil info` and the fs they denote
+volume_kinds = {'hfs' : 'HFS+',
+                'apfs' : 'APFS',
+                'msdos' : 'MS-DOS',
+                'udf' : 'UDF'}
@@ -2,35 +2,736 @@
 #                                                    Raphael Shejnberg, 8/21/14
 #
 
-import os, plistlib
+import atexit, contextlib, os, segment, sparsebundle, udif
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from HDIUtil_Constants import Constants
-from utils import Helpers
+from capacity import CapacityMonitor
+from checksum import Checksummer, ChecksumCache
+from info_cache import InfoCache, ImageRegistry
+from leases import LeaseManager
+from progress import stream_command
+from utils import CommandEngine, CommandError, Helpers, clock
 
 # Methods to possibly be move over into seperate diskutil class
 def change_volname(old_name, new_name):
-    Helpers.run_command('diskutil', 'rename', old_name, new_name)
-    
+    CommandEngine.run('diskutil', 'rename', old_name, new_name)
+
+## Outcome of a batch operation such as HDIUtil.create_many()
+#
+## results and durations line up with items; a failed item has result None and its
+## exception collected in errors instead of aborting the rest of the batch
+class BatchResult(object):
+    def __init__(self, items, outcomes, elapsed):
+        self.items = list(items)
+        self.results = [result for (result, error, duration) in outcomes]
+        self.durations = [duration for (result, error, duration) in outcomes]
+        self.errors = [(item, error) for item, (result, error, duration) in zip(self.items, outcomes) if error is not None]
+        # Wall time of the whole batch and summed time spent in workers
+        self.elapsed = elapsed
+        self.busy = sum(self.durations)
+
+    def __repr__(self):
+        return 'BatchResult({} ok, {} failed, {:.3f}s elapsed, {:.3f}s busy)'.format(
+            len(self.items) - len(self.errors), len(self.errors), self.elapsed, self.busy)
+
+    def __len__(self): return len(self.items)
+
+    @property
+    def ok(self): return not self.errors
+
+    # Raises the first collected error, if any
+    def raise_errors(self):
+        if self.errors:
+            item, error = self.errors[0]
+            raise error
+
+# Placeholder for fields of a lazily loaded DiskImage that have not been resolved yet
+class _Unresolved(object):
+    def __repr__(self): return 'unresolved'
+    def __format__(self, spec): return format(repr(self), spec)
+
+UNRESOLVED = _Unresolved()
+
+## Read-only metadata of a disk image
+#
+## Immutable and tuple-sized, for inventories holding many images at once
+ImageRecord = namedtuple('ImageRecord', ['path', 'type', 'format', 'volname', 'fs', 'size'])
+
+
+## DiskImage Class
+#
+## All base logic for disk image actions contained in here
+class DiskImage(object):
+    UTILITY_NAME = 'hdiutil'
+
+    # Fields backing the properties below, in the order repr() shows them
+    FIELDS = ('path', 'volname', 'fs', 'size', 'type', 'encryption')
+    # Initial values of fields not given in the options
+    FIELD_DEFAULTS = {}
+
+    __slots__ = tuple('_' + name for name in FIELDS) + ('_sources', '_pending')
+
+    # Fields a lazy load leaves unresolved, and the sources tried for them, cheapest first
+    # Subclasses add the fields only some sources know, which other loads leave unresolved too
+    LAZY_FIELDS = ('volname', 'fs', 'size', 'type')
+    LAZY_SOURCES = ('extension', 'native', 'snapshot', 'attached')
+
+    # Properties batch() defers, in the order their commands run on commit:
+    # resizing works on a detached image, renaming on a mounted one
+    BATCHED_FIELDS = ('size', 'volname')
+
+    # Whether the image file takes its full size on disk, sparse types grow as data is written
+    PREALLOCATED = True
+
+    # Type registry, filled by DiskImage.register
+    types = {}
+    formats = {}
+    extensions = {}
+
+    ## Usage: Has multiple use-cases regarding disk-images
+    ##    Case 1: Create a disk-image
+    ##       DiskImage(path='some/path', size='1024', type='SPARSE')
+    ##    Case 2: Generate an object from an existing disk-image
+    ##       DiskImage(path='some/path.dmg', create_new=False)
+    ##    Case 3: Write a disk-image without hdiutil, see create_native
+    ##       DiskImage(path='some/path.sparsebundle', size='1g', native='True')
+    def __init__(self, options):
+        create_new = False if 'create_new' in options and options.pop('create_new') == 'False' else True
+        native = options.pop('native', False) == 'True'
+        lazy = options.pop('lazy', False) == 'True'
+
+        # Initialize all fields
+        # Validation of member variables that occurs in the setters does not happen on the initial assignment of variables
+        for name in self.FIELDS:
+            setattr(self, '_' + name, self.FIELD_DEFAULTS.get(name))
+        # Memoized output of each data source, see LAZY_SOURCES
+        self._sources = {}
+        # Changes staged by batch(), None outside a batch
+        self._pending = None
+
+        # Set path and retrieve info from disk-image (process dependent on self.path)
+        if not create_new:
+            self.path = options.pop('path')
+            if lazy:
+                options = {}
+            elif native:
+                options = self._sources['native'] = self.native_data_model()
+            else:
+                options = self.generate_data_model(self.diskutil_info())
+            # Fields the data model leaves out resolve on first access, see LAZY_SOURCES
+            options = dict({name: UNRESOLVED for name in self.LAZY_FIELDS}, **options)
+
+        # Copy values to self, data models may carry extra keys such as format
+        for k, v in options.items():
+            if k in self.FIELDS:
+                setattr(self, '_' + k, v)
+
+        # Execute hdiutil create command
+        if create_new:
+            with self._reserve_space(self._parse_size(self._size or 0)):
+                if native:
+                    self.create_native()
+                else:
+                    self.create_command()
+
+
+    def __repr__(self):
+        str = ''
+
+        for k in self.FIELDS:
+            str += ("{0:20}:\t\t{1:<10}\n".format(k, '{}'.format(getattr(self, '_' + k))))
+        return str
+
+
+    # Type Registry
+    #
+    # Class decorator adding a subclass under its TYPE, each of its FORMATS and the extensions of its TYPE
+    @staticmethod
+    def register(image_class):
+        DiskImage.types[image_class.TYPE] = image_class
+        for format in image_class.FORMATS:
+            DiskImage.formats[format] = image_class
+        for extension in Constants.type_extensions(image_class.TYPE):
+            DiskImage.extensions[extension] = image_class
+        return image_class
+
+    # Returns the DiskImage subclass for a path's extension, an hdiutil format or a create -type,
+    # tried in that order
+    @staticmethod
+    def class_for(path=None, format=None, type=None):
+        if path is not None:
+            extension = os.path.normpath(path).split('.')[-1].lower()
+            if extension in DiskImage.extensions:
+                return DiskImage.extensions[extension]
+        if format in DiskImage.formats:
+            return DiskImage.formats[format]
+        if type in DiskImage.types:
+            return DiskImage.types[type]
+        raise Exception('Unrecognized disk image type: ' + ', '.join('{}'.format(arg) for arg in (path, format, type) if arg))
+
+
+    # Setters and getters
+
+    # Encryption settings
+    # Values: False, AES-128, AES-256
+    @property
+    def encryption(self):
+        return self._encryption
+
+    @encryption.setter
+    def encryption(self, encryption):
+        if self._encryption is None:
+            if encryption in Constants.valid_args('create', 'encryption'):
+                self._encryption = encryption
+            else:
+                raise Exception('Invalid arg for encryption: ' + encryption)
+        else:
+            raise Exception('Cannot reassign encryption value.')
+
+
+
+    # Returns this disks mounting point
+    def mounting_point(self):
+        info = self.info()
+        if info:
+            return info['system-entities'][1]['dev-entry']
+
+    # Size of disk image in bytes. This does not include overhead
+    @property
+    def size(self):
+        return self._resolved('size')
+
+    @size.setter
+    def size(self, size):
+
+        size = self._parse_size(size)
+        if self._pending is not None:
+            self._pending['size'] = size
+            return
+
+        # Different handling cases depending on if size has been assigned before
+        if self._size:
+            with self._reserve_space(size, self.size):
+                self.run_hdiutil_command('resize', self.path, size=Helpers.hr_bytes(size))
+        else:
+            self._check_space(size)
+        self._size = size
+
+    # Validation testing that size is an int, returns the size in bytes
+    @staticmethod
+    def _parse_size(size):
+        size = Helpers.get_bytes(size) if isinstance(size, str) else size
+        if not Helpers.is_float(size):
+            raise Exception('Invalid argument. Size must be an integer')
+        return size
+
+    # Bytes the image file grows by when its size goes from current to size
+    # A newly created image keeps its size as given, e.g. '100m'
+    def _space_needed(self, size, current=0):
+        return size - self._parse_size(current) if self.PREALLOCATED else 0
+
+    # Validation testing that space is available on the filesystem holding the image
+    def _check_space(self, size, current=0):
+        if self._space_needed(size, current) > HDIUtil.capacity.available(self.path):
+            raise Exception('Invalid argument. Size is too large, not enough space.')
+
+    # Holds the space a create or resize needs until the block exits, so concurrent creates
+    # and resizes cannot all pass the check and overcommit the disk
+    # Usage: with self._reserve_space(size, self.size): ...resize...
+    def _reserve_space(self, size, current=0):
+        return HDIUtil.capacity.reserve(self.path, self._space_needed(size, current))
+
+
+    # Path to the name of the volume (what appears when its mounted)
+    @property
+    def volname(self):
+        return self._resolved('volname')
+
+    @volname.setter
+    def volname(self, volname):
+        if not volname:
+            raise Exception('Invalid argument. Volume name cannot be empty.')
+        if self._pending is not None:
+            self._pending['volname'] = volname
+            return
+        change_volname(self.volname, volname)
+        self._volname = volname
+
+
+    # Path to disk image
+    @property
+    def path(self): return self._path
+
+    @path.setter
+    def path(self, path):
+        path_ar = path.split('/')
+        if len(path_ar) > 1:
+            filename = path_ar[-1]
+            if not os.path.exists(os.path.expanduser('/'.join(path_ar[:-1]))):
+                raise Exception('Invalid argument. Path cannot be found.')
+
+        self._path = path
+
+
+    # File-system type
+    # Values: HFS+,
+    @property
+    def fs(self): return self._resolved('fs')
+
+    @fs.setter
+    def fs(self, fs):
+        if fs not in Constants.valid_args('create', 'fs'):
+            raise Exception('Invalid argument. File-system (fs) arg must be among the following: ' + ', '.join(Constants.valid_args('create', 'fs')))
+        else:
+            self._fs = fs
+
+    # Disk image type
+    # Values: UDIF, SPARSE, SPARSEBUNDLE
+    @property
+    def type(self): return self._resolved('type')
+
+    @type.setter
+    def type(self, type):
+        if not type in Constants.valid_args('create', 'type'):
+            raise Exception('Invalid argument. Type arg must be among the following ' + ', '.join(Constants.valid_args('create', 'type')))
+
+    # Read-only snapshot of this image's metadata
+    # Unless attach is set, fields only the attached image can provide are left as None
+    def record(self, attach=False):
+        sources = self.LAZY_SOURCES if attach else self.LAZY_SOURCES[:-1]
+        volname, fs, size, type = [self._resolved(name, sources) for name in ('volname', 'fs', 'size', 'type')]
+        return ImageRecord(self.path, type, self._lookup('format', sources) or self.format, volname, fs, size)
+
+
+    # Formatting Helpers
+    #
+    # Converts this object to a standardized format where keys are the same as those used in bash commands
+    def standard_format(self):
+        options = {k: getattr(self, '_' + k) for k in self.FIELDS}
+        if not options.get('encryption') or options['encryption'] == 'False':
+            options.pop('encryption', None)
+        return options
+
+    def run_disk_util_command(self, *args, **kwargs):
+        out = Helpers.run_command(*args, **kwargs)
+    # Runs an hdiutil command
+    def run_hdiutil_command(self, *args, **kwargs):
+        args = ['hdiutil'] + list(args)
+        try:
+            result = CommandEngine.run(*args, **kwargs)
+        except CommandError as e:
+            # Some commands require the disk-image to be mounted/unmounted. If ran when it isn't it returns
+            # saying 'Resource temporarily unavailable'
+            if 'Resource temporarily unavailable' not in str(e):
+                raise
+            self.detach() if self.is_mounted() else self.attach()
+            result = CommandEngine.run(*args, **kwargs)
+        # Callers parse the output as text
+        return result.stdout if isinstance(result.stdout, str) else result.stdout.decode('utf-8', 'replace')
+
+    # Create a disk image from self
+    def create_command(self):
+
+       options = self.standard_format()
+       command = self.run_hdiutil_command('create', options.pop('path'), **options)
+
+    # Writes the disk image from self without running hdiutil, only SparseBundle supports it
+    def create_native(self):
+        raise Exception('Native creation is only supported for sparse bundle images.')
+
+
+
+
+    # Info Extraction Helpers
+    #
+    # Extracts info of existing dmg and sets instance vars to match
+    def update(self):
+        info = self.generate_data_model(self.diskutil_info())
+        {k: setattr(self, k, v) for k, v in info.items()}
+
+    # Returns the path to the mounting point of the disk
+    def get_mounting_point(self):
+        info = self.info()
+        if info:
+            return info['system-entities'][1]['dev-entry']
+        else:
+            raise Exception('Disk not found. Mount the image and try again.')
+
+
+    # Helper method lets you know if the disk is mounted
+    def is_mounted(self): return True if self.info() else False
+
+    # Generate a dict of info used in DiskImage initialization
+    # image_info arg must be
+    def generate_data_model(self, image_info):
+        options = {
+            'volname' : 'Volume Name',
+            'fs' : 'File System Personality',
+            'size' : 'Total Size'
+        }
+        options = {k: image_info[v] for k, v in options.items()}
+        str_size = ' '.join(options['size'].split(' ')[:2])
+
+        options['size'] = Helpers.get_bytes(str_size)
+        options['type'] = Constants.image_type(self.path)
+
+        return options
+
+    # Generate the same dict as generate_data_model by reading the image file itself,
+    # without attaching it. The volume name is stored in neither format and is left as None
+    def native_data_model(self):
+        image_type = Constants.image_type(self.path)
+        if image_type == 'UDIF':
+            image = udif.read_udif(self.path)
+            return {'volname' : None, 'fs' : image.fs, 'size' : image.size, 'type' : image_type, 'format' : image.format}
+        elif image_type == 'SPARSEBUNDLE':
+            bundle = sparsebundle.SparseBundleImage(self.path)
+            # Band sizes are tracked in 512-byte sectors, as hdiutil's sparse-band-size expects
+            return {'volname' : None, 'fs' : None, 'size' : bundle.size, 'type' : image_type, 'format' : 'UDSB',
+                    'sparse_band_size' : bundle.band_size // 512}
+        else:
+            raise Exception('Native inspection is only supported for UDIF (.dmg) and sparse bundle images.')
+
+    # Batched Updates
+    #
+    ## Defers assignments to BATCHED_FIELDS until the block exits
+    #
+    ## Usage: with image.batch():
+    ##            image.size = '2g'
+    ##            image.size = '3g'
+    ##            image.volname = 'Build'
+    ## Only the last value assigned to each property is kept and properties read back their staged
+    ## value. On exit every change is validated before any command runs, unchanged values are
+    ## skipped and the rest are applied in BATCHED_FIELDS order. If a command fails, the changes
+    ## already applied are reverted and the error is raised. An exception inside the block discards
+    ## the staged changes
+    @contextlib.contextmanager
+    def batch(self):
+        if self._pending is not None:
+            raise Exception('A batch is already open on this disk image.')
+        self._pending = {}
+        try:
+            yield self
+            changes = self._pending
+        finally:
+            self._pending = None
+        self._commit(changes)
+
+    def _commit(self, changes):
+        changes = [(name, changes[name]) for name in self.BATCHED_FIELDS
+                   if name in changes and changes[name] != getattr(self, name)]
+        if 'size' in dict(changes):
+            self._check_space(dict(changes)['size'], self.size)
+
+        applied = []
+        try:
+            for name, value in changes:
+                previous = getattr(self, name)
+                self._apply(name, value)
+                applied.append((name, previous))
+        except Exception:
+            # Roll back in reverse order; the original error is the one worth raising
+            for name, previous in reversed(applied):
+                try:
+                    self._apply(name, previous)
+                except Exception:
+                    pass
+            raise
+
+    # Runs the command behind one batched property and updates the field
+    def _apply(self, name, value):
+        if name == 'size':
+            with self._reserve_space(value, self.size):
+                self.run_hdiutil_command('resize', self.path, size=Helpers.hr_bytes(value))
+        elif name == 'volname':
+            change_volname(self.volname, value)
+        setattr(self, '_' + name, value)
+
+    # Lazy Loading
+    #
+    # Returns a field's value, first resolving it if a lazy load left it unresolved
+    # A value found in a subset of LAZY_SOURCES is only kept if it is not None
+    def _resolved(self, name, sources=None):
+        if self._pending and name in self._pending:
+            return self._pending[name]
+        value = getattr(self, '_' + name)
+        if value is UNRESOLVED:
+            value = self._lookup(name, sources or self.LAZY_SOURCES)
+            if value is not None or sources is None:
+                setattr(self, '_' + name, value)
+            else:
+                return None
+        return value
+
+    # First non-None value of name among sources
+    def _lookup(self, name, sources):
+        for source in sources:
+            value = self.source_data(source).get(name)
+            if value is not None:
+                return value
+
+    # Memoized data model from one of LAZY_SOURCES
+    # Sources other than attaching the image yield an empty dict when they do not apply
+    def source_data(self, source):
+        if source not in self._sources:
+            try:
+                self._sources[source] = getattr(self, source + '_data_model')()
+            except Exception:
+                if source == 'attached':
+                    raise
+                self._sources[source] = {}
+        return self._sources[source]
+
+    # Drops memoized values, fields resolve again from LAZY_SOURCES on next access
+    def refresh(self):
+        self._sources = {}
+        for name in self.LAZY_FIELDS:
+            setattr(self, '_' + name, UNRESOLVED)
+
+    def extension_data_model(self):
+        return {'type' : Constants.image_type(self.path)}
+
+    # Volume name and fs from the shared `hdiutil info` snapshot, empty if not attached
+    def snapshot_data_model(self):
+        info = self.info()
+        if not info:
+            return {}
+        mount_points = ImageRegistry.mount_points(info)
+        kinds = [entity['volume-kind'] for entity in info['system-entities'] if entity.get('volume-kind')]
+        return {'volname' : os.path.basename(mount_points[0]) if mount_points else None,
+                'fs' : Constants.volume_fs(kinds[0]) if kinds else None,
+                'type' : Constants.image_type(self.path)}
+
+    def attached_data_model(self):
+        return self.generate_data_model(self.diskutil_info())
+
+    # Commands
+    #
+    # Attaches a disk
+    # registry is passed on to is_encrypted, see attach_many
+    def attach(self, registry=None):
+        cmd = 'attach'
+        self.run_hdiutil_command(cmd, self.path)
+        if self.is_encrypted(registry):
+            Helpers.read_password()
+
+    # Keeps the disk attached for the duration of a block, reusing an existing mount
+    # Usage: with image.mounted(): ...
+    def mounted(self, timeout=None):
+        return HDIUtil.leases.lease(self, timeout)
+
+    # Detaches a disk
+    def detach(self):
+        cmd = 'detach'
+        self.run_hdiutil_command(cmd, self.mounting_point())
+        HDIUtil.leases.detached(self.path)
+
+    ## Converts the image to another format, returning a lazily loaded DiskImage for the result
+    #
+    ## Usage: image.convert('UDZO', '~/dist/build.dmg', imagekey='zlib-level=9')
+    ##        image.convert('ULFO', progress=lambda event: print(event.percent))
+    ## output defaults to converted_path(format), e.g. ~/build-ulfo.dmg for ~/build.dmg. progress is
+    ## called with every ProgressEvent of the conversion, see progress.py
+    def convert(self, format, output=None, progress=None, overwrite=False, **options):
+        Constants.validate('convert', dict(options, format=format))
+        output = output or self.converted_path(format)
+        if ImageRegistry.canonical_path(output) == ImageRegistry.canonical_path(self.path):
+            raise Exception('Invalid argument. Cannot convert an image onto itself: ' + output)
+        if overwrite:
+            options['ov'] = None
+
+        args = ('convert', self.path)
+        options.update(format=format, o=output)
+        try:
+            stream_command(self.UTILITY_NAME, *args, **options).wait(progress)
+        except CommandError as e:
+            # Images attached read/write have to be detached first, as in run_hdiutil_command
+            if 'Resource temporarily unavailable' not in str(e) or not self.is_mounted():
+                raise
+            self.detach()
+            stream_command(self.UTILITY_NAME, *args, **options).wait(progress)
+
+        return DiskImage.class_for(output, format)({'path' : output, 'create_new' : 'False', 'lazy' : 'True'})
+
+    # Default output of convert: this image's path with the format appended to its name and the
+    # extension hdiutil gives images of format, so it never names the image itself
+    def converted_path(self, format):
+        root, extension = os.path.splitext(os.path.normpath(self.path))
+        return '{}-{}.{}'.format(root, format.lower(), Constants.format_extension(format))
+
+    # Returns the space of deleted files in a sparse image or sparse bundle to the host, hdiutil compact
+    # progress is called with every ProgressEvent, see progress.py
+    def compact(self, progress=None):
+        if self.PREALLOCATED:
+            raise Exception('Only sparse images and sparse bundles can be compacted.')
+        stream_command(self.UTILITY_NAME, 'compact', self.path).wait(progress)
+        HDIUtil.capacity.invalidate(self.path)
+
+    # Native checksum of the image file, or of every band of a sparse bundle, see checksum.py
+    # Unchanged images are answered from HDIUtil.checksums' cache
+    def checksum(self):
+        return HDIUtil.checksums.checksum(self.path)
+
+    # Cuts the image file into segments of size, e.g. '2g', checksummed in a manifest, see segment.py
+    # Returns the SegmentManifest; HDIUtil.join reassembles the image from it. hdiutil segment is not
+    # used because only hdiutil can join its output
+    def segment(self, size, directory=None, workers=None, progress=None):
+        return segment.split(self.path, int(self._parse_size(size)), directory, workers, progress=progress)
+
+    # hdiutil isencrypted
+    # Looks the image up in registry, an ImageRegistry, instead of the shared snapshot when given, so
+    # no `hdiutil info` runs; images it does not list are asked with hdiutil isencrypted
+    def is_encrypted(self, registry=None):
+        info = registry.by_path(self.path) if registry is not None else self.info()
+        if info: return info['image-encrypted']
+        else:
+            output = self.run_hdiutil_command('isencrypted', self.path)
+            is_encrypted = output.strip().split(' ')[-1]
+            return False if is_encrypted in ['NO'] else True
+
+
+
+    # Returns relevant portion of output to command: hdiutil info
+    # Returns None if disk not mounted
+    def info(self):
+        return HDIUtil.info_cache.registry().by_path(self.path)
+
+    # Returns output of command: hdiutil imageinfo
+    def imageinfo(self):
+        output = self.run_hdiutil_command('imageinfo', self.path, plist=None)
+        if self.is_mounted(): raise Exception('Command: hdiutil imageinfo cannot be run unless the disk is mounted')
+        else: return Helpers.read_plist(output)
+    # Returns relevant portion of command: diskutil info
+    def diskutil_info(self):
+        UTILITY_NAME = 'diskutil'
+        with self.mounted():
+            response = CommandEngine.run(UTILITY_NAME, 'info', self.get_mounting_point()).stdout
+        return Helpers.parse_diskutil_info(response)
+    # Resets the password for the disk image
+    # hdiutil - chpass
+    def change_password(self):
+        self.run_hdiutil_command('chpass')
+        Helpers.read_password()
+
+
+## Subclassed disk-image types
+#
+## format is the hdiutil format used when creating, FORMATS every format the class represents,
+## as listed in HDIUtil_Constants.formats
+@DiskImage.register
+class UDIF(DiskImage):
+    __slots__ = ()
+    TYPE = 'UDIF'
+    FORMATS = Constants.type_formats(TYPE)
+    format = 'UDRW'
+
+@DiskImage.register
+class Sparse(DiskImage):
+    __slots__ = ()
+    TYPE = 'SPARSE'
+    FORMATS = Constants.type_formats(TYPE)
+    format = 'UDSP'
+    PREALLOCATED = False
+
+@DiskImage.register
+class SparseBundle(DiskImage):
+    TYPE = 'SPARSEBUNDLE'
+    FORMATS = Constants.type_formats(TYPE)
+    format = 'UDSB'
+    PREALLOCATED = False
+    # In 512-byte sectors
+    DEFAULT_BAND_SIZE = sparsebundle.DEFAULT_BAND_SIZE // 512
+    MIN_BAND_SIZE = 2048
+    MAX_BAND_SIZE = 16777216
+
+    FIELDS = DiskImage.FIELDS + ('sparse_band_size',)
+    FIELD_DEFAULTS = {'sparse_band_size' : DEFAULT_BAND_SIZE}
+    # Existing bundles report their own band size, read from Info.plist by the native source
+    LAZY_FIELDS = DiskImage.LAZY_FIELDS + ('sparse_band_size',)
+    __slots__ = ('_sparse_band_size',)
+
+    def __init__(self, options):
+        if options.get('create_new') not in ('False', False) and options.get('sparse_band_size') is not None:
+            options['sparse_band_size'] = self.valid_band_size(options['sparse_band_size'])
+        super(SparseBundle, self).__init__(options)
+
+    # Band size in sectors as an int, raising unless hdiutil accepts it
+    @classmethod
+    def valid_band_size(cls, size):
+        if not Helpers.is_float(size) or float(size) != int(float(size)) or not cls.MIN_BAND_SIZE <= int(float(size)) <= cls.MAX_BAND_SIZE:
+            raise Exception('Invalid argument. Band size must be between {} and {} sectors (1 MB to 8 GB).'.format(cls.MIN_BAND_SIZE, cls.MAX_BAND_SIZE))
+        return int(float(size))
+
+    # The band size is passed to hdiutil create as an image key
+    def standard_format(self):
+        options = super(SparseBundle, self).standard_format()
+        options['imagekey'] = 'sparse-band-size={}'.format(options.pop('sparse_band_size'))
+        return options
+
+    # Writes an empty, unformatted bundle directly, so no hdiutil process is spawned
+    # volname and fs are ignored: the bundle gets its partition map and file system when it is
+    # formatted on macOS. Use sparsebundle.create_sparsebundle to fill the bands from a raw image
+    def create_native(self):
+        if '{}'.format(self.encryption) not in ('None', 'False'):
+            raise Exception('Encrypted sparse bundles cannot be created natively.')
+        sparsebundle.create_sparsebundle(self.path, int(self._parse_size(self._size)), int(self._sparse_band_size) * 512)
+
+    @property
+    def sparse_band_size(self):
+        return self._resolved('sparse_band_size')
+
+    #'Valid values for SPARSEBUNDLE range from 2048 to 16777216 sectors (1 MB to 8 GB)'
+    # Include support for changing band sizes
+    @sparse_band_size.setter
+    def sparse_band_size(self, size):
+        if self.sparse_band_size is None:
+            self._sparse_band_size = size
+        else:
+            raise Exception('Band-size of Sparse-bundle cannot be changed.')
+
+
 class HDIUtil(object):
 
     # Utility name
     NAME = 'hdiutil'
-    
+
+    # Snapshot of `hdiutil info` shared by every DiskImage in the process
+    # Usage: HDIUtil.info_cache.ttl = 10
+    info_cache = InfoCache()
+
+    # Reference-counted attachments shared by every DiskImage, see DiskImage.mounted()
+    # Usage: HDIUtil.leases.idle_timeout = 60; HDIUtil.leases.max_attached = 32
+    leases = LeaseManager()
+
+    # Cached free space and in-process reservations per filesystem, see DiskImage._reserve_space()
+    # Usage: HDIUtil.capacity.available('~/images'); HDIUtil.capacity.ttl = 5
+    capacity = CapacityMonitor()
+
+    # Parallel image checksums, cached on disk by path, size, mtime and inode
+    # Usage: HDIUtil.checksums.algorithm = 'sha1'; HDIUtil.checksums.cache = None
+    checksums = Checksummer(cache=ChecksumCache())
+
     def __init__(self):
         # Hash of default values for given options
         self._default_options = {
-                     'size' : '100m', 
-                     'volname' : 'Volume', 
-                     'path' : '~', 
+                     'size' : '100m',
+                     'volname' : 'Volume',
+                     'path' : '~',
                      'encryption' : False,
-                     'fs' : 'HFS+', 
+                     'fs' : 'HFS+',
                      'type' : 'UDIF',
-                     'create_new' : True}
-                     
-    # Default options when creating DiskImages            
+                     'create_new' : True,
+                     'native' : False,
+                     'lazy' : False,
+                     # In 512-byte sectors, sparse bundles only
+                     'sparse_band_size' : None}
+
+    # Default options when creating DiskImages
     @property
     def default_options(self):
         return self._default_options
-        
+
     @default_options.setter
     def default_options(self, **kwargs):
         for k in kwargs.keys():
@@ -38,346 +739,139 @@ class HDIUtil(object):
                 self._default_options[k] = kwargs[k]
             else:
                 raise Exception('Invalid option argument: ' + k)
-	
+
     ## Disk Image Factory
     #
-    ## Usage: create(path='/my/path', size='1024b', type='SPARSE') 
-    ## All disk-image classes are contained in this method to provide regulation over object creation
+    ## Usage: create(path='/my/path', size='1024b', type='SPARSE')
+    ##        create(path='/my/path.sparsebundle', size='1g', native=True, sparse_band_size=16384)
+    ## The DiskImage subclass is picked from the type registry by the path's extension, a type
+    ## given as well has to match it
+    ## With native=True a sparse bundle is written directly instead of by hdiutil create
     #
     def create(self, *args, **kwargs):
-        ## DiskImage Class
-        # 
-        ## All base logic for disk image actions contained in here
-    	class DiskImage(object):
-                UTILITY_NAME = 'hdiutil'
-                
-                ## Usage: Has multiple use-cases regarding disk-images
-                ##    Case 1: Create a disk-image
-                ##       DiskImage(path='some/path', size='1024', type='SPARSE')
-                ##    Case 2: Generate an object from an existing disk-image
-                ##       DiskImage(path='some/path.dmg', create_new=False)
-                def __init__(self, options):
-                    create_new = False if 'create_new' in options and options.pop('create_new') is 'False' else True
-                    # Set path and retrieve info from disk-image (process dependent on self.path)
-                    if not create_new:
-                        self.path = options.pop('path')
-                        options = self.generate_data_model(self.diskutil_info())
-
-                    init_options = self.obj_format(options)
-                    
-                    # Initialize all fields to None
-                    # Validation of member variables that occurs in the setters does not happen on the initial assignment of variables
-                    # this ensures that all field will be validated on initialization
-                    self.__dict__.update(dict([(k, None) for k in init_options.keys()]))
-
-                    # Copy values to self
-                    { k: setattr(self, k, v) for k, v in init_options.items() }
-                    
-
-                    # Execute hdiutil create command
-                    if create_new:
-                        self.create_command()
-
-                
-                def __repr__(self):
-                    str = ''
-                    
-                    for k in self.__dict__.keys():
-                        str += ("{0:20}:\t\t{1:<10}\n".format(k[1:], self.__dict__[k]))
-                    return str
-
-
-                # Setters and getters
-                
-                # Encryption settings
-                # Values: False, AES-128, AES-256
-                @property
-                def encryption(self):
-                    return self._encryption
-                
-                @encryption.setter
-                def encryption(self, encryption):
-                    if self._encryption is None:
-                        if encryption in Constants.valid_args('create', 'encryption'):
-                            self._encryption = encryption
-                        else:
-                            raise Exception('Invalid arg for encryption: ' + encryption)
-                    else:
-                        raise Exception('Cannot reassign encryption value.')
-            
-    
-                
-                # Returns this disks mounting point
-                def mounting_point(self):
-                    output = self.run_hdiutil_command('info', plist=None)
-                    image_info = plistlib.readPlistFromString(output)
-                    
-                    for image in image_info['images']:
-                        if self.path.split('/')[-1] in image['image-path']:
-                            return image['system-entities'][1]['dev-entry']
-                
-                # Size of disk image in bytes. This does not include overhead
-                @property
-                def size(self):
-                    return self._size
-       
-                @size.setter
-                def size(self, size):
-                    
-                    size = Helpers.get_bytes(size) if isinstance(size, str) else size
-                        
-                    # General validation testing that size is an int and that space is available on disk
-                    if not Helpers.is_float(size):
-                        raise Exception('Invalid argument. Size must be an integer')
-                    elif size >= Helpers.bytes_available():
-                        raise Exception('Invalid argument. Size is too large, not enough space.')
-                
-                    # Different handling cases depending on if size has been assigned before
-                    if self._size:
-                        self.run_hdiutil_command('resize', self.path, size=Helpers.hr_bytes(size))
-                    self._size = size
-                    
-  
-                # Path to the name of the volume (what appears when its mounted)
-                @property
-                def volname(self):
-                    return self._volname
-        
-                @volname.setter
-                def volname(self, volname):
-                    change_volname(self.volname, volname)
-                    self._volname = volname
-            
-    
-                # Path to disk image
-                @property
-                def path(self): return self._path
-        
-                @path.setter
-                def path(self, path):
-                    path_ar = path.split('/')
-                    if len(path_ar) > 1:
-                        filename = path_ar[-1]
-                        if not os.path.exists(os.path.expanduser('/'.join(path_ar[:-1]))):
-                            raise Exception('Invalid argument. Path cannot be found.')
-                            
-                    self._path = path
-                
-    
-                # File-system type
-                # Values: HFS+, 
-                @property
-                def fs(self): return self._fs
-                
-                @fs.setter
-                def fs(self, fs):
-                    if fs not in Constants.valid_args('create', 'fs'):
-                        raise Exception('Invalid argument. File-system (fs) arg must be among the following: ' + ', '.join(valid_args('create', 'fs')))
-                    else:
-                        self._fs = fs
-    
-                # Disk image type
-                # Values: UDIF, SPARSE, SPARSEBUNDLE
-                @property
-                def type(self): return self._type
-                
-                @type.setter
-                def type(self, type):
-                    if not type in Constants.valid_args('create', 'type'):
-                        raise Exception('Invalid argument. Type arg must be among the following ' + ', '.join(valid_args('create')))
-    
-                
-
-                # Formatting Helpers
-                #
-                # Converts a dict representing an instance of this object to a standardized format where keys 
-                # are the same as those used in bash commands
-                def standard_format(self):
-                    # Generate list form dict(self) but with leading underscore removed
-                    options = {k[1:]: v for k, v in self.__dict__}
-                    if not options['encryption']:
-                        del options['encryption']
-                    return options
-                # Converts bash style options to a format for this object type
-                def obj_format(self, data): return {'_' + k: v for k, v in dict(data).items()}
-                                    
-                def run_disk_util_command(self, *args, **kwargs):
-                    out = Helpers.run_command(*args, **kwargs)
-                # Runs an hdiutil command
-                def run_hdiutil_command(self, *args, **kwargs):
-                    args = ['hdiutil'] + list(args)
-                    try:
-                        out = Helpers.run_command(*args, **kwargs)
-                    except Exception, e:
-                        # Some commands require the disk-image to be mounted/unmounted. If ran when it isn't it returns
-                        # saying 'Resource temporarily unavailable'
-                        if 'Resource temporarily unavailable' in str(e):
-                            self.detach() if self.is_mounted() else self.attach()
-   
-                        out = Helpers.run_command(*args, **kwargs)
-                    return out
-                    
-                # Create a disk image from self
-                def create_command(self):
-
-                   options = self.standard_format()
-                   command = run_hdiutil_command('create', options.pop('path'), **options)
-                   
-                   
-            
-
-                # Info Extraction Helpers
-                #
-                # Extracts info of existing dmg and sets instance vars to match
-                def update(self):
-                    info = self.generate_data_model(self.diskutil_info())
-                    {k: setattr(self, k, v) for k, v in info.items()}
-
-                # Returns the path to the mounting point of the disk
-                def get_mounting_point(self):
-                    info = self.info()
-                    if info:
-                        return info['system-entities'][1]['dev-entry']
-                    else:
-                        raise Exception('Disk not found. Mount the image and try again.')
-
-                
-                # Helper method lets you know if the disk is mounted
-                def is_mounted(self): return True if self.info() else False
-
-                # Generate a dict of info used in DiskImage initialization
-                # image_info arg must be
-                def generate_data_model(self, image_info):
-                    ext = self.path.split('.')[-1]
-                    options = {
-                        'volname' : 'Volume Name',
-                        'fs' : 'File System Personality',
-                        'size' : 'Total Size'
-                    }
-                    options = {k: image_info[v] for k, v in options.items()}
-                    str_size = ' '.join(options['size'].split(' ')[:2])
-
-                    options['size'] = Helpers.get_bytes(str_size)
-                    options['type'] = ext if ext != 'dmg' else 'UDIF'
-                    
-                    return options
-                
-                # Commands
-                #
-                # Attaches a disk
-                def attach(self):
-                    cmd = 'attach'
-                    self.run_hdiutil_command(cmd, self.path)
-                    if self.is_encrypted():
-                        read_password() 
-                
-                # Detaches a disk
-                def detach(self):
-                    cmd = 'detach'
-                    self.run_hdiutil_command(cmd, self.mounting_point())
-                
-                # hdiutil isencrypted
-                def is_encrypted(self):
-                    if self.is_mounted(): self.info()['image-encrypted']
-                    else:
-                        output = self.run_command('isencrypted', self.path)
-                        is_encrypted = output.split(' ')[-1]
-                        return False if is_encrypted in ['NO'] else True
-     
-                        
-                
-                # Returns relevant portion of output to command: hdiutil info 
-                # Returns None if disk not mounted
-                def info(self):
-                    output = self.run_hdiutil_command('info', plist=None)
-                    info = plistlib.readPlistFromString(output)
-                    return [image for image in info['images'] if self.path.split('/')[-1] in image['image-path']][0]
-
-                # Returns output of command: hdiutil imageinfo
-                def imageinfo(self):
-                    output = self.run_command('imageinfo', self.path, plist=None)
-                    if self.is_mounted(): raise Exception('Command: hdiutil imageinfo cannot be run unless the disk is mounted')
-                    else: return plistlib.readPlistFromString(output)
-                # Returns relevant portion of command: diskutil info                
-                def diskutil_info(self):
-                    UTILITY_NAME = 'diskutil'
-                    self.attach()
-                         
-                    response = Helpers.run_command(UTILITY_NAME, 'info', self.get_mounting_point())
-                    non_empty_lines = [line for line in response.splitlines() if line != '']
-                    return {line.split(':')[0].lstrip() : line.split(':')[-1].strip() for line in non_empty_lines}
-                # Resets the password for the disk image
-                # hdiutil - chpass
-                def change_password(self):
-                    self.run_command('chpass')
-                    read_password()
-                
-           
-
-                    
-                 
-    
-        
-        
-        ## Subclassed disk-image types
-        class UDIF(DiskImage):
-            format = 'UDRW'
-        class Sparse(DiskImage):
-            format = 'UDSP'
-        class SparseBundle(DiskImage):
-            format = 'UDSB'
-            DEFAULT_BAND_SIZE = 1024 * 8
-            def __init__(self, options):
-                
-                self._sparse_band_size = self.DEFAULT_BAND_SIZE
-                super(SparseBundle, self).__init__(options)
-                
-            def prep_for_command(self):
-                options = super(SparseBundle, self).prep_for_command()
-                options += '{}={}'.format(self.sparse_band_size[1:].replace('_', '-'), self.sparse_band_size)
-            
-            @property
-            def sparse_band_size(self):
-                return _sparse_band_size
-                
-            #'Valid values for SPARSEBUNDLE range from 2048 to 16777216 sectors (1 MB to 8 GB)'
-            # Include support for changing band sizes
-            @sparse_band_size.setter
-            def sparse_band_size(self, size):
-                if self.sparse_band_size is None:
-                    self._sparse_band_size = size
-                else:
-                    raise Exception('Band-size of Sparse-bundle cannot be changed.')
-        
-        
-        
-        
-
-        
         # Merge create properly formatted option dict and copy in default values
-        options = dict(self.default_options)  
-        invalid_options = [el for el in options if el not in self.default_options]
+        options = dict(self.default_options)
+        invalid_options = [el for el in kwargs if el not in self.default_options]
         if invalid_options:
-            raise Exception('Invalid option: ' + ', '.join(invalid_options)) 
-        
-        
-        options = {k: str(kwargs[k]) for k, v in options.items() if k in kwargs and kwargs[k] is not None}
-
-        
-        types = {
-            'dmg' : UDIF,
-            'sparse' : Sparse,
-            'sparsebundle' : SparseBundle
-        }
-        return types[options['path'].split('.')[-1]](options)
-            
+            raise Exception('Invalid option: ' + ', '.join(invalid_options))
+
+
+        options.update({k: str(v) for k, v in kwargs.items() if v is not None})
+        # The extension decides the image type unless one was given, which has to agree with it
+        extension_type = Constants.image_type(options['path'])
+        if kwargs.get('type') is None and extension_type:
+            options['type'] = extension_type
+        elif extension_type and options['type'] != extension_type:
+            raise Exception('Invalid argument. Type {} does not match the extension of {}'.format(options['type'], options['path']))
+
+        image_class = DiskImage.class_for(path=options['path'], type=options['type'])
+        if options['sparse_band_size'] is not None and image_class is not SparseBundle:
+            raise Exception('Invalid option: sparse_band_size only applies to sparse bundles.')
+        # Left to the class default when not given
+        if options['sparse_band_size'] is None:
+            del options['sparse_band_size']
+        return image_class(options)
+
 
     # Works like create but builds a DiskImage object from a preexisting disk image
-    def load(self, path):
+    # With native=True the image file is parsed directly instead of being attached
+    # With lazy=True nothing is read until a field is accessed, see DiskImage.LAZY_SOURCES
+    def load(self, path, native=False, lazy=False):
         if not os.path.exists(os.path.expanduser(path)):
             raise Exception('Disk image not found.')
         else:
-            return self.create(path=path, create_new=False)      
+            return self.create(path=path, create_new=False, native=native, lazy=lazy)
+
+    # ImageRecords for many images, read without attaching any of them
+    def records(self, paths):
+        return [self.load(path, lazy=True).record() for path in paths]
+
+    # Batch Operations
+    #
+    # Each runs on a pool of at most max_workers threads (default MAX_WORKERS) and returns a BatchResult
+    # Lookups a batch makes up front read one `hdiutil info` snapshot, handed to the workers; the
+    # commands the workers run still invalidate HDIUtil.info_cache as soon as they finish
+    MAX_WORKERS = 8
+
+    # Usage: create_many([{'path': '~/a.dmg', 'size': '10m'}, {'path': '~/b.sparsebundle'}], max_workers=4)
+    def create_many(self, specs, max_workers=None):
+        return self._run_batch(lambda spec: self.create(**spec), specs, max_workers)
+
+    # Accepts DiskImage objects or paths
+    # Encryption is checked against the snapshot taken up front, or with hdiutil isencrypted for images
+    # it does not list, so the workers never wait on `hdiutil info` after their attach invalidated it
+    def attach_many(self, images, max_workers=None):
+        registry = HDIUtil.info_cache.registry()
+
+        def attach(image):
+            if isinstance(image, str):
+                CommandEngine.run(self.NAME, 'attach', image)
+            else:
+                image.attach(registry)
+            return image
+        return self._run_batch(attach, images, max_workers)
+
+    # Accepts DiskImage objects or paths, detaches every attached image when none are given
+    def detach_all(self, images=None, max_workers=None):
+        registry = HDIUtil.info_cache.registry()
+
+        def detach(image):
+            path = image if isinstance(image, str) else image.path
+            info = registry.by_path(path)
+            if info is None:
+                raise Exception('Disk not found: ' + path)
+            CommandEngine.run(self.NAME, 'detach', info['system-entities'][0]['dev-entry'])
+            HDIUtil.leases.detached(path)
+            return image
+
+        if images is None:
+            images = [info['image-path'] for info in registry]
+        return self._run_batch(detach, images, max_workers)
+
+    def _run_batch(self, func, items, max_workers=None):
+        items = list(items)
+
+        def work(item):
+            start = clock()
+            try:
+                return (func(item), None, clock() - start)
+            except Exception as e:
+                return (None, e, clock() - start)
+
+        start = clock()
+        pool = ThreadPool(max(1, min(max_workers or self.MAX_WORKERS, len(items))))
+        try:
+            outcomes = pool.map(work, items)
+        finally:
+            pool.close()
+            pool.join()
+        return BatchResult(items, outcomes, clock() - start)
+
+    # Runs an hdiutil verb with -puppetstrings, returning a ProgressStream over its progress
+    # Usage: for event in hdiutil.stream('compact', '~/build.sparsebundle'): print(event.percent, event.phase)
+    def stream(self, *args, **kwargs):
+        return stream_command(self.NAME, *args, **kwargs)
+
+    # Checksums of every disk image below directory, keyed by real path
+    # Usage: hdiutil.checksum_directory('~/builds')
+    def checksum_directory(self, directory, recursive=True):
+        return HDIUtil.checksums.scan(directory, recursive)
+
+    # Reassembles an image cut by DiskImage.segment, returning it as a lazily loaded DiskImage
+    # manifest is a SegmentManifest or the path of one; see segment.join for resuming and verification
+    def join(self, manifest, output=None, workers=None, progress=None):
+        path = segment.join(manifest, output, workers, progress=progress)
+        return DiskImage.class_for(path)({'path' : path, 'create_new' : 'False', 'lazy' : 'True'})
+
+    # Indexed view of every image hdiutil reports as attached
+    # Usage: hdiutil.registry().select(type='SPARSEBUNDLE', mounted=True)
+    def registry(self):
+        return HDIUtil.info_cache.registry()
+
+# Attaches, detaches, resizes, creates and renames run through CommandEngine invalidate the shared snapshot
+CommandEngine.add_post_hook(HDIUtil.info_cache.observe)
+# Images left attached to stay warm are detached when the interpreter exits
+atexit.register(HDIUtil.leases.close)
 
 # Driver Code
 if __name__ == '__main__':
@@ -386,4 +880,4 @@ if __name__ == '__main__':
     disk_image = hdiutil.load('~/desktop/mydmg2.dmg')
     disk_image.volname = 'poopy'
 
-    print disk_image
\ No newline at end of file
+    print(disk_image)
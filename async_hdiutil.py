@@ -0,0 +1,264 @@
+#
+# asyncio interface to hdiutil. Requires Python 3.5+
+#
+## Usage:
+##    hdiutil = AsyncHDIUtil(timeout=60)
+##    image = await hdiutil.create('~/images/build.sparsebundle', size='1g', type='SPARSEBUNDLE')
+##    await image.attach()
+##    await image.resize('2g', timeout=30)
+##    async for event in hdiutil.stream('compact', '~/images/build.sparsebundle'): print(event.percent)
+#
+
+import asyncio, os
+from HDIUtil_Constants import Constants
+from info_cache import ImageRegistry
+from progress import ProgressParser
+from utils import CommandEngine, CommandError, CommandResult, Helpers, clock
+
+## Runs a command without a shell and returns its stdout
+#
+## Usage: await run_command('hdiutil', 'info', plist=None, timeout=10)
+## The child is killed if the call times out or the awaiting task is cancelled.
+## CommandEngine's pre- and post-hooks fire as they do for synchronous commands
+async def run_command(*args, timeout=None, **kwargs):
+    argv = Helpers.generate_command_args(*args, **kwargs)
+    CommandEngine.before(argv)
+    start = clock()
+    try:
+        proc = await asyncio.create_subprocess_exec(*argv,
+                                                    stdin=asyncio.subprocess.DEVNULL,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE)
+    except OSError:
+        raise Exception('OSError, Command not found: ' + argv[0])
+
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout)
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+
+    result = CommandResult(argv, proc.returncode, out, err, clock() - start)
+    CommandEngine.after(result)
+    if not result.ok:
+        raise CommandError(result)
+    return out
+
+
+## Asynchronous iterator over the progress of one running command, see progress.ProgressStream
+#
+## Usage: async for event in AsyncProgressStream(argv): ...
+## The command starts on the first iteration and result holds the CommandResult once it ends.
+## cancel(), or cancelling the iterating task, kills the child; iteration then ends without raising
+class AsyncProgressStream(object):
+
+    def __init__(self, argv, timeout=None):
+        self.argv = argv
+        self.timeout = timeout
+        self.result = None
+        self.cancelled = False
+        self._proc = None
+        self._parser = ProgressParser()
+        self._output = []
+        self._errors = None
+        self._start = None
+
+    def __repr__(self):
+        state = 'cancelled' if self.cancelled else ('finished' if self.result else 'running' if self._proc else 'pending')
+        return 'AsyncProgressStream({!r}, {})'.format(self.argv, state)
+
+    def __aiter__(self): return self
+
+    async def __anext__(self):
+        if self.result is not None or (self.cancelled and self._proc is None):
+            raise StopAsyncIteration
+        if self._proc is None:
+            await self._spawn()
+
+        try:
+            while True:
+                line = await self._readline()
+                if not line:
+                    break
+                event = self._parser.feed(line)
+                if event is None:
+                    continue
+                if event.kind == 'output':
+                    self._output.append(event.message)
+                return event
+        except BaseException:
+            # Timeouts and cancellation of the iterating task stop the command
+            self.cancel()
+            await self._finish()
+            raise
+
+        await self._finish()
+        if not self.result.ok and not self.cancelled:
+            raise CommandError(self.result)
+        raise StopAsyncIteration
+
+    # Stops the command, iteration ends at the next step
+    def cancel(self):
+        self.cancelled = True
+        if self._proc is not None and self._proc.returncode is None:
+            try:
+                self._proc.kill()
+            except ProcessLookupError:
+                pass
+
+    # Runs the command to completion, calling callback with every event, and returns the result
+    async def wait(self, callback=None):
+        async for event in self:
+            if callback is not None:
+                callback(event)
+        return self.result
+
+    async def _spawn(self):
+        CommandEngine.before(self.argv)
+        self._start = clock()
+        try:
+            self._proc = await asyncio.create_subprocess_exec(*self.argv,
+                                                              stdin=asyncio.subprocess.DEVNULL,
+                                                              stdout=asyncio.subprocess.PIPE,
+                                                              stderr=asyncio.subprocess.PIPE)
+        except OSError:
+            raise Exception('OSError, Command not found: ' + self.argv[0])
+        # stderr is drained on the side so a chatty command cannot block on a full pipe
+        self._errors = asyncio.ensure_future(self._proc.stderr.read())
+
+    # The timeout bounds the whole command, not each line
+    async def _readline(self):
+        if self.timeout is None:
+            return await self._proc.stdout.readline()
+        return await asyncio.wait_for(self._proc.stdout.readline(), self.timeout - (clock() - self._start))
+
+    async def _finish(self):
+        if self.result is not None:
+            return
+        await self._proc.wait()
+        err = await self._errors
+        self.result = CommandResult(self.argv, self._proc.returncode, '\n'.join(self._output), err, clock() - self._start)
+        CommandEngine.after(self.result)
+
+
+class AsyncHDIUtil(object):
+
+    # Utility name
+    NAME = 'hdiutil'
+
+    # timeout: default per-call timeout in seconds, None waits indefinitely
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    # Runs an hdiutil verb, a timeout passed here overrides the default
+    async def run_hdiutil_command(self, *args, timeout=None, **kwargs):
+        timeout = self.timeout if timeout is None else timeout
+        return await run_command(self.NAME, *args, timeout=timeout, **kwargs)
+
+    # Runs an hdiutil verb with -puppetstrings, returning an AsyncProgressStream over its progress
+    # Usage: async for event in hdiutil.stream('convert', path, format='UDZO', o=output): ...
+    def stream(self, *args, timeout=None, **kwargs):
+        kwargs['puppetstrings'] = None
+        argv = [os.path.expanduser(arg) if arg.startswith('~') else arg
+                for arg in Helpers.generate_command_args(self.NAME, *args, **kwargs)]
+        return AsyncProgressStream(argv, self.timeout if timeout is None else timeout)
+
+    # Creates a new disk image, options are validated like HDIUtil.create()
+    # Usage: await create('~/a.sparsebundle', size='1g', type='SPARSEBUNDLE', volname='Build')
+    async def create(self, path, timeout=None, **options):
+        options = {k: v for k, v in options.items() if v is not None}
+        if 'type' not in options and Constants.image_type(path):
+            options['type'] = Constants.image_type(path)
+        Constants.validate('create', options)
+        # Encryption is off unless a cipher is given
+        if not options.get('encryption'):
+            options.pop('encryption', None)
+
+        await self.run_hdiutil_command('create', os.path.expanduser(path), timeout=timeout, **options)
+        return AsyncDiskImage(self, path, **options)
+
+    # Builds an AsyncDiskImage from a preexisting disk image, filling volname, fs and size
+    async def load(self, path, timeout=None):
+        if not os.path.exists(os.path.expanduser(path)):
+            raise Exception('Disk image not found.')
+        image = AsyncDiskImage(self, path)
+        await image.update(timeout=timeout)
+        return image
+
+    # Indexed view of every attached image
+    async def registry(self, timeout=None):
+        output = await self.run_hdiutil_command('info', timeout=timeout, plist=None)
+        return ImageRegistry(Helpers.read_plist(output))
+
+
+## Awaitable counterpart to the DiskImage returned by HDIUtil.create()
+#
+## Every operation accepts timeout=, overriding the owning AsyncHDIUtil's default
+class AsyncDiskImage(object):
+
+    def __init__(self, hdiutil, path, **options):
+        self.hdiutil = hdiutil
+        self.path = path
+        self.type = options.get('type') or Constants.image_type(path)
+        self.volname = options.get('volname')
+        self.fs = options.get('fs')
+        self.size = Helpers.get_bytes(options['size']) if isinstance(options.get('size'), str) else options.get('size')
+        self.encryption = options.get('encryption', False)
+
+    def __repr__(self):
+        return 'AsyncDiskImage({!r}, type={}, volname={}, fs={}, size={})'.format(
+            self.path, self.type, self.volname, self.fs, self.size)
+
+    # Returns this image's entry of `hdiutil info`, None if it is not attached
+    async def info(self, timeout=None):
+        registry = await self.hdiutil.registry(timeout=timeout)
+        return registry.by_path(self.path)
+
+    async def is_mounted(self, timeout=None):
+        return await self.info(timeout=timeout) is not None
+
+    # Returns the dev-entry of the image's volume, None if it is not attached
+    async def mounting_point(self, timeout=None):
+        info = await self.info(timeout=timeout)
+        if info:
+            return info['system-entities'][1]['dev-entry']
+
+    async def attach(self, timeout=None):
+        await self.hdiutil.run_hdiutil_command('attach', os.path.expanduser(self.path), timeout=timeout)
+
+    async def detach(self, timeout=None):
+        mounting_point = await self.mounting_point(timeout=timeout)
+        if mounting_point is None:
+            raise Exception('Disk not found. Mount the image and try again.')
+        await self.hdiutil.run_hdiutil_command('detach', mounting_point, timeout=timeout)
+
+    # Usage: await resize('2g') or await resize(2000000000)
+    async def resize(self, size, timeout=None):
+        size = Helpers.get_bytes(size) if isinstance(size, str) else size
+        if not Helpers.is_float(size):
+            raise Exception('Invalid argument. Size must be an integer')
+        await self.hdiutil.run_hdiutil_command('resize', os.path.expanduser(self.path),
+                                               timeout=timeout, size=Helpers.hr_bytes(size))
+        self.size = size
+
+    # Converts to another format, returning the new image
+    # Usage: await convert('UDZO', '~/dist/build.dmg')
+    async def convert(self, format, output, timeout=None):
+        Constants.validate('convert', {'format' : format})
+        await self.hdiutil.run_hdiutil_command('convert', os.path.expanduser(self.path), timeout=timeout,
+                                               format=format, o=os.path.expanduser(output))
+        return AsyncDiskImage(self.hdiutil, output, volname=self.volname, fs=self.fs, size=self.size)
+
+    # Refreshes volname, fs and size from `diskutil info`, attaching the image if needed
+    async def update(self, timeout=None):
+        if not await self.is_mounted(timeout=timeout):
+            await self.attach(timeout=timeout)
+        mounting_point = await self.mounting_point(timeout=timeout)
+        output = await run_command('diskutil', 'info', mounting_point,
+                                   timeout=self.hdiutil.timeout if timeout is None else timeout)
+        image_info = Helpers.parse_diskutil_info(output)
+        self.volname = image_info['Volume Name']
+        self.fs = image_info['File System Personality']
+        self.size = Helpers.get_bytes(' '.join(image_info['Total Size'].split(' ')[:2]))
@@ -0,0 +1,166 @@
+#
+# Measures the latency and subprocess count of wrapper operations against a fake backend
+#
+## Usage: python benchmarks/bench_backend.py [--fleet 1,10,100] [--iterations 10] [--latency 0.005] [--output results.jsonl]
+## hdiutil and diskutil are replaced by fake_backend.py for the run, with fleet images attached,
+## so results do not depend on the host's disks. Prints one JSON object per benchmark and fleet
+## size; --output also appends them to a file, for tracking regressions across commits
+#
+
+import argparse, json, os, shutil, stat, sys, tempfile, time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.pardir))
+
+from PyHDIUtil import HDIUtil
+from fake_backend import write_state
+from utils import CommandEngine, Helpers
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+## A temporary directory with fleet images attached to a fake hdiutil and diskutil
+#
+## The fakes are put first on PATH for the lifetime of the backend
+class FakeBackend(object):
+
+    def __init__(self, fleet, latency=0.0):
+        self.directory = tempfile.mkdtemp(prefix='pyhdiutil-bench-')
+        self.bin = os.path.join(self.directory, 'bin')
+        self.state = os.path.join(self.directory, 'state.json')
+        self.log = os.path.join(self.directory, 'calls.log')
+        os.mkdir(self.bin)
+        for utility in ('hdiutil', 'diskutil'):
+            wrapper = os.path.join(self.bin, utility)
+            with open(wrapper, 'w') as f:
+                f.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(sys.executable, os.path.join(BENCHMARKS_DIR, 'fake_backend.py'), utility))
+            os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IXUSR)
+
+        self.images = [self.image_path('fleet{}.dmg'.format(i)) for i in range(fleet)]
+        self.detached = self.image_path('detached.dmg')
+        for path in self.images + [self.detached]:
+            open(path, 'wb').close()
+        write_state(self.state, self.images)
+        open(self.log, 'w').close()
+
+        self._environ = dict(os.environ)
+        os.environ.update({'PATH' : self.bin + os.pathsep + os.environ.get('PATH', ''),
+                           'FAKE_BACKEND_STATE' : self.state,
+                           'FAKE_BACKEND_LOG' : self.log,
+                           'FAKE_BACKEND_LATENCY' : str(latency)})
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.close()
+
+    def close(self):
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.directory)
+
+    def image_path(self, name):
+        return os.path.realpath(os.path.join(self.directory, name))
+
+    # Subprocesses spawned so far, counted by the fakes themselves
+    @property
+    def calls(self):
+        with open(self.log) as f:
+            return sum(1 for line in f)
+
+
+# Runs setup untimed, then operation timed, iterations times
+# Returns per-iteration seconds and subprocess counts
+def measure(backend, operation, iterations, setup=None):
+    seconds = []
+    calls = []
+    for i in range(iterations):
+        if setup is not None:
+            setup(i)
+        before = backend.calls
+        start = _clock()
+        operation(i)
+        seconds.append(_clock() - start)
+        calls.append(backend.calls - before)
+    return seconds, calls
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+# Every benchmark as (name, operation, setup), run against a backend with fleet images attached
+def benchmarks(backend, hdiutil):
+    cache = HDIUtil.info_cache
+    first = backend.images[0] if backend.images else backend.detached
+
+    def reset(i):
+        HDIUtil.leases.flush()
+        cache.invalidate()
+
+    def warm(i):
+        cache.invalidate()
+        hdiutil.load(first, lazy=True).info()
+
+    def new_path(i):
+        return backend.image_path('created-{}-{}.dmg'.format(id(backend), i))
+
+    return [
+        # Spawning through a shell against spawning argv lists directly
+        ('run_command_shell', lambda i: Helpers.run_command('hdiutil', 'info', plist=None), None),
+        ('engine_run', lambda i: CommandEngine.run('hdiutil', 'info', plist=None), None),
+        # `hdiutil info` plist parsing and indexing, then the cached lookup
+        ('info_cold', lambda i: hdiutil.load(first, lazy=True).info(), reset),
+        ('info_warm', lambda i: hdiutil.load(first, lazy=True).info(), warm),
+        ('create', lambda i: hdiutil.create(path=new_path(i), size='10m'), reset),
+        # Eager loads go through diskutil_info(), attaching the image if it is not attached yet
+        ('load_attached', lambda i: hdiutil.load(first), reset),
+        ('load_detached', lambda i: hdiutil.load(backend.detached), reset),
+        ('load_lazy_record', lambda i: hdiutil.load(first, lazy=True).record(), reset),
+        # Bulk operations over the whole fleet
+        ('records', lambda i: hdiutil.records(backend.images), reset),
+        ('detach_all', lambda i: hdiutil.detach_all(), lambda i: (reset(i), write_state(backend.state, backend.images))),
+        ('attach_many', lambda i: hdiutil.attach_many(backend.images), lambda i: (reset(i), write_state(backend.state))),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark PyHDIUtil against a fake hdiutil/diskutil backend.')
+    parser.add_argument('--fleet', default='1,10,100', help='comma-separated numbers of attached images')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every fake invocation sleeps')
+    parser.add_argument('--only', help='comma-separated benchmark names')
+    parser.add_argument('--output', help='file the JSON lines are appended to')
+    args = parser.parse_args(argv)
+
+    only = set(args.only.split(',')) if args.only else None
+    output = open(args.output, 'a') if args.output else None
+    hdiutil = HDIUtil()
+    try:
+        for fleet in [int(size) for size in args.fleet.split(',')]:
+            with FakeBackend(fleet, args.latency) as backend:
+                for name, operation, setup in benchmarks(backend, hdiutil):
+                    if only is not None and name not in only:
+                        continue
+                    seconds, calls = measure(backend, operation, args.iterations, setup)
+                    result = {'benchmark' : name, 'fleet' : fleet, 'iterations' : args.iterations,
+                              'latency' : args.latency, 'python' : sys.version.split()[0],
+                              'mean_ms' : round(sum(seconds) / len(seconds) * 1e3, 3),
+                              'p50_ms' : round(percentile(seconds, 0.5) * 1e3, 3),
+                              'p95_ms' : round(percentile(seconds, 0.95) * 1e3, 3),
+                              'max_ms' : round(max(seconds) * 1e3, 3),
+                              'subprocesses' : round(sum(calls) / float(len(calls)), 2)}
+                    line = json.dumps(result, sort_keys=True)
+                    print(line)
+                    if output:
+                        output.write(line + '\n')
+                # Leave nothing attached to this backend's fakes
+                HDIUtil.leases.flush()
+                HDIUtil.info_cache.invalidate()
+    finally:
+        if output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#
+# Measures construction time and memory per DiskImage object
+#
+## Usage: python benchmarks/bench_objects.py [count]
+## Prints one JSON object per measurement. Images are loaded lazily from an empty
+## placeholder file, so no hdiutil process is spawned
+#
+
+import gc, json, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from PyHDIUtil import HDIUtil
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+# Returns (seconds, bytes) used per object built by factory
+def measure(factory, count):
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    else:
+        import resource
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = _clock()
+    objects = [factory(i) for i in range(count)]
+    elapsed = _clock() - start
+
+    if tracemalloc:
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    else:
+        # ru_maxrss is in kilobytes on Linux
+        allocated = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) * 1024
+    del objects
+    return elapsed / count, allocated / float(count)
+
+
+def main(count):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'bench.dmg')
+        open(path, 'wb').close()
+        hdiutil = HDIUtil()
+
+        image = hdiutil.load(path, lazy=True)
+        benchmarks = [('DiskImage', lambda i: hdiutil.load(path, lazy=True)),
+                      ('ImageRecord', lambda i: image.record())]
+
+        for name, factory in benchmarks:
+            seconds, size = measure(factory, count)
+            print(json.dumps({'benchmark' : name, 'count' : count, 'python' : sys.version.split()[0],
+                              'memory' : 'tracemalloc' if tracemalloc else 'maxrss',
+                              'us_per_object' : round(seconds * 1e6, 2), 'bytes_per_object' : round(size, 1)}))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
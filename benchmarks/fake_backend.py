@@ -0,0 +1,192 @@
+#
+# Deterministic stand-in for hdiutil and diskutil, used by the benchmarks
+#
+## Usage: python fake_backend.py hdiutil info -plist
+##        python fake_backend.py diskutil info /dev/disk2s1
+## bench_backend.py installs wrappers named hdiutil and diskutil that exec this script, so the
+## wrapper runs real subprocesses against canned output. Configured through the environment:
+##    FAKE_BACKEND_STATE    JSON file holding the attached images, see write_state()
+##    FAKE_BACKEND_LOG      every invocation is appended here as one line
+##    FAKE_BACKEND_LATENCY  seconds each invocation sleeps before answering (default 0)
+##    FAKE_BACKEND_PIDS     optional file every invocation appends its process id to, so tests
+##                          can check that a timed-out or cancelled command was killed
+##    FAKE_BACKEND_REPLAY   optional file of recorded -puppetstrings output, printed line by line
+##                          instead of the made-up progress of long verbs
+##    FAKE_BACKEND_LINE_DELAY  seconds between replayed lines (default 0)
+## Runs on Python 2.7 and 3
+#
+
+import fcntl, json, os, plistlib, shutil, sys, time
+
+SECTOR_SIZE = 512
+DEFAULT_SIZE = 100 * 1000 * 1000
+
+
+# Writes a state with the given images attached, each a path or a dict with path and volname
+def write_state(path, images=()):
+    state = {'images' : [], 'next_dev' : 2}
+    for image in images:
+        image = image if isinstance(image, dict) else {'path' : image}
+        state['images'].append(_new_image(state, image['path'], image.get('volname')))
+    with open(path, 'w') as f:
+        json.dump(state, f)
+
+
+def _new_image(state, path, volname=None):
+    image = {'path' : path, 'dev' : state['next_dev'],
+             'volname' : volname or os.path.splitext(os.path.basename(path))[0] or 'Volume'}
+    state['next_dev'] += 1
+    return image
+
+
+def _dump_plist(data):
+    if hasattr(plistlib, 'dumps'):
+        return plistlib.dumps(data)
+    return plistlib.writePlistToString(data)
+
+
+def _write(data):
+    getattr(sys.stdout, 'buffer', sys.stdout).write(data if isinstance(data, bytes) else data.encode('utf-8'))
+
+
+def _fail(utility, verb, message):
+    sys.stderr.write('{}: {} failed - {}\n'.format(utility, verb, message))
+    return 1
+
+
+def _find(state, key):
+    for image in state['images']:
+        if key in ('/dev/disk{}'.format(image['dev']), '/dev/disk{}s1'.format(image['dev']), 'disk{}s1'.format(image['dev']),
+                   '/Volumes/' + image['volname'], image['volname']):
+            return image
+
+
+# `hdiutil info -plist` output for the attached images
+def info_plist(state):
+    images = []
+    for image in state['images']:
+        images.append({'image-path' : image['path'],
+                       'image-encrypted' : False,
+                       'image-type' : 'read/write disk image',
+                       'writeable' : True,
+                       'system-entities' : [{'dev-entry' : '/dev/disk{}'.format(image['dev']), 'content-hint' : 'GUID_partition_scheme'},
+                                            {'dev-entry' : '/dev/disk{}s1'.format(image['dev']), 'content-hint' : 'Apple_HFS',
+                                             'mount-point' : '/Volumes/' + image['volname'], 'volume-kind' : 'hfs'}]})
+    return _dump_plist({'framework' : '671.40.2', 'revision' : '671.40.2', 'vendor' : 'Apple', 'images' : images})
+
+
+def hdiutil(state, args):
+    verb, rest = args[0], args[1:]
+    options = [arg for arg in rest if arg.startswith('-')]
+    positional = [arg for arg in rest if not arg.startswith('-')]
+
+    if verb == 'info':
+        _write(info_plist(state) if '-plist' in options else '\n'.join(image['path'] for image in state['images']) + '\n')
+    elif verb == 'attach':
+        path = os.path.realpath(positional[0])
+        if not os.path.exists(path):
+            return _fail('hdiutil', 'attach', 'No such file or directory')
+        image = [image for image in state['images'] if image['path'] == path]
+        if not image:
+            image = [_new_image(state, path)]
+            state['images'].append(image[0])
+        _write('/dev/disk{0}\tGUID_partition_scheme\t\n/dev/disk{0}s1\tApple_HFS\t/Volumes/{1}\n'.format(image[0]['dev'], image[0]['volname']))
+    elif verb == 'detach':
+        image = _find(state, positional[0])
+        if image is None:
+            return _fail('hdiutil', 'detach', 'No such file or directory')
+        state['images'].remove(image)
+        _write('"disk{}" ejected.\n'.format(image['dev']))
+    elif verb == 'create':
+        path = positional[0]
+        if os.path.exists(path):
+            return _fail('hdiutil', 'create', 'File exists')
+        if path.endswith('.sparsebundle'):
+            os.mkdir(path)
+        else:
+            open(path, 'wb').close()
+        _write('created: {}\n'.format(path))
+    elif verb == 'convert':
+        output = rest[rest.index('-o') + 1]
+        if os.path.exists(output) and '-ov' not in options:
+            return _fail('hdiutil', 'convert', 'File exists')
+        _progress(options)
+        shutil.copy(positional[0], output)
+        _write('created: {}\n'.format(output))
+    elif verb in ('compact', 'resize', 'verify'):
+        _progress(options)
+    elif verb == 'isencrypted':
+        _write('encrypted: NO\n')
+    elif verb == 'imageinfo':
+        _write(_dump_plist({'Format' : 'UDRW', 'Partitions' : {},
+                            'Size Information' : {'Total Bytes' : DEFAULT_SIZE, 'Sector Count' : DEFAULT_SIZE // SECTOR_SIZE}}))
+    return 0
+
+
+def _progress(options):
+    if '-puppetstrings' not in options:
+        return
+    replay = os.environ.get('FAKE_BACKEND_REPLAY')
+    if not replay:
+        for percent in (0, 50, 100):
+            _write('PERCENT:{:f}\n'.format(percent))
+        return
+    delay = float(os.environ.get('FAKE_BACKEND_LINE_DELAY', '0'))
+    with open(replay, 'rb') as f:
+        for line in f:
+            _write(line)
+            sys.stdout.flush()
+            time.sleep(delay)
+
+
+def diskutil(state, args):
+    verb, rest = args[0], args[1:]
+    if verb == 'info':
+        image = _find(state, rest[0])
+        if image is None:
+            return _fail('diskutil', 'info', 'Could not find disk: ' + rest[0])
+        _write('\n'.join(['   Device Identifier:        disk{}s1'.format(image['dev']),
+                          '   Device Node:              /dev/disk{}s1'.format(image['dev']),
+                          '',
+                          '   Volume Name:              ' + image['volname'],
+                          '   Mounted:                  Yes',
+                          '   Mount Point:              /Volumes/' + image['volname'],
+                          '',
+                          '   File System Personality:  HFS+',
+                          '   Total Size:               100.0 MB (100000000 Bytes) (exactly 195313 512-Byte-Units)',
+                          '']))
+    elif verb == 'rename':
+        image = _find(state, rest[0])
+        if image is None:
+            return _fail('diskutil', 'rename', 'Could not find disk: ' + rest[0])
+        image['volname'] = rest[1]
+        _write('Volume on disk{}s1 renamed to {}\n'.format(image['dev'], rest[1]))
+    return 0
+
+
+def main(argv):
+    utility, args = argv[1], argv[2:]
+    log = os.environ.get('FAKE_BACKEND_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.write(' '.join([utility] + args) + '\n')
+    pids = os.environ.get('FAKE_BACKEND_PIDS')
+    if pids:
+        with open(pids, 'a') as f:
+            f.write('{}\n'.format(os.getpid()))
+    time.sleep(float(os.environ.get('FAKE_BACKEND_LATENCY', '0')))
+
+    # Concurrent invocations see and update the state one at a time
+    state_path = os.environ['FAKE_BACKEND_STATE']
+    with open(state_path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(state_path) as f:
+            state = json.load(f)
+        status = (hdiutil if utility == 'hdiutil' else diskutil)(state, args)
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
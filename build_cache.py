@@ -0,0 +1,256 @@
+#
+# Builds images from source folders, reusing earlier builds of the same content
+#
+## Usage: builder = ImageBuilder(max_bytes=20 * 1000 ** 3)
+##        image = builder.build('~/build/Payload', '~/dist/Payload.dmg', volname='Payload', format='UDZO')
+## The source folder is summarized by a Merkle tree hash: a file's digest comes from
+## checksum.Checksummer, whose cache skips files whose size, mtime and inode are unchanged, and a
+## directory's digest is the hash of its entries' names, permissions and digests. The tree hash
+## and the create options key a local cache of built images; a hit clones the cached image,
+## copy-on-write where the filesystem supports it, instead of running hdiutil create
+#
+
+import binascii, hashlib, json, os, shutil, stat, sys, threading, time
+from HDIUtil_Constants import Constants
+from PyHDIUtil import DiskImage
+from checksum import Checksummer, ChecksumCache
+from conversion import image_bytes
+from progress import stream_command
+from utils import CommandEngine, Helpers
+
+
+def _raise(error):
+    raise error
+
+
+# Names from os.walk are bytes on Python 2 and text on Python 3
+def _encode(name):
+    return name if isinstance(name, bytes) else name.encode('utf-8', 'surrogateescape')
+
+
+## Hex Merkle hash of a folder
+#
+## Symbolic links are hashed by their target and not followed
+def tree_hash(source, checksummer):
+    source = os.path.realpath(os.path.expanduser(source))
+    if not os.path.isdir(source):
+        raise Exception('Source folder not found: ' + source)
+
+    listings = {}
+    files = []
+    for root, dirs, names in os.walk(source, onerror=_raise):
+        listing = listings[root] = []
+        for name in dirs + names:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                listing.append((b'l', name, 0, os.readlink(path)))
+            elif stat.S_ISDIR(st.st_mode):
+                listing.append((b'd', name, stat.S_IMODE(st.st_mode), path))
+            elif stat.S_ISREG(st.st_mode):
+                listing.append((b'f', name, stat.S_IMODE(st.st_mode), path))
+                files.append(path)
+    digests = checksummer.checksums(files)
+
+    def node(directory):
+        digest = hashlib.new(checksummer.algorithm)
+        for kind, name, mode, payload in sorted(listings[directory], key=lambda entry: entry[1]):
+            if kind == b'd':
+                child = node(payload)
+            elif kind == b'f':
+                child = binascii.unhexlify(digests[payload])
+            else:
+                child = hashlib.new(checksummer.algorithm, _encode(payload)).digest()
+            digest.update(kind + b'\0' + _encode(name) + b'\0' + '{:o}'.format(mode).encode('ascii') + b'\0' + child)
+        return digest.digest()
+
+    return binascii.hexlify(node(source)).decode('ascii')
+
+
+# Copies an image file or bundle, as a copy-on-write clone where the filesystem supports one
+# (clonefile on APFS, reflinks on Btrfs and XFS)
+def clone(source, destination):
+    recursive = ['-R'] if os.path.isdir(source) else []
+    try:
+        if sys.platform == 'darwin':
+            CommandEngine.run('cp', '-c', *(recursive + [source, destination]))
+        else:
+            CommandEngine.run('cp', '--reflink=auto', *(recursive + [source, destination]))
+        return
+    except Exception:
+        # Filesystems without clones and cp implementations without the option
+        _remove(destination)
+    if recursive:
+        shutil.copytree(source, destination, symlinks=True)
+    else:
+        shutil.copy2(source, destination)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+## Directory of built images keyed by build key, evicting the least recently used
+#
+## max_bytes and max_entries bound the cache, None leaves that bound off. index.json records
+## each entry's size and last use
+class ImageCache(object):
+
+    INDEX = 'index.json'
+
+    def __init__(self, directory, max_bytes=None, max_entries=None):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index = None
+
+    def __repr__(self):
+        with self._lock:
+            index = self._entries()
+            return 'ImageCache({!r}, {} entries, {} bytes, {} hits, {} misses)'.format(
+                self.directory, len(index), sum(entry['bytes'] for entry in index.values()), self.hits, self.misses)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries()
+
+    # Bytes used by every cached image
+    @property
+    def size(self):
+        with self._lock:
+            return sum(entry['bytes'] for entry in self._entries().values())
+
+    # Clones the image cached under key to destination, returns False on a miss
+    def get(self, key, destination):
+        with self._lock:
+            entry = self._entries().get(key)
+            if entry is None or not os.path.exists(self._path(entry)):
+                self._entries().pop(key, None)
+                self.misses += 1
+                return False
+            entry['used'] = time.time()
+            self.hits += 1
+            self._save()
+            cached = self._path(entry)
+            # Held while cloning, so eviction cannot remove the image halfway through
+            self._copy(cached, os.path.expanduser(destination))
+        return True
+
+    # Adds a copy of the image at path under key, then evicts down to the bounds
+    def put(self, key, path):
+        path = os.path.expanduser(path)
+        name = key + os.path.splitext(os.path.normpath(path))[1]
+        with self._lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self._copy(path, os.path.join(self.directory, name))
+            self._entries()[key] = {'name' : name, 'bytes' : image_bytes(path), 'used' : time.time()}
+            self._evict()
+            self._save()
+
+    # Removes entries, least recently used first, until the cache is within its bounds
+    def evict(self):
+        with self._lock:
+            self._evict()
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries().values():
+                _remove(self._path(entry))
+            self._entries().clear()
+            self._save()
+
+    # ImageCache Helpers
+    #
+    # Called with the lock held
+    def _entries(self):
+        if self._index is None:
+            try:
+                with open(os.path.join(self.directory, self.INDEX)) as f:
+                    self._index = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _path(self, entry):
+        return os.path.join(self.directory, entry['name'])
+
+    def _evict(self):
+        index = self._entries()
+        by_age = sorted(index, key=lambda key: index[key]['used'])
+        total = sum(entry['bytes'] for entry in index.values())
+        while by_age and ((self.max_entries is not None and len(index) > self.max_entries) or
+                          (self.max_bytes is not None and total > self.max_bytes)):
+            entry = index.pop(by_age.pop(0))
+            _remove(self._path(entry))
+            total -= entry['bytes']
+
+    def _save(self):
+        if not os.path.isdir(self.directory):
+            return
+        Helpers.write_json(os.path.join(self.directory, self.INDEX), self._index)
+
+    # Clones through a temporary name, so an interrupted copy never looks complete
+    @staticmethod
+    def _copy(source, destination):
+        temporary = Helpers.temporary_path(destination, 'partial')
+        _remove(temporary)
+        try:
+            clone(source, temporary)
+            os.rename(temporary, destination)
+        except Exception:
+            _remove(temporary)
+            raise
+
+
+class ImageBuilder(object):
+
+    DEFAULT_DIRECTORY = '~/.pyhdiutil/build-cache'
+
+    ## directory: where built images and the source-file digest cache are kept
+    ## max_bytes, max_entries: bounds of the image cache, see ImageCache
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=None, max_entries=None, checksummer=None):
+        self.cache = ImageCache(directory, max_bytes, max_entries)
+        self.checksummer = checksummer or Checksummer(cache=ChecksumCache(os.path.join(directory, 'files.json')))
+
+    def __repr__(self):
+        return 'ImageBuilder({!r})'.format(self.cache)
+
+    # Hex Merkle hash of the source folder
+    def tree_hash(self, source):
+        return tree_hash(source, self.checksummer)
+
+    # Cache key of building path from source with options; the extension of path picks the
+    # image type, so it is part of the key
+    def key(self, source, path, **options):
+        description = {'tree' : self.tree_hash(source),
+                       'extension' : os.path.splitext(os.path.normpath(path))[1].lower(),
+                       'options' : {k: '{}'.format(v) for k, v in options.items() if v is not None}}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+    ## Creates the image at path holding the contents of source, returning a lazily loaded DiskImage
+    #
+    ## options are hdiutil create options such as volname, fs or format. With cached set the image
+    ## is cloned from the cache when an identical build is found, and added to it otherwise.
+    ## progress is called with every ProgressEvent of hdiutil create, see progress.py
+    def build(self, source, path, progress=None, cached=True, **options):
+        options = {k: v for k, v in options.items() if v is not None}
+        Constants.validate('create', dict(options, srcfolder=source))
+        if os.path.exists(os.path.expanduser(path)):
+            raise Exception('Invalid argument. Disk image already exists: ' + path)
+
+        key = self.key(source, path, **options) if cached else None
+        if key is None or not self.cache.get(key, path):
+            stream_command('hdiutil', 'create', path, srcfolder=source, **options).wait(progress)
+            if key is not None:
+                self.cache.put(key, path)
+
+        image_class = DiskImage.class_for(path, options.get('format'), options.get('type'))
+        return image_class({'path' : path, 'create_new' : 'False', 'lazy' : 'True'})
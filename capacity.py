@@ -0,0 +1,123 @@
+#
+# Free-space accounting for the filesystems holding disk images
+#
+## Usage: HDIUtil.capacity.available('~/images/build.dmg')
+##        with HDIUtil.capacity.reserve('~/images/build.dmg', 10 * 1000 ** 3):
+##            ...create the image...
+## Free space comes from os.statvfs and is cached per filesystem for a short TTL. Reservations
+## are subtracted from it, so concurrent creates cannot all pass the same space check
+#
+
+import os, threading
+from utils import Helpers, clock
+
+
+## Space held on one filesystem until released
+class Reservation(object):
+    def __init__(self, monitor, device, size):
+        self.monitor = monitor
+        self.device = device
+        self.size = size
+        self.released = False
+
+    def __repr__(self):
+        return 'Reservation({} bytes{})'.format(self.size, ', released' if self.released else '')
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.release()
+
+    def release(self):
+        self.monitor.release(self)
+
+
+class CapacityMonitor(object):
+
+    # Seconds a statvfs result is reused
+    DEFAULT_TTL = 1.0
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        # Keyed by st_dev, one entry per mounted filesystem
+        self._free = {}
+        self._reserved = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        with self._lock:
+            return 'CapacityMonitor(ttl={}, reserved={})'.format(self.ttl, sum(self._reserved.values()))
+
+    # Nearest existing ancestor of path, images that are about to be created do not exist yet
+    @staticmethod
+    def existing_path(path):
+        path = os.path.abspath(os.path.expanduser(path))
+        while not os.path.exists(path):
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        return path
+
+    # Mount point of the filesystem that holds or will hold path
+    @staticmethod
+    def mount_point(path):
+        path = os.path.realpath(CapacityMonitor.existing_path(path))
+        while not os.path.ismount(path):
+            path = os.path.dirname(path)
+        return path
+
+    # Free bytes on path's filesystem available to unprivileged users, ignoring reservations
+    def free(self, path):
+        existing = self.existing_path(path)
+        device = os.stat(existing).st_dev
+        with self._lock:
+            return self._free_bytes(device, existing)
+
+    # Free bytes on path's filesystem less the space reserved on it
+    def available(self, path):
+        existing = self.existing_path(path)
+        device = os.stat(existing).st_dev
+        with self._lock:
+            return self._free_bytes(device, existing) - self._reserved.get(device, 0)
+
+    # Reserves size bytes on path's filesystem, raising if they are not available
+    # Returns a Reservation, usable as a context manager
+    def reserve(self, path, size):
+        existing = self.existing_path(path)
+        device = os.stat(existing).st_dev
+        with self._lock:
+            if size > 0:
+                available = self._free_bytes(device, existing) - self._reserved.get(device, 0)
+                if size > available:
+                    raise Exception('Not enough space on {}: {} needed, {} available.'.format(
+                        self.mount_point(path), Helpers.hr_bytes(size), Helpers.hr_bytes(max(available, 0))))
+                self._reserved[device] = self._reserved.get(device, 0) + size
+        return Reservation(self, device, size)
+
+    # Returns reserved space to the pool; the space is usually consumed by then, so the cached
+    # free-space figure for the filesystem is dropped too
+    def release(self, reservation):
+        with self._lock:
+            if reservation.released:
+                return
+            reservation.released = True
+            if reservation.size > 0:
+                self._reserved[reservation.device] -= reservation.size
+            self._free.pop(reservation.device, None)
+
+    # Drops cached free-space figures, for one path's filesystem or for all of them
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._free.clear()
+            else:
+                self._free.pop(os.stat(self.existing_path(path)).st_dev, None)
+
+    # Called with the lock held
+    def _free_bytes(self, device, existing):
+        cached = self._free.get(device)
+        if cached is not None and clock() - cached[0] < self.ttl:
+            return cached[1]
+        free = Helpers.bytes_available(existing)
+        self._free[device] = (clock(), free)
+        return free
@@ -0,0 +1,227 @@
+#
+# Native checksums of image files, hashed in parallel chunks and cached across runs
+#
+## Usage: checksummer = Checksummer(cache=ChecksumCache())
+##        checksummer.checksum('~/images/build.dmg')
+##        checksummer.scan('~/images')   # {path: digest} for every image below the directory
+## Files are mapped with mmap and cut into chunk_size pieces hashed on a thread pool; hashlib
+## releases the GIL while hashing, so chunks are hashed on every core. A file's digest is the
+## hash of its chunk digests in order, and a sparse bundle's the hash of the names and digests
+## of its Info.plist and bands, so digests only compare with digests made with the same
+## algorithm and chunk size, not with the output of shasum
+#
+
+import binascii, hashlib, json, os, threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from HDIUtil_Constants import Constants
+from sparsebundle import INFO_PLIST, SparseBundleImage
+from utils import Helpers
+
+DEFAULT_ALGORITHM = 'sha256'
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+## Digests from earlier runs, keyed by path and invalidated when the file's size, mtime or inode change
+#
+## Stored as JSON at path; save() writes it atomically
+class ChecksumCache(object):
+
+    DEFAULT_PATH = '~/.pyhdiutil/checksums.json'
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = os.path.expanduser(path)
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'ChecksumCache({!r}, {} entries)'.format(self.path, len(self.entries))
+
+    @property
+    def entries(self):
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._read()
+            return self._entries
+
+    # Cached digest of path, None unless key, algorithm and chunk size all match
+    def get(self, path, key, algorithm, chunk_size):
+        entry = self.entries.get(path)
+        if entry is not None and entry['key'] == list(key) and entry['algorithm'] == algorithm and entry['chunk_size'] == chunk_size:
+            return entry['digest']
+
+    def put(self, path, key, algorithm, chunk_size, digest):
+        entries = self.entries
+        with self._lock:
+            entries[path] = {'key' : list(key), 'algorithm' : algorithm, 'chunk_size' : chunk_size, 'digest' : digest}
+            self._dirty = True
+
+    # Drops every entry, or the entry of one path
+    def invalidate(self, path=None):
+        entries = self.entries
+        with self._lock:
+            if path is None:
+                entries.clear()
+            else:
+                entries.pop(os.path.realpath(os.path.expanduser(path)), None)
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            Helpers.write_json(self.path, self._entries)
+            self._dirty = False
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            # Missing or unreadable caches start empty
+            return {}
+
+
+class Checksummer(object):
+
+    ## algorithm: any hashlib algorithm
+    ## chunk_size: bytes hashed by one task
+    ## workers: threads hashing chunks, defaults to the number of cores
+    ## cache: a ChecksumCache, None to hash every file on every call
+    def __init__(self, algorithm=DEFAULT_ALGORITHM, chunk_size=DEFAULT_CHUNK_SIZE, workers=None, cache=None):
+        hashlib.new(algorithm)
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.cache = cache
+
+    def __repr__(self):
+        return 'Checksummer({}, chunk_size={}, workers={}, cache={!r})'.format(self.algorithm, self.chunk_size, self.workers, self.cache)
+
+    # Hex digest of a .dmg, sparse image or sparse bundle
+    def checksum(self, path):
+        return self.checksums([path])[os.path.realpath(os.path.expanduser(path))]
+
+    # True if path's digest is expected
+    def verify(self, path, expected):
+        return self.checksum(path) == expected.lower()
+
+    # Digests of every disk image found below directory, keyed by real path
+    def scan(self, directory, recursive=True):
+        return self.checksums(self.find_images(directory, recursive))
+
+    ## Digests of many images, keyed by real path
+    #
+    ## The chunks of every image not found in the cache are hashed on one pool
+    def checksums(self, paths):
+        paths = sorted(set(os.path.realpath(os.path.expanduser(path)) for path in paths))
+        digests = {}
+        pending = []
+        for path in paths:
+            key = self.cache_key(path)
+            digest = self.cache.get(path, key, self.algorithm, self.chunk_size) if self.cache is not None else None
+            if digest is None:
+                pending.append((path, key))
+            else:
+                digests[path] = digest
+
+        if pending:
+            files = {path: self.image_files(path) for path, key in pending}
+            hashed = self._hash_files([f for path, key in pending for name, f in files[path]])
+            for path, key in pending:
+                members = files[path]
+                if os.path.isdir(path):
+                    combined = hashlib.new(self.algorithm)
+                    for name, f in members:
+                        combined.update(name.encode('utf-8') + b'\0' + hashed[f])
+                    digests[path] = combined.hexdigest()
+                else:
+                    digests[path] = binascii.hexlify(hashed[members[0][1]]).decode('ascii')
+                if self.cache is not None:
+                    self.cache.put(path, key, self.algorithm, self.chunk_size, digests[path])
+            if self.cache is not None:
+                self.cache.save()
+        return digests
+
+    # Image paths below directory, sparse bundles are not descended into
+    @staticmethod
+    def find_images(directory, recursive=True):
+        found = []
+        for root, dirs, names in os.walk(os.path.expanduser(directory)):
+            for name in sorted(dirs):
+                if Constants.image_type(name):
+                    found.append(os.path.join(root, name))
+            for name in sorted(names):
+                if Constants.image_type(name):
+                    found.append(os.path.join(root, name))
+            # Bundles are images, not directories to search
+            dirs[:] = sorted(name for name in dirs if not Constants.image_type(name)) if recursive else []
+        return found
+
+    # (name, file path) of the files whose contents make up an image, in a stable order
+    @staticmethod
+    def image_files(path):
+        if not os.path.isdir(path):
+            return [(os.path.basename(path), path)]
+        bundle = SparseBundleImage(path)
+        files = [(INFO_PLIST, os.path.join(path, INFO_PLIST))]
+        return files + [(os.path.relpath(bundle.band_path(index), path), bundle.band_path(index)) for index in bundle.bands()]
+
+    # (size, mtime, inode) identifying a version of an image; for a sparse bundle the size is
+    # the bands' total and the mtime the latest among the bundle and its files
+    @staticmethod
+    def cache_key(path):
+        st = os.stat(path)
+        if not os.path.isdir(path):
+            return (st.st_size, Helpers.mtime_ns(st), st.st_ino)
+        size = 0
+        mtime = Helpers.mtime_ns(st)
+        for root, dirs, names in os.walk(path):
+            mtime = max(mtime, Helpers.mtime_ns(os.stat(root)))
+            for name in names:
+                member = os.stat(os.path.join(root, name))
+                size += member.st_size
+                mtime = max(mtime, Helpers.mtime_ns(member))
+        return (size, mtime, st.st_ino)
+
+    # Checksummer Helpers
+    #
+    # Returns {file: raw digest} for files, hashing every chunk of every file on one thread pool
+    # Each task maps its file only while hashing its chunk, so open descriptors stay bounded by the workers
+    def _hash_files(self, files):
+        tasks = []
+        for f in files:
+            # Empty files still get one task so they have a digest
+            tasks.extend((f, offset) for offset in range(0, max(os.path.getsize(f), 1), self.chunk_size))
+
+        def hash_chunk(task):
+            f, offset = task
+            mapped = Helpers.map_file(f)
+            if mapped is None:
+                return hashlib.new(self.algorithm).digest()
+            try:
+                view = Helpers.memory_view(mapped, offset, offset + self.chunk_size)
+                try:
+                    return hashlib.new(self.algorithm, view).digest()
+                finally:
+                    # Lets the map be closed; Python 2 hashes copies, which need no release
+                    if hasattr(view, 'release'):
+                        view.release()
+            finally:
+                mapped.close()
+
+        pool = ThreadPool(max(1, min(self.workers or cpu_count(), len(tasks))))
+        try:
+            chunk_digests = pool.map(hash_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        hashed = {}
+        for (f, offset), digest in zip(tasks, chunk_digests):
+            hashed.setdefault(f, hashlib.new(self.algorithm)).update(digest)
+        return {f: h.digest() for f, h in hashed.items()}
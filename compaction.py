@@ -0,0 +1,337 @@
+#
+# Background compaction of sparse images and sparse bundles, most reclaimable space first
+#
+## Usage: scheduler = CompactionScheduler(max_concurrent=2, io_budget=50 * 1000 ** 2, history='~/.pyhdiutil/compactions.jsonl')
+##        scheduler.run(['/Volumes/Shared/images'])        # one pass, returns a CompactionRun
+##        scheduler.start(['/Volumes/Shared/images'], interval=3600); ...; scheduler.stop()
+## Reclaimable space is estimated without attaching anything: the bytes an image allocates on the
+## host (its bands) less the bytes in use on the HFS+ volume inside it, read from the volume
+## header. Attached images are skipped, compaction needs exclusive access
+#
+
+import json, os, struct, threading, time, uuid
+from multiprocessing.pool import ThreadPool
+from HDIUtil_Constants import Constants
+from PyHDIUtil import HDIUtil
+from checksum import Checksummer
+from sparsebundle import SparseBundleImage
+from utils import Helpers, clock
+
+SECTOR_SIZE = 512
+
+# GUID partition table header at LBA 1, and the partition type of Apple_HFS as stored on disk
+GPT_SIGNATURE = b'EFI PART'
+GPT_HFS_TYPE = uuid.UUID('48465300-0000-11aa-aa11-00306543ecac').bytes_le
+
+# HFS+ and HFSX volume headers sit 1024 bytes into the volume
+HFS_SIGNATURES = (b'H+', b'HX')
+HFS_HEADER_OFFSET = 1024
+
+# .sparseimage files start with a 4096-byte header whose band table maps file positions to bands
+SPARSE_SIGNATURE = b'sprs'
+SPARSE_HEADER_SIZE = 4096
+SPARSE_BAND_TABLE = 64
+
+
+## Bytes in use on the HFS+ volume of a virtual disk, None if no HFS+ volume is found
+#
+## read(offset, length) reads the virtual disk. The volume is looked for in the GUID partition
+## table, then at the start of the disk for images created without a partition map
+def volume_used_bytes(read):
+    offsets = [0]
+    header = read(SECTOR_SIZE, 92)
+    if header[:8] == GPT_SIGNATURE:
+        entries_lba, count, entry_size = struct.unpack_from('<QII', header, 72)
+        table = read(entries_lba * SECTOR_SIZE, min(count, 128) * entry_size)
+        for i in range(len(table) // entry_size):
+            entry = table[i * entry_size:(i + 1) * entry_size]
+            if entry[:16] == GPT_HFS_TYPE:
+                offsets.insert(0, struct.unpack_from('<Q', entry, 32)[0] * SECTOR_SIZE)
+    for offset in offsets:
+        volume = read(offset + HFS_HEADER_OFFSET, 52)
+        if len(volume) == 52 and volume[:2] in HFS_SIGNATURES:
+            block_size, total_blocks, free_blocks = struct.unpack_from('>III', volume, 40)
+            return (total_blocks - free_blocks) * block_size
+
+
+# Reader over the virtual disk of a .sparseimage
+# Only bands listed in the first header are found, which covers the partition map and volume
+# header of any image; reads elsewhere return zeros
+def sparse_image_reader(path):
+    with open(path, 'rb') as f:
+        header = f.read(SPARSE_HEADER_SIZE)
+    if len(header) < SPARSE_HEADER_SIZE or header[:4] != SPARSE_SIGNATURE:
+        raise Exception('Not a sparse image: ' + path)
+    band_size = struct.unpack_from('>I', header, 8)[0] * SECTOR_SIZE
+    table = struct.unpack_from('>{}I'.format((SPARSE_HEADER_SIZE - SPARSE_BAND_TABLE) // 4), header, SPARSE_BAND_TABLE)
+    # Entries hold band numbers counted from 1, 0 marks an unused slot
+    positions = {band - 1: index for index, band in enumerate(table) if band}
+
+    def read(offset, length):
+        chunks = []
+        with open(path, 'rb') as f:
+            while length > 0:
+                band, within = divmod(offset, band_size)
+                step = min(length, band_size - within)
+                if band in positions:
+                    f.seek(SPARSE_HEADER_SIZE + positions[band] * band_size + within)
+                    chunks.append(f.read(step).ljust(step, b'\0'))
+                else:
+                    chunks.append(b'\0' * step)
+                offset += step
+                length -= step
+        return b''.join(chunks)
+    return read
+
+
+## What compacting one image would gain, and why it is skipped if it is
+class CompactionCandidate(object):
+
+    def __init__(self, path, type, allocated, used, attached):
+        self.path = path
+        self.type = type
+        # Bytes the image takes on the host
+        self.allocated = allocated
+        # Bytes in use on its volume, None if the volume could not be read
+        self.used = used
+        self.attached = attached
+        self.skip = None
+
+    def __repr__(self):
+        return 'CompactionCandidate({!r}, allocated={}, reclaimable={}{})'.format(
+            self.path, Helpers.hr_bytes(self.allocated),
+            Helpers.hr_bytes(self.reclaimable) if self.reclaimable is not None else 'unknown',
+            ', skipped: ' + self.skip if self.skip else '')
+
+    # Estimate of the bytes compacting would return to the host, None if unknown
+    @property
+    def reclaimable(self):
+        if self.used is not None:
+            return max(0, self.allocated - self.used)
+
+
+## Inspects an image natively and returns its CompactionCandidate
+def inspect(path):
+    path = os.path.realpath(os.path.expanduser(path))
+    image_type = Constants.image_type(path)
+    if image_type == 'SPARSEBUNDLE':
+        bundle = SparseBundleImage(path)
+        stream = bundle.open()
+        def read(offset, length):
+            stream.seek(offset)
+            return stream.read(length)
+        allocated = bundle.allocated
+    elif image_type == 'SPARSE':
+        read = sparse_image_reader(path)
+        allocated = allocated_bytes(path)
+    else:
+        raise Exception('Only sparse images and sparse bundles can be compacted: ' + path)
+    attached = HDIUtil.info_cache.registry().by_path(path) is not None
+    return CompactionCandidate(path, image_type, allocated, volume_used_bytes(read), attached)
+
+
+# Bytes an image takes on the host
+def allocated_bytes(path):
+    if os.path.isdir(path):
+        return SparseBundleImage(path).allocated
+    st = os.stat(path)
+    return st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+
+
+## Paces I/O to rate bytes per second across every thread spending from it
+#
+## spend() returns once the bytes spent before it have had their time
+class IOBudget(object):
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = clock()
+        self._lock = threading.Lock()
+
+    # Waits for the budget to allow nbytes more I/O, returns False if the threading.Event
+    # cancelled is set while waiting
+    def spend(self, nbytes, cancelled=None):
+        with self._lock:
+            now = clock()
+            start = max(now, self._next)
+            self._next = start + float(nbytes) / self.rate
+        remaining = start - clock()
+        if cancelled is None:
+            if remaining > 0:
+                time.sleep(remaining)
+            return True
+        # Returns False as soon as cancelled is set
+        return not (cancelled.wait(remaining) if remaining > 0 else cancelled.is_set())
+
+
+## Outcome of one scheduler pass
+class CompactionRun(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.elapsed = None
+        self.jobs = []
+        self.skipped = []
+
+    def __repr__(self):
+        return 'CompactionRun({} compacted, {} reclaimed, {} skipped)'.format(
+            len([job for job in self.jobs if job['error'] is None]), Helpers.hr_bytes(self.reclaimed), len(self.skipped))
+
+    # Bytes returned to the host by every compaction of the run
+    @property
+    def reclaimed(self):
+        return sum(job['reclaimed'] for job in self.jobs if job['reclaimed'])
+
+    def record(self):
+        return {'started' : self.started, 'elapsed' : self.elapsed, 'reclaimed' : self.reclaimed,
+                'jobs' : self.jobs, 'skipped' : self.skipped}
+
+
+class CompactionScheduler(object):
+
+    # Images expected to free less than this many bytes are left alone
+    DEFAULT_MIN_RECLAIMABLE = 100 * 1000 * 1000
+
+    ## max_concurrent: compactions run at once
+    ## io_budget: bytes per second the compactions may read and write together, None for no limit;
+    ##     each compaction is charged the bytes its image allocates before it starts
+    ## min_reclaimable: smallest estimated gain worth a compaction
+    ## include_unknown: also compact images whose volume could not be read, largest first
+    ## history: JSON-lines file every run's record is appended to, None to keep runs in memory only
+    def __init__(self, max_concurrent=1, io_budget=None, min_reclaimable=DEFAULT_MIN_RECLAIMABLE,
+                 include_unknown=False, history=None):
+        self.max_concurrent = max_concurrent
+        self.budget = IOBudget(io_budget) if io_budget else None
+        self.min_reclaimable = min_reclaimable
+        self.include_unknown = include_unknown
+        self.history_path = os.path.expanduser(history) if history else None
+        self.runs = []
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'CompactionScheduler(max_concurrent={}, io_budget={}, runs={})'.format(
+            self.max_concurrent, self.budget.rate if self.budget else None, len(self.runs))
+
+    ## Candidates for the images among paths, best first; directories are searched for images
+    #
+    ## Every candidate is returned, those that would not be compacted with their skip reason set
+    def rank(self, paths):
+        candidates = []
+        for path in self.images(paths):
+            try:
+                candidate = inspect(path)
+            except Exception as e:
+                candidate = CompactionCandidate(os.path.realpath(path), Constants.image_type(path), 0, None, False)
+                candidate.skip = 'unreadable: {}'.format(e)
+                candidates.append(candidate)
+                continue
+            if candidate.attached:
+                candidate.skip = 'attached'
+            elif candidate.reclaimable is None and not self.include_unknown:
+                candidate.skip = 'volume not readable'
+            elif candidate.reclaimable is not None and candidate.reclaimable < self.min_reclaimable:
+                candidate.skip = 'below min_reclaimable'
+            candidates.append(candidate)
+        # Eligible first, known gains by size, then unknown gains by allocation
+        return sorted(candidates, key=lambda c: (c.skip is not None, c.reclaimable is None, -(c.reclaimable or c.allocated)))
+
+    ## Compacts the best candidates among paths, at most limit of them, and returns the run's record
+    def run(self, paths, limit=None, progress=None):
+        run = CompactionRun()
+        candidates = self.rank(paths)
+        selected = [candidate for candidate in candidates if candidate.skip is None][:limit]
+        run.skipped = [{'path' : candidate.path, 'reason' : candidate.skip} for candidate in candidates if candidate.skip]
+
+        if selected:
+            pool = ThreadPool(max(1, min(self.max_concurrent, len(selected))))
+            try:
+                run.jobs = pool.map(lambda candidate: self._compact(candidate, progress), selected)
+            finally:
+                pool.close()
+                pool.join()
+        run.elapsed = time.time() - run.started
+
+        with self._lock:
+            self.runs.append(run)
+            if self.history_path:
+                directory = os.path.dirname(self.history_path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with open(self.history_path, 'a') as f:
+                    f.write(json.dumps(run.record(), sort_keys=True) + '\n')
+        return run
+
+    # Records of earlier runs, read back from the history file
+    def history(self):
+        if not self.history_path or not os.path.exists(self.history_path):
+            return [run.record() for run in self.runs]
+        with open(self.history_path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    ## Runs a pass over paths every interval seconds on a background thread, until stop()
+    def start(self, paths, interval=3600, limit=None):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                raise Exception('The compaction scheduler is already running.')
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._loop, args=(list(paths), interval, limit), name='hdiutil-compaction')
+            self._thread.daemon = True
+            self._thread.start()
+
+    # Stops the background thread, cancelling compactions in progress
+    def stop(self, wait=True):
+        self._stopping.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    # Image paths among paths, directories are searched for images
+    @staticmethod
+    def images(paths):
+        found = []
+        for path in paths:
+            if os.path.isdir(os.path.expanduser(path)) and not Constants.image_type(path):
+                found.extend(Checksummer.find_images(path))
+            else:
+                found.append(path)
+        return [path for path in found if Constants.image_type(path) in ('SPARSE', 'SPARSEBUNDLE')]
+
+    # Scheduler Helpers
+    #
+    def _loop(self, paths, interval, limit):
+        while not self._stopping.is_set():
+            start = clock()
+            try:
+                self.run(paths, limit)
+            except Exception:
+                # A failing pass must not end the schedule, its jobs carry their errors
+                pass
+            self._stopping.wait(max(0, interval - (clock() - start)))
+
+    def _compact(self, candidate, progress=None):
+        job = {'path' : candidate.path, 'estimated' : candidate.reclaimable, 'before' : candidate.allocated,
+               'after' : None, 'reclaimed' : None, 'elapsed' : None, 'error' : None}
+
+        def report(event):
+            if self._stopping.is_set():
+                raise Exception('Compaction cancelled.')
+            if progress is not None:
+                progress(candidate, event)
+
+        start = clock()
+        try:
+            if self.budget is not None and not self.budget.spend(candidate.allocated, self._stopping):
+                raise Exception('Compaction cancelled.')
+            # The image may have been attached while waiting for its turn
+            if HDIUtil.info_cache.registry().by_path(candidate.path) is not None:
+                raise Exception('Skipped, the image was attached.')
+            before = allocated_bytes(candidate.path)
+            HDIUtil().load(candidate.path, lazy=True).compact(progress=report)
+            job['before'] = before
+            job['after'] = allocated_bytes(candidate.path)
+            job['reclaimed'] = before - job['after']
+        except Exception as e:
+            job['error'] = str(e)
+        job['elapsed'] = clock() - start
+        return job
@@ -0,0 +1,297 @@
+#
+# Prioritized queue converting many disk images on a pool of worker threads
+#
+## Usage: with ConversionQueue(workers=4, journal='~/.hdiutil-conversions.jsonl') as queue:
+##            for path in builds:
+##                queue.submit(path, 'ULFO', priority=1 if path.endswith('-release.dmg') else 0)
+##        for job in queue.jobs: print(job)
+## Higher priorities run first, equal priorities in submission order. Every submission, start and
+## outcome is appended to the journal; opening a queue on the same journal resubmits the jobs a
+## crash left unfinished, removing a partial output first
+#
+
+import heapq, json, os, shutil, threading, uuid
+from HDIUtil_Constants import Constants
+from PyHDIUtil import HDIUtil
+from utils import Helpers, clock
+
+
+## One conversion and, once it ran, its throughput
+class ConversionJob(object):
+
+    def __init__(self, source, format, output=None, priority=0, options=None, id=None):
+        self.id = id or uuid.uuid4().hex
+        self.source = source
+        self.format = format
+        self.output = output
+        self.priority = priority
+        self.options = options or {}
+        # pending -> running -> done | failed
+        self.state = 'pending'
+        self.error = None
+        self.percent = None
+        # Bytes read and written, seconds spent converting
+        self.bytes_in = None
+        self.bytes_out = None
+        self.elapsed = None
+
+    def __repr__(self):
+        if self.state == 'done':
+            return 'ConversionJob({!r} -> {}, {:.1f} MB/s, ratio {:.2f})'.format(self.source, self.format, self.throughput, self.ratio)
+        return 'ConversionJob({!r} -> {}, {})'.format(self.source, self.format, self.state)
+
+    # Source megabytes (10^6) converted per second
+    @property
+    def throughput(self):
+        if self.state == 'done' and self.elapsed:
+            return self.bytes_in / 1000000.0 / self.elapsed
+
+    # Source size over output size, above 1 when the output is smaller
+    @property
+    def ratio(self):
+        if self.state == 'done' and self.bytes_out:
+            return float(self.bytes_in) / self.bytes_out
+
+    # Fields the journal records to resubmit the job
+    def spec(self):
+        return {'id' : self.id, 'source' : self.source, 'format' : self.format, 'output' : self.output,
+                'priority' : self.priority, 'options' : self.options}
+
+    # Throughput figures, for logs and reports
+    def report(self):
+        return {'id' : self.id, 'source' : self.source, 'output' : self.output, 'format' : self.format,
+                'state' : self.state, 'error' : self.error, 'bytes_in' : self.bytes_in, 'bytes_out' : self.bytes_out,
+                'elapsed' : self.elapsed, 'throughput' : self.throughput, 'ratio' : self.ratio}
+
+
+# Bytes used by an image file, or by the files of an image directory such as a sparse bundle
+def image_bytes(path):
+    path = os.path.expanduser(path)
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(path) for name in names)
+
+
+## Append-only record of a queue's jobs, one JSON object per line
+#
+## Records are {'event': 'submit', 'job': spec}, {'event': 'start', 'id': ..., 'existed': bool}
+## and {'event': 'done' | 'failed', 'id': ..., ...}. Opening a journal compacts it to the jobs
+## still unfinished
+class ConversionJournal(object):
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self.unfinished = self._replay()
+        # Compacted under a temporary name, so a crash while rewriting keeps the old journal;
+        # the open file follows the rename and later records are appended to it
+        temporary = Helpers.temporary_path(self.path)
+        self._file = open(temporary, 'w')
+        for spec, started, existed in self.unfinished:
+            self._write({'event' : 'submit', 'job' : spec})
+            if started:
+                self._write({'event' : 'start', 'id' : spec['id'], 'existed' : existed})
+        os.rename(temporary, self.path)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def submitted(self, job): self.record({'event' : 'submit', 'job' : job.spec()})
+
+    # existed tells a resumed queue whether an output left behind is partial or was there before
+    def started(self, job, existed): self.record({'event' : 'start', 'id' : job.id, 'existed' : existed})
+
+    def finished(self, job):
+        self.record({'event' : job.state, 'id' : job.id, 'error' : job.error, 'elapsed' : job.elapsed,
+                     'bytes_in' : job.bytes_in, 'bytes_out' : job.bytes_out})
+
+    def record(self, entry):
+        with self._lock:
+            self._write(entry)
+
+    # Every line is flushed to disk so it survives the crash it is there for
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    # Returns (spec, started, existed) for the jobs submitted but neither done nor failed, in order
+    def _replay(self):
+        jobs = {}
+        order = []
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by the crash
+                    continue
+                if entry['event'] == 'submit':
+                    jobs[entry['job']['id']] = [entry['job'], False, False]
+                    order.append(entry['job']['id'])
+                elif entry['event'] == 'start' and entry['id'] in jobs:
+                    jobs[entry['id']][1:] = [True, entry['existed']]
+                elif entry['id'] in jobs:
+                    del jobs[entry['id']]
+        return [tuple(jobs[id]) for id in order if id in jobs]
+
+
+class ConversionQueue(object):
+
+    # Concurrent conversions, each runs its own hdiutil process
+    DEFAULT_WORKERS = 4
+
+    ## workers: size of the thread pool
+    ## journal: path of the on-disk job journal, None to keep no journal
+    ## on_progress(job, event) and on_complete(job) are called from the worker threads
+    def __init__(self, workers=DEFAULT_WORKERS, journal=None, on_progress=None, on_complete=None):
+        self.workers = workers
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.jobs = []
+        self._heap = []
+        self._sequence = 0
+        self._running = 0
+        self._closed = False
+        self._threads = []
+        self._cond = threading.Condition()
+
+        self.journal = ConversionJournal(journal) if journal else None
+        if self.journal:
+            for spec, started, existed in self.journal.unfinished:
+                if started and not existed:
+                    self._remove_partial(spec['output'])
+                self._push(ConversionJob(**spec))
+
+    def __repr__(self):
+        with self._cond:
+            states = [job.state for job in self.jobs]
+        return 'ConversionQueue(workers={}, {})'.format(
+            self.workers, ', '.join('{} {}'.format(states.count(state), state) for state in ('pending', 'running', 'done', 'failed')))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Pending jobs stay in the journal when the block fails
+        self.close(wait=exc_type is None)
+
+    # Queues a conversion and returns its job; options are passed to DiskImage.convert()
+    def submit(self, source, format, output=None, priority=0, **options):
+        # Fail on bad formats and options now rather than in a worker
+        Constants.validate('convert', dict(((k, v) for k, v in options.items() if k != 'overwrite'), format=format))
+        if output is None:
+            output = HDIUtil().create(path=source, create_new=False, lazy=True).converted_path(format)
+        if os.path.realpath(os.path.expanduser(output)) == os.path.realpath(os.path.expanduser(source)):
+            raise Exception('Invalid argument. Cannot convert an image onto itself: ' + output)
+        job = ConversionJob(source, format, output, priority, options)
+        if self.journal:
+            self.journal.submitted(job)
+        self._push(job)
+        return job
+
+    # Starts the worker threads, jobs submitted later run as soon as a worker is free
+    def start(self):
+        with self._cond:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='hdiutil-convert-{}'.format(len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    # Blocks until every submitted job has finished
+    def join(self):
+        with self._cond:
+            while self._heap or self._running:
+                self._cond.wait()
+
+    # Stops the workers, after the queue drains when wait is set, otherwise once running jobs finish
+    # Jobs left pending stay in the journal
+    def close(self, wait=True):
+        if wait:
+            self.join()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        if self.journal:
+            self.journal.close()
+
+    # Throughput figures of every job, and totals over the finished ones
+    def report(self):
+        done = [job for job in self.jobs if job.state == 'done']
+        elapsed = sum(job.elapsed for job in done)
+        bytes_in = sum(job.bytes_in for job in done)
+        bytes_out = sum(job.bytes_out for job in done)
+        return {'jobs' : [job.report() for job in self.jobs],
+                'done' : len(done),
+                'failed' : len([job for job in self.jobs if job.state == 'failed']),
+                'bytes_in' : bytes_in,
+                'bytes_out' : bytes_out,
+                'throughput' : bytes_in / 1000000.0 / elapsed if elapsed else None,
+                'ratio' : float(bytes_in) / bytes_out if bytes_out else None}
+
+    # Queue Helpers
+    #
+    def _push(self, job):
+        with self._cond:
+            self.jobs.append(job)
+            # Highest priority first, then submission order
+            heapq.heappush(self._heap, (-job.priority, self._sequence, job))
+            self._sequence += 1
+            self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._heap and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                job = heapq.heappop(self._heap)[2]
+                job.state = 'running'
+                self._running += 1
+            try:
+                self._run(job)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify_all()
+            if self.on_complete is not None:
+                self.on_complete(job)
+
+    def _run(self, job):
+        def progress(event):
+            job.percent = event.percent
+            if self.on_progress is not None:
+                self.on_progress(job, event)
+
+        if self.journal:
+            self.journal.started(job, os.path.exists(os.path.expanduser(job.output)))
+        start = clock()
+        try:
+            image = HDIUtil().load(job.source, lazy=True)
+            image.convert(job.format, job.output, progress=progress, **job.options)
+            job.bytes_in = image_bytes(job.source)
+            job.bytes_out = image_bytes(job.output)
+            job.state = 'done'
+        except Exception as e:
+            job.error = str(e)
+            job.state = 'failed'
+        job.elapsed = clock() - start
+        if self.journal:
+            self.journal.finished(job)
+
+    # Removes what a conversion interrupted by a crash left at its output
+    @staticmethod
+    def _remove_partial(output):
+        output = os.path.expanduser(output)
+        if os.path.isdir(output):
+            shutil.rmtree(output)
+        elif os.path.exists(output):
+            os.remove(output)
@@ -0,0 +1,159 @@
+#
+# Process-wide cache of `hdiutil info -plist` snapshots shared by every DiskImage
+#
+
+import os, threading
+from HDIUtil_Constants import Constants
+from utils import CommandEngine, Helpers, clock
+
+class InfoCache(object):
+
+    # Seconds a snapshot stays valid before `hdiutil info` is run again
+    DEFAULT_TTL = 2.0
+
+    # hdiutil verbs that change what `hdiutil info` reports
+    INVALIDATING_COMMANDS = ('attach', 'detach', 'resize', 'create')
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._snapshot = None
+        self._registry = None
+        self._timestamp = 0
+        # Held while refreshing so concurrent misses only fork hdiutil once
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return 'InfoCache(ttl={}, hits={}, misses={})'.format(self.ttl, self.hits, self.misses)
+
+    # Returns the parsed output of `hdiutil info -plist`, refreshing it if the TTL expired
+    def snapshot(self):
+        with self._lock:
+            if self._snapshot is not None and clock() - self._timestamp < self.ttl:
+                self.hits += 1
+                return self._snapshot
+
+            self.misses += 1
+            output = CommandEngine.run('hdiutil', 'info', plist=None).stdout
+            self._snapshot = Helpers.read_plist(output)
+            self._registry = None
+            self._timestamp = clock()
+            return self._snapshot
+
+    # Returns an ImageRegistry over the current snapshot, built once per snapshot
+    def registry(self):
+        with self._lock:
+            snapshot = self.snapshot()
+            if self._registry is None:
+                self._registry = ImageRegistry(snapshot)
+            return self._registry
+
+    # Drops the current snapshot; the next lookup runs `hdiutil info` again
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._registry = None
+
+    # Called after an hdiutil verb has run, invalidates if the verb changes attached images
+    def notify(self, command):
+        if command in self.INVALIDATING_COMMANDS:
+            self.invalidate()
+
+    # CommandEngine post-hook: invalidates after hdiutil verbs that change attached images
+    # and after `diskutil rename`, which moves mount points
+    def observe(self, result):
+        if result.utility == 'hdiutil':
+            self.notify(result.subcommand)
+        elif result.utility == 'diskutil' and result.subcommand == 'rename':
+            self.invalidate()
+
+    # Hit/miss counters
+    def stats(self):
+        return {'hits' : self.hits, 'misses' : self.misses, 'ttl' : self.ttl}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+## Indexed view of one `hdiutil info` snapshot
+#
+## Usage: registry = ImageRegistry(info)
+##        registry.by_path('~/images/a.dmg')
+##        registry.select(type='SPARSEBUNDLE', mounted=True)
+#
+## Entries are the image dicts exactly as found in info['images']
+class ImageRegistry(object):
+
+    def __init__(self, info):
+        self.images = list(info.get('images', []))
+        self._by_path = {}
+        self._by_dev_entry = {}
+        self._by_mount_point = {}
+        self._by_volname = {}
+        self._by_type = {}
+
+        for image in self.images:
+            self._by_path[self.canonical_path(image['image-path'])] = image
+            self._by_type.setdefault(Constants.image_type(image['image-path']), []).append(image)
+            for entity in image.get('system-entities', []):
+                self._by_dev_entry[entity['dev-entry']] = image
+                mount_point = entity.get('mount-point')
+                if mount_point:
+                    self._by_mount_point[mount_point] = image
+                    self._by_volname.setdefault(os.path.basename(mount_point), []).append(image)
+
+    def __len__(self): return len(self.images)
+
+    def __iter__(self): return iter(self.images)
+
+    def __contains__(self, path): return self.by_path(path) is not None
+
+    # Key used for the path index, hdiutil reports image paths fully resolved
+    @staticmethod
+    def canonical_path(path):
+        return os.path.realpath(os.path.expanduser(path))
+
+    # Lookups
+    #
+    # Each returns the matching image dict or None
+    def by_path(self, path):
+        return self._by_path.get(self.canonical_path(path))
+
+    # Accepts either '/dev/disk2s1' or 'disk2s1'
+    def by_dev_entry(self, dev_entry):
+        if not dev_entry.startswith('/dev/'):
+            dev_entry = '/dev/' + dev_entry
+        return self._by_dev_entry.get(dev_entry)
+
+    def by_mount_point(self, mount_point):
+        return self._by_mount_point.get(os.path.normpath(mount_point))
+
+    # Volume names are not unique, so all images mounted under that name are returned
+    def by_volname(self, volname):
+        return list(self._by_volname.get(volname, []))
+
+    # Bulk query
+    #
+    # Usage: select(type='SPARSEBUNDLE', mounted=True)
+    # Criteria left as None are not filtered on
+    def select(self, type=None, mounted=None, encrypted=None):
+        images = self.images if type is None else self._by_type.get(type, [])
+        if mounted is not None:
+            images = [image for image in images if bool(self.mount_points(image)) == mounted]
+        if encrypted is not None:
+            images = [image for image in images if bool(image.get('image-encrypted')) == encrypted]
+        return list(images)
+
+    # Entry Helpers
+    #
+    # Mount points of every mounted volume of an image
+    @staticmethod
+    def mount_points(image):
+        return [entity['mount-point'] for entity in image.get('system-entities', []) if entity.get('mount-point')]
+
+    # Image type implied by the image's extension: UDIF, SPARSE or SPARSEBUNDLE
+    @staticmethod
+    def image_type(image):
+        return Constants.image_type(image['image-path'])
@@ -0,0 +1,234 @@
+#
+# Reference-counted attachments shared by every DiskImage in the process
+#
+## Usage: with image.mounted():
+##            ...
+## Nested or concurrent leases on the same image share one attachment. Images this manager
+## attached stay attached for idle_timeout seconds after the last release and are then
+## detached in the background; images that were already attached are reused and left attached
+#
+
+import contextlib, threading
+from info_cache import ImageRegistry
+from utils import clock
+
+
+class _Lease(object):
+    def __init__(self, image):
+        self.image = image
+        self.refs = 0
+        # True when this manager attached the image and so is responsible for detaching it
+        self.owned = False
+        # attaching -> attached -> detaching, or detached when the image was detached outside the manager
+        self.state = 'attaching'
+        self.idle_since = None
+
+
+class LeaseManager(object):
+
+    # Seconds an image stays attached after its last lease is released
+    DEFAULT_IDLE_TIMEOUT = 30.0
+
+    # Images this manager may have attached at once
+    DEFAULT_MAX_ATTACHED = 16
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, max_attached=DEFAULT_MAX_ATTACHED):
+        self.idle_timeout = idle_timeout
+        self.max_attached = max_attached
+        self._leases = {}
+        self._cond = threading.Condition()
+        self._reaper = None
+        self._closed = False
+
+    def __repr__(self):
+        with self._cond:
+            return 'LeaseManager(idle_timeout={}, max_attached={}, leased={}, attached={})'.format(
+                self.idle_timeout, self.max_attached, sum(lease.refs for lease in self._leases.values()), self._owned_count())
+
+    ## Holds the image attached for the duration of a block
+    #
+    ## timeout bounds the wait for a free slot when max_attached images are in use
+    @contextlib.contextmanager
+    def lease(self, image, timeout=None):
+        self.acquire(image, timeout)
+        try:
+            yield image
+        finally:
+            self.release(image)
+
+    def acquire(self, image, timeout=None):
+        key = ImageRegistry.canonical_path(image.path)
+        deadline = None if timeout is None else clock() + timeout
+
+        while True:
+            # Checked on every pass, the image may have been detached while we waited
+            already_mounted = image.is_mounted()
+            with self._cond:
+                lease = self._leases.get(key)
+                if lease is not None and lease.state == 'attached' and not already_mounted:
+                    # Detached by something other than DiskImage.detach, e.g. another process
+                    lease.state = 'detached'
+                if lease is not None and lease.state == 'attached':
+                    lease.refs += 1
+                    lease.idle_since = None
+                    return lease.image
+                if lease is not None and lease.state == 'detached':
+                    if lease.refs:
+                        # Still held by other blocks, attach it again for all of them
+                        lease.refs += 1
+                        lease.owned = True
+                        lease.state = 'attaching'
+                        break
+                    del self._leases[key]
+                    lease = None
+                if lease is None and (already_mounted or self._owned_count() < self.max_attached):
+                    lease = self._leases[key] = _Lease(image)
+                    lease.refs = 1
+                    lease.owned = not already_mounted
+                    break
+                if lease is None and self._evict_idle():
+                    continue
+                # Another thread is attaching or detaching this image, or every slot is leased
+                self._wait(deadline)
+
+        try:
+            if lease.owned:
+                image.attach()
+        except Exception:
+            with self._cond:
+                lease.refs -= 1
+                if lease.refs:
+                    lease.state = 'detached'
+                else:
+                    del self._leases[key]
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            lease.state = 'attached'
+            self._cond.notify_all()
+        return image
+
+    def release(self, image):
+        key = ImageRegistry.canonical_path(image.path)
+        with self._cond:
+            lease = self._leases.get(key)
+            if lease is None or lease.refs == 0:
+                raise Exception('Image is not leased: ' + image.path)
+            lease.refs -= 1
+            if lease.refs == 0:
+                if not lease.owned or lease.state == 'detached':
+                    # Reused mounts are not ours to detach
+                    del self._leases[key]
+                else:
+                    lease.idle_since = clock()
+                    self._start_reaper()
+                self._cond.notify_all()
+
+    # Detaches every idle image this manager attached, without waiting for its idle timeout
+    def flush(self):
+        while True:
+            with self._cond:
+                idle = [(key, lease) for key, lease in self._leases.items() if lease.state == 'attached' and lease.refs == 0]
+                if not idle:
+                    return
+                key, lease = idle[0]
+                lease.state = 'detaching'
+            try:
+                self._detach(key, lease)
+            except Exception:
+                # As in _reap, the lease is dropped and the other idle images are still detached
+                pass
+
+    # Called by DiskImage.detach: the image at path is no longer attached
+    # Idle leases are dropped, held ones are attached again by the next acquire
+    def detached(self, path):
+        key = ImageRegistry.canonical_path(path)
+        with self._cond:
+            lease = self._leases.get(key)
+            # Detaches made by the manager itself are in the detaching state
+            if lease is None or lease.state != 'attached':
+                return
+            if lease.refs:
+                lease.state = 'detached'
+            else:
+                del self._leases[key]
+            self._cond.notify_all()
+
+    # Stops the background reaper and detaches idle images, HDIUtil registers this to run at exit
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.flush()
+
+    # Leases Helpers
+    #
+    # Called with the lock held
+    def _owned_count(self):
+        return len([lease for lease in self._leases.values() if lease.owned])
+
+    def _wait(self, deadline):
+        if deadline is None:
+            self._cond.wait()
+            return
+        remaining = deadline - clock()
+        if remaining <= 0:
+            raise Exception('Timed out waiting for a free attachment slot ({} images attached).'.format(self.max_attached))
+        self._cond.wait(remaining)
+
+    # Detaches the longest idle lease to make room, called with the lock held
+    # Returns False if nothing was idle
+    def _evict_idle(self):
+        idle = [(lease.idle_since, key) for key, lease in self._leases.items()
+                if lease.state == 'attached' and lease.refs == 0]
+        if not idle:
+            return False
+        idle_since, key = min(idle)
+        lease = self._leases[key]
+        lease.state = 'detaching'
+        self._cond.release()
+        try:
+            self._detach(key, lease)
+        finally:
+            self._cond.acquire()
+        return True
+
+    # Detaches a lease already marked as detaching, called without the lock held
+    def _detach(self, key, lease):
+        try:
+            lease.image.detach()
+        finally:
+            with self._cond:
+                self._leases.pop(key, None)
+                self._cond.notify_all()
+
+    def _start_reaper(self):
+        if self._reaper is None or not self._reaper.is_alive():
+            self._reaper = threading.Thread(target=self._reap, name='hdiutil-lease-reaper')
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    # Background loop detaching leases idle for longer than idle_timeout
+    def _reap(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                idle = [(lease.idle_since, key) for key, lease in self._leases.items()
+                        if lease.state == 'attached' and lease.refs == 0]
+                if not idle:
+                    self._cond.wait()
+                    continue
+                idle_since, key = min(idle)
+                remaining = idle_since + self.idle_timeout - clock()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                lease = self._leases[key]
+                lease.state = 'detaching'
+            try:
+                self._detach(key, lease)
+            except Exception:
+                # The image may have been detached behind our back; the lease is dropped either way
+                pass
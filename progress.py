@@ -0,0 +1,164 @@
+#
+# Streaming runner for long hdiutil operations, reporting progress as the command runs
+#
+## Usage: stream = HDIUtil().stream('convert', '~/build.dmg', format='UDZO', o='~/dist/build.dmg')
+##        for event in stream:
+##            if event.kind == 'percent': print(event.percent)
+##        stream.cancel()  # from another thread, kills hdiutil
+## hdiutil is run with -puppetstrings, which prints one progress record per line:
+##    PERCENT:42.500000    fraction done, -1 while the duration is indeterminate
+##    PHASE:Compressing    current step of the operation
+##    MESSAGE:Finishing... status text
+## Other lines are reported as 'output' events
+#
+
+import os, subprocess, threading
+from collections import namedtuple
+from utils import CommandEngine, CommandError, CommandResult, Helpers, clock
+
+## One line of progress
+#
+## kind is one of 'percent', 'phase', 'message' or 'output'. percent and phase carry the latest
+## values seen so far, so every event describes the whole state; percent is None while hdiutil
+## reports an indeterminate duration. message is the text of the line that produced the event
+ProgressEvent = namedtuple('ProgressEvent', ['kind', 'percent', 'phase', 'message'])
+
+# Record prefixes printed by -puppetstrings and the event kind each produces
+RECORD_KINDS = {'PERCENT' : 'percent',
+                'PHASE' : 'phase',
+                'MESSAGE' : 'message'}
+
+
+## Turns -puppetstrings output into ProgressEvents, one line at a time
+class ProgressParser(object):
+    def __init__(self):
+        self.percent = None
+        self.phase = None
+
+    # Returns the event for one line of output, None for blank lines
+    def feed(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        line = line.strip()
+        if not line:
+            return None
+
+        prefix, _, value = line.partition(':')
+        kind = RECORD_KINDS.get(prefix)
+        if kind is None:
+            return ProgressEvent('output', self.percent, self.phase, line)
+        value = value.strip()
+
+        if kind == 'percent':
+            if not Helpers.is_float(value):
+                return ProgressEvent('output', self.percent, self.phase, line)
+            percent = float(value)
+            self.percent = None if percent < 0 else min(percent, 100.0)
+        elif kind == 'phase':
+            self.phase = value
+        return ProgressEvent(kind, self.percent, self.phase, value)
+
+    # Events for every line of a recorded output
+    def parse(self, output):
+        events = [self.feed(line) for line in output.splitlines()]
+        return [event for event in events if event is not None]
+
+
+## Iterable over the progress of one running command
+#
+## The command starts on the first iteration. Once iteration ends, result holds the CommandResult,
+## whose stdout is the 'output' lines only; CommandError is raised if the command failed. After
+## cancel(), or if iteration is abandoned, the child is killed and iteration ends without raising
+class ProgressStream(object):
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.result = None
+        self.cancelled = False
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        state = 'cancelled' if self.cancelled else ('finished' if self.result else 'running' if self._proc else 'pending')
+        return 'ProgressStream({!r}, {})'.format(self.argv, state)
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.cancel()
+
+    def __iter__(self):
+        with self._lock:
+            if self._proc is not None:
+                raise Exception('A progress stream can only be iterated once.')
+            if self.cancelled:
+                return
+            CommandEngine.before(self.argv)
+            start = clock()
+            try:
+                self._proc = subprocess.Popen(self.argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except OSError:
+                raise Exception('OSError, Command not found: ' + self.argv[0])
+        proc = self._proc
+        # Nothing is written to the command, closing stdin makes any prompt read end of file
+        proc.stdin.close()
+
+        # stderr is drained on the side so a chatty command cannot block on a full pipe
+        errors = []
+        drain = threading.Thread(target=lambda: errors.append(proc.stderr.read()))
+        drain.daemon = True
+        drain.start()
+
+        parser = ProgressParser()
+        output = []
+        exhausted = False
+        try:
+            # readline rather than iterating the file, which reads ahead on Python 2
+            for line in iter(proc.stdout.readline, b''):
+                event = parser.feed(line)
+                if event is None:
+                    continue
+                if event.kind == 'output':
+                    output.append(event.message)
+                yield event
+            exhausted = True
+        finally:
+            # The consumer stopped iterating early, the command is no longer wanted
+            if not exhausted:
+                self.cancel()
+            proc.wait()
+            drain.join()
+            proc.stdout.close()
+            proc.stderr.close()
+            self.result = CommandResult(self.argv, proc.returncode, '\n'.join(output), errors[0] if errors else b'', clock() - start)
+            CommandEngine.after(self.result)
+
+        if not self.result.ok and not self.cancelled:
+            raise CommandError(self.result)
+
+    # Stops the command, safe to call from any thread and more than once
+    def cancel(self):
+        with self._lock:
+            if self._proc is None:
+                self.cancelled = True
+            elif self._proc.poll() is None:
+                self.cancelled = True
+                try:
+                    self._proc.kill()
+                except OSError:
+                    # Exited between the poll and the kill
+                    pass
+
+    # Runs the command to completion, calling callback with every event, and returns the result
+    def wait(self, callback=None):
+        for event in self:
+            if callback is not None:
+                callback(event)
+        return self.result
+
+
+# Builds argv like CommandEngine.run, adding -puppetstrings, and returns its ProgressStream
+# A leading ~ in arguments is expanded, as a shell would
+def stream_command(*args, **kwargs):
+    kwargs['puppetstrings'] = None
+    argv = Helpers.generate_command_args(*args, **kwargs)
+    return ProgressStream([os.path.expanduser(arg) if arg.startswith('~') else arg for arg in argv])
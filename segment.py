@@ -0,0 +1,345 @@
+#
+# Splits image files into fixed-size segments with a checksummed manifest, and joins them back
+#
+## Usage: manifest = split('~/images/build.dmg', 2 * 1000 ** 3, directory='/transfer/build')
+##        # copy /transfer/build to the other host, then there:
+##        damaged = verify('/transfer/build/build.dmg.manifest.json')   # segments to send again
+##        join('/transfer/build/build.dmg.manifest.json', '~/images/build.dmg')
+## Segments are plain byte ranges of the image named <image>.001.part, <image>.002.part and so on,
+## each checksummed with hashlib so shasum can check them too. The manifest records the image's
+## size, the segment size and every segment's offset, size and digest as JSON. Unlike the output of
+## hdiutil segment, the segments need no hdiutil to be joined, on macOS or elsewhere.
+## Both directions resume: split skips segments the manifest already records, join skips segments
+## a previous, interrupted join of the same output recorded in <output>.partial.json
+#
+
+import errno, hashlib, json, os, sys, threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from progress import ProgressEvent
+from utils import Helpers
+
+DEFAULT_ALGORITHM = 'sha256'
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 1
+# Bytes hashed and copied at a time
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+## The segments of one image and their digests
+#
+## digest is None for segments not written yet, so an interrupted split leaves a manifest that
+## tells which segments remain
+class SegmentManifest(object):
+
+    def __init__(self, path, image, size, segment_size, algorithm=DEFAULT_ALGORITHM, segments=None, source=None):
+        self.path = os.path.expanduser(path)
+        self.image = image
+        self.size = size
+        self.segment_size = segment_size
+        self.algorithm = algorithm
+        # Dicts with name, offset, size and digest, in image order
+        self.segments = segments if segments is not None else self._layout(image, size, segment_size)
+        # Size and mtime of the image the segments were cut from, used to resume a split
+        self.source = source
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'SegmentManifest({!r}, {} of {} segments written)'.format(
+            self.path, len(self.segments) - len(self.pending()), len(self.segments))
+
+    @classmethod
+    def load(cls, path):
+        path = os.path.expanduser(path)
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('version') != MANIFEST_VERSION:
+            raise Exception('Unsupported segment manifest version: {}'.format(data.get('version')))
+        return cls(path, data['image'], data['size'], data['segment_size'], data['algorithm'], data['segments'], data.get('source'))
+
+    # Writes the manifest atomically
+    def save(self):
+        with self._lock:
+            Helpers.write_json(self.path, self._data())
+
+    @property
+    def directory(self):
+        return os.path.dirname(self.path)
+
+    @property
+    def complete(self):
+        return not self.pending()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, segment['name'])
+
+    # Segments without a recorded digest
+    def pending(self):
+        return [segment for segment in self.segments if segment['digest'] is None]
+
+    # Records a written segment, saving the manifest so an interrupted split keeps it
+    def record(self, segment, digest):
+        with self._lock:
+            segment['digest'] = digest
+            Helpers.write_json(self.path, self._data())
+
+    def _data(self):
+        return {'version' : MANIFEST_VERSION, 'image' : self.image, 'size' : self.size, 'segment_size' : self.segment_size,
+                'algorithm' : self.algorithm, 'segments' : self.segments, 'source' : self.source}
+
+    @staticmethod
+    def _layout(image, size, segment_size):
+        count = (size + segment_size - 1) // segment_size
+        width = max(3, len(str(count)))
+        return [{'name' : '{}.{:0{}d}.part'.format(image, i + 1, width), 'offset' : i * segment_size,
+                 'size' : min(segment_size, size - i * segment_size), 'digest' : None} for i in range(count)]
+
+
+## Cuts the image file at path into segment_size segments, returning the SegmentManifest
+#
+## Segments and the manifest <image>.manifest.json are written to directory, by default the
+## image's own. Segments are cut and hashed on workers threads. An existing manifest for the
+## same unchanged image and segment size is resumed, otherwise the split starts over.
+## progress is called with a ProgressEvent after every segment
+def split(path, segment_size, directory=None, workers=None, algorithm=DEFAULT_ALGORITHM, progress=None):
+    path = os.path.expanduser(path)
+    if not os.path.isfile(path):
+        raise Exception('Only single-file disk images can be segmented: ' + path)
+    segment_size = int(segment_size)
+    if segment_size <= 0:
+        raise Exception('Invalid argument. Segment size must be positive.')
+    directory = os.path.expanduser(directory) if directory else os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    st = os.stat(path)
+    image = os.path.basename(path)
+    source = {'size' : st.st_size, 'mtime' : Helpers.mtime_ns(st)}
+    manifest_path = os.path.join(directory, image + MANIFEST_SUFFIX)
+    manifest = None
+    if os.path.exists(manifest_path):
+        manifest = SegmentManifest.load(manifest_path)
+        if (manifest.source, manifest.segment_size, manifest.algorithm) != (source, segment_size, algorithm):
+            manifest = None
+    if manifest is None:
+        manifest = SegmentManifest(manifest_path, image, st.st_size, segment_size, algorithm, source=source)
+        manifest.save()
+
+    # Recorded segments whose file went missing or was cut short are written again
+    for segment in manifest.segments:
+        if segment['digest'] is not None and _size(manifest.segment_path(segment)) != segment['size']:
+            segment['digest'] = None
+    pending = manifest.pending()
+    if not pending:
+        return manifest
+
+    mapped = Helpers.map_file(path)
+    try:
+        def write(segment):
+            target = manifest.segment_path(segment)
+            temporary = Helpers.temporary_path(target, 'partial')
+            digest = hashlib.new(algorithm)
+            with open(temporary, 'wb') as f:
+                for offset in range(segment['offset'], segment['offset'] + segment['size'], CHUNK_SIZE):
+                    view = Helpers.memory_view(mapped, offset, min(offset + CHUNK_SIZE, segment['offset'] + segment['size']))
+                    try:
+                        digest.update(view)
+                        f.write(view)
+                    finally:
+                        if hasattr(view, 'release'):
+                            view.release()
+            os.rename(temporary, target)
+            manifest.record(segment, digest.hexdigest())
+
+        _run(write, pending, workers, len(manifest.segments) - len(pending), len(manifest.segments), 'Splitting', progress)
+    finally:
+        mapped.close()
+    return manifest
+
+
+## Names of the manifest's segments that are missing or do not match their digest
+#
+## Run on the receiving host to find the segments a transfer has to send again
+def verify(manifest, workers=None):
+    manifest = _manifest(manifest)
+    if not manifest.complete:
+        raise Exception('Segment manifest is incomplete, the split did not finish: ' + manifest.path)
+
+    def check(segment):
+        segment_path = manifest.segment_path(segment)
+        if _size(segment_path) != segment['size'] or _digest(segment_path, manifest.algorithm) != segment['digest']:
+            return segment['name']
+
+    pool = ThreadPool(max(1, min(workers or cpu_count(), len(manifest.segments))))
+    try:
+        return [name for name in pool.map(check, manifest.segments) if name is not None]
+    finally:
+        pool.close()
+        pool.join()
+
+
+## Reassembles the image described by manifest at output, returning output's path
+#
+## output defaults to the image's name beside the manifest. Segments are verified against their
+## digests, unless check is False, and copied into place on workers threads with
+## copy_file_range or sendfile where the platform has them. The image is assembled under
+## <output>.partial and renamed once complete; an interrupted join is resumed from there, as long
+## as the segments it joined have the digests the manifest gives them
+def join(manifest, output=None, workers=None, check=True, progress=None):
+    manifest = _manifest(manifest)
+    if not manifest.complete:
+        raise Exception('Segment manifest is incomplete, the split did not finish: ' + manifest.path)
+    output = os.path.expanduser(output) if output else os.path.join(manifest.directory, manifest.image)
+    if os.path.exists(output):
+        raise Exception('Invalid argument. Disk image already exists: ' + output)
+    missing = [segment['name'] for segment in manifest.segments if _size(manifest.segment_path(segment)) != segment['size']]
+    if missing:
+        raise Exception('Missing or truncated segments: ' + ', '.join(missing))
+
+    partial = output + '.partial'
+    state_path = partial + '.json'
+    state = {'image' : manifest.image, 'size' : manifest.size, 'segment_size' : manifest.segment_size,
+             'algorithm' : manifest.algorithm, 'joined' : {}}
+    previous = _read_state(state_path) if os.path.exists(partial) else None
+    if previous is not None and all(previous.get(key) == state[key] for key in ('image', 'size', 'segment_size', 'algorithm')):
+        # Segments are recorded with their digests, so a partial joined from other segments
+        # under the same name, an earlier build of the image, is started over
+        digests = {segment['name'] : segment['digest'] for segment in manifest.segments}
+        joined = previous.get('joined')
+        if isinstance(joined, dict) and all(digests.get(name) == digest for name, digest in joined.items()):
+            state = previous
+    pending = [segment for segment in manifest.segments if segment['name'] not in state['joined']]
+
+    with open(partial, 'r+b' if state['joined'] else 'wb') as f:
+        f.truncate(manifest.size)
+    lock = threading.Lock()
+
+    def place(segment):
+        segment_path = manifest.segment_path(segment)
+        if check and _digest(segment_path, manifest.algorithm) != segment['digest']:
+            raise Exception('Segment does not match its checksum: ' + segment_path)
+        source = os.open(segment_path, os.O_RDONLY)
+        try:
+            target = os.open(partial, os.O_WRONLY)
+            try:
+                copy_range(source, target, segment['size'], segment['offset'])
+                # Recorded only once the data is on disk, so a resumed join never skips lost data
+                getattr(os, 'fdatasync', os.fsync)(target)
+            finally:
+                os.close(target)
+        finally:
+            os.close(source)
+        with lock:
+            state['joined'][segment['name']] = segment['digest']
+            Helpers.write_json(state_path, state)
+
+    _run(place, pending, workers, len(manifest.segments) - len(pending), len(manifest.segments), 'Joining', progress)
+    os.rename(partial, output)
+    os.remove(state_path)
+    return output
+
+
+## Copies count bytes from the start of source to offset in target, both file descriptors
+#
+## Uses copy_file_range, which can share blocks on filesystems that support it, then sendfile,
+## which Linux allows between files, falling back to read and write. Moves both file positions
+def copy_range(source, target, count, offset):
+    os.lseek(source, 0, os.SEEK_SET)
+    os.lseek(target, offset, os.SEEK_SET)
+    copied = 0
+    for copy in _COPIERS:
+        try:
+            while copied < count:
+                sent = copy(source, target, min(count - copied, CHUNK_SIZE * 8))
+                if not sent:
+                    break
+                copied += sent
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+            # Not supported for these files, carry on with the next way of copying
+            os.lseek(source, copied, os.SEEK_SET)
+            os.lseek(target, offset + copied, os.SEEK_SET)
+        if copied >= count:
+            return
+    raise Exception('Segment ended after {} of {} bytes.'.format(copied, count))
+
+
+def _copy_file_range(source, target, count):
+    return os.copy_file_range(source, target, count)
+
+
+def _sendfile(source, target, count):
+    return os.sendfile(target, source, None, count)
+
+
+def _read_write(source, target, count):
+    data = os.read(source, min(count, CHUNK_SIZE))
+    view = memoryview(data)
+    while view:
+        view = view[os.write(target, view):]
+    return len(data)
+
+
+_COPIERS = ([_copy_file_range] if hasattr(os, 'copy_file_range') else []) + \
+           ([_sendfile] if hasattr(os, 'sendfile') and sys.platform.startswith('linux') else []) + \
+           [_read_write]
+
+
+# Segment Helpers
+#
+def _manifest(manifest):
+    return manifest if isinstance(manifest, SegmentManifest) else SegmentManifest.load(manifest)
+
+
+# Runs task over segments on a thread pool, reporting the share of all segments done to progress
+def _run(task, segments, workers, done, total, phase, progress):
+    pool = ThreadPool(max(1, min(workers or cpu_count(), len(segments))))
+    try:
+        for _ in pool.imap_unordered(task, segments):
+            done += 1
+            if progress is not None:
+                progress(ProgressEvent('percent', 100.0 * done / total, phase, None))
+    except BaseException:
+        # Drops the segments not started yet, so a failed task or progress callback stops the run
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+# Join state left by an interrupted join, None if there is none or it cannot be read
+def _read_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+# Plain hex digest of a whole file, comparable with shasum's
+def _digest(path, algorithm):
+    digest = hashlib.new(algorithm)
+    mapped = Helpers.map_file(path)
+    if mapped is None:
+        return digest.hexdigest()
+    try:
+        for offset in range(0, len(mapped), CHUNK_SIZE):
+            view = Helpers.memory_view(mapped, offset, offset + CHUNK_SIZE)
+            try:
+                digest.update(view)
+            finally:
+                if hasattr(view, 'release'):
+                    view.release()
+    finally:
+        mapped.close()
+    return digest.hexdigest()
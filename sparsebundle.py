@@ -0,0 +1,266 @@
+#
+# Native inspection of .sparsebundle directories: reads Info.plist and bands/ directly,
+# without spawning hdiutil, so bundles can be examined and streamed on any host
+#
+## Usage: bundle = SparseBundleImage('~/images/build.sparsebundle')
+##        bundle.band_size, bundle.size, bundle.allocated, bundle.band_count
+##        for chunk in bundle.iter_range(): digest.update(chunk)
+##        create_sparsebundle('~/images/staged.sparsebundle', 10 * 1000 ** 3, source=open('disk.raw', 'rb'))
+#
+
+import os, shutil
+from utils import Helpers
+
+BUNDLE_TYPE = 'com.apple.diskimage.sparsebundle'
+BUNDLE_VERSION = 1
+INFO_PLIST = 'Info.plist'
+BANDS_DIR = 'bands'
+# Empty files hdiutil keeps beside Info.plist
+TOKEN_FILE = 'token'
+LOCK_FILE = 'lock'
+
+# Band size of new bundles in bytes, SparseBundle.DEFAULT_BAND_SIZE is the same in sectors
+DEFAULT_BAND_SIZE = 1024 * 8 * 512
+
+
+# Copies a chunk yielded by iter_range into bytes
+def _bytes(chunk):
+    return chunk.tobytes() if isinstance(chunk, memoryview) else bytes(chunk)
+
+
+class SparseBundleImage(object):
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        info_path = os.path.join(self.path, INFO_PLIST)
+        if not os.path.isfile(info_path):
+            raise Exception('Not a sparse bundle, Info.plist not found: ' + self.path)
+        with open(info_path, 'rb') as f:
+            info = Helpers.read_plist(f.read())
+        if info.get('diskimage-bundle-type') != BUNDLE_TYPE:
+            raise Exception('Not a sparse bundle: ' + self.path)
+
+        self.info = info
+        self.band_size = int(info['band-size'])
+        # Logical size of the virtual disk in bytes
+        self.size = int(info['size'])
+        self.version = info.get('bundle-backingstore-version')
+
+    def __repr__(self):
+        return 'SparseBundleImage({!r}, size={}, band_size={}, bands={})'.format(
+            self.path, self.size, self.band_size, self.band_count)
+
+    @property
+    def bands_path(self): return os.path.join(self.path, BANDS_DIR)
+
+    # Bands are named by their index in lowercase hex
+    def band_path(self, index):
+        return os.path.join(self.bands_path, '{:x}'.format(index))
+
+    # Number of bands needed to cover the whole virtual disk
+    @property
+    def max_bands(self): return (self.size + self.band_size - 1) // self.band_size
+
+    # Sorted indexes of the bands present on disk
+    def bands(self):
+        try:
+            names = os.listdir(self.bands_path)
+        except OSError:
+            return []
+        indexes = []
+        for name in names:
+            try:
+                indexes.append(int(name, 16))
+            except ValueError:
+                pass
+        return sorted(indexes)
+
+    @property
+    def band_count(self): return len(self.bands())
+
+    # Bytes actually allocated on disk by the bands, less than apparent_size when bands are sparse
+    @property
+    def allocated(self):
+        total = 0
+        for index in self.bands():
+            st = os.stat(self.band_path(index))
+            total += st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+        return total
+
+    # Sum of the band file lengths
+    @property
+    def apparent_size(self):
+        return sum(os.path.getsize(self.band_path(index)) for index in self.bands())
+
+    ## Streams the virtual disk between offset and offset + length
+    #
+    ## Yields buffers of at most chunk_size bytes (default: band_size). Data present in band files
+    ## is yielded as views of an mmap rather than copied; missing bands and the unwritten tail of
+    ## short bands read as zeros
+    def iter_range(self, offset=0, length=None, chunk_size=None):
+        end = self.size if length is None else min(self.size, offset + length)
+        chunk_size = min(chunk_size or self.band_size, self.band_size)
+        zeros = None
+
+        while offset < end:
+            index, band_offset = divmod(offset, self.band_size)
+            band_end = min(self.band_size, band_offset + (end - offset))
+            mapped = self._map_band(index)
+            try:
+                mapped_size = len(mapped) if mapped is not None else 0
+                while band_offset < band_end:
+                    step = min(chunk_size, band_end - band_offset)
+                    if band_offset < mapped_size:
+                        step = min(step, mapped_size - band_offset)
+                        yield Helpers.memory_view(mapped, band_offset, band_offset + step)
+                    else:
+                        if zeros is None:
+                            zeros = memoryview(b'\0' * chunk_size)
+                        yield zeros[:step]
+                    band_offset += step
+                    offset += step
+            finally:
+                if mapped is not None:
+                    try:
+                        mapped.close()
+                    except BufferError:
+                        # A consumer still holds a view, the map is released when it is collected
+                        pass
+
+    # File-like reader over the virtual disk
+    def open(self):
+        return SparseBundleStream(self)
+
+    # Maps a band read-only, None if the band does not exist or is empty
+    def _map_band(self, index):
+        try:
+            return Helpers.map_file(self.band_path(index))
+        except (IOError, OSError):
+            return None
+
+
+## Seekable, read-only file object over a sparse bundle's virtual disk
+class SparseBundleStream(object):
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.position = 0
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.close()
+
+    def close(self): pass
+
+    def readable(self): return True
+
+    def seekable(self): return True
+
+    def tell(self): return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.bundle.size
+        if offset < 0:
+            raise ValueError('Negative seek position: {}'.format(offset))
+        self.position = offset
+        return self.position
+
+    def read(self, size=-1):
+        length = None if size is None or size < 0 else size
+        data = b''.join(_bytes(chunk) for chunk in self.bundle.iter_range(self.position, length))
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)
+        filled = 0
+        for chunk in self.bundle.iter_range(self.position, len(view)):
+            view[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+        self.position += filled
+        return filled
+
+
+## Writes a sparse bundle of size bytes without running hdiutil, returning its SparseBundleImage
+#
+## The bundle holds no partition map or file system unless source provides them; it is meant to
+## be formatted or attached later on macOS. With source, a readable raw disk image, the bundle is
+## filled from it: bands that are entirely zero are left out, like the bands hdiutil never wrote.
+## size defaults to source's length when source is seekable and is rounded up to whole sectors. The bundle is written under a
+## temporary name and renamed into place once complete
+def create_sparsebundle(path, size=None, band_size=DEFAULT_BAND_SIZE, source=None):
+    path = os.path.expanduser(path)
+    if os.path.exists(path):
+        raise Exception('Invalid argument. Disk image already exists: ' + path)
+    if size is None:
+        if source is None:
+            raise Exception('Invalid argument. A size or a source is required.')
+        position = source.tell()
+        source.seek(0, os.SEEK_END)
+        size = source.tell() - position
+        source.seek(position)
+    if band_size <= 0 or band_size % 512 or size <= 0:
+        raise Exception('Invalid argument. Band size must be a positive multiple of 512 and size positive.')
+    # Whole sectors, as hdiutil rounds sizes up
+    size = (int(size) + 511) // 512 * 512
+
+    partial = Helpers.temporary_path(path, 'partial')
+    try:
+        os.makedirs(os.path.join(partial, BANDS_DIR))
+        info = {'CFBundleInfoDictionaryVersion' : '6.0',
+                'band-size' : int(band_size),
+                'bundle-backingstore-version' : BUNDLE_VERSION,
+                'diskimage-bundle-type' : BUNDLE_TYPE,
+                'size' : int(size)}
+        with open(os.path.join(partial, INFO_PLIST), 'wb') as f:
+            f.write(Helpers.write_plist(info))
+        for name in (TOKEN_FILE, LOCK_FILE):
+            open(os.path.join(partial, name), 'wb').close()
+        if source is not None:
+            _write_bands(os.path.join(partial, BANDS_DIR), source, int(size), int(band_size))
+        os.rename(partial, path)
+    except Exception:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    return SparseBundleImage(path)
+
+
+# Copies source into band files one band at a time, skipping bands that are all zeros
+def _write_bands(bands_path, source, size, band_size):
+    buffer = bytearray(band_size)
+    view = memoryview(buffer)
+    zeros = bytes(band_size) if str is not bytes else b'\0' * band_size
+    offset = 0
+    index = 0
+    while True:
+        filled = _read_band(source, view)
+        if filled == 0:
+            break
+        if offset + filled > size:
+            raise Exception('Invalid argument. The source is larger than the bundle size ({} bytes).'.format(size))
+        if view[:filled] != zeros[:filled]:
+            with open(os.path.join(bands_path, '{:x}'.format(index)), 'wb') as f:
+                f.write(view[:filled])
+        offset += filled
+        index += 1
+        if filled < band_size:
+            break
+
+
+# Fills view from source, looping over short reads; returns the bytes read, less than len(view) at the end
+def _read_band(source, view):
+    filled = 0
+    while filled < len(view):
+        if hasattr(source, 'readinto'):
+            count = source.readinto(view[filled:])
+        else:
+            data = source.read(len(view) - filled)
+            count = len(data)
+            view[filled:filled + count] = data
+        if not count:
+            break
+        filled += count
+    return filled
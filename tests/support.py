@@ -0,0 +1,51 @@
+#
+# Shared setup for the tests: a fake hdiutil and diskutil on PATH
+#
+## Usage: class MyTest(BackendTestCase):
+##            def test_attach(self):
+##                image = self.hdiutil.load(self.image('a.dmg'), lazy=True)
+## The fakes are benchmarks/fake_backend.py, installed by bench_backend.FakeBackend; every test
+## gets a fresh backend with no images attached and the process-wide caches emptied
+#
+
+import os, sys, unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from bench_backend import FakeBackend
+from PyHDIUtil import HDIUtil
+
+
+class BackendTestCase(unittest.TestCase):
+
+    # Images attached when the test starts and seconds every fake invocation sleeps
+    fleet = 0
+    latency = 0.0
+
+    def setUp(self):
+        self.backend = FakeBackend(self.fleet, self.latency)
+        self._ttl = HDIUtil.info_cache.ttl
+        HDIUtil.leases.flush()
+        HDIUtil.info_cache.invalidate()
+        HDIUtil.info_cache.reset_stats()
+        self.hdiutil = HDIUtil()
+
+    def tearDown(self):
+        HDIUtil.leases.flush()
+        HDIUtil.info_cache.invalidate()
+        HDIUtil.info_cache.ttl = self._ttl
+        self.backend.close()
+
+    # Creates an empty image file in the backend's directory and returns its path
+    def image(self, name):
+        path = self.backend.image_path(name)
+        open(path, 'wb').close()
+        return path
+
+    # Fake invocations so far, optionally only those of one utility and verb, e.g. calls('hdiutil', 'info')
+    def calls(self, utility=None, verb=None):
+        with open(self.backend.log) as f:
+            lines = [line.split() for line in f]
+        return len([line for line in lines if utility in (None, line[0]) and verb in (None, line[1])])
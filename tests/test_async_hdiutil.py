@@ -0,0 +1,104 @@
+import errno, os, sys, unittest
+from support import BackendTestCase
+
+# async_hdiutil requires Python 3.5+, coroutines are driven without async syntax so this
+# module still imports on Python 2
+if sys.version_info >= (3, 5):
+    import asyncio
+    from async_hdiutil import AsyncHDIUtil, AsyncDiskImage
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio API requires Python 3.5+')
+class AsyncHDIUtilTest(BackendTestCase):
+
+    def setUp(self):
+        super(AsyncHDIUtilTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.async_hdiutil = AsyncHDIUtil()
+
+    def tearDown(self):
+        self.loop.close()
+        super(AsyncHDIUtilTest, self).tearDown()
+
+    def run_coroutine(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    # Makes every fake invocation slow and records its pid, returns the pid file
+    def slow_backend(self, latency=5):
+        pids = os.path.join(self.backend.directory, 'pids')
+        os.environ['FAKE_BACKEND_LATENCY'] = str(latency)
+        os.environ['FAKE_BACKEND_PIDS'] = pids
+        return pids
+
+    def assertKilled(self, pids):
+        with open(pids) as f:
+            pid = int(f.read().split()[-1])
+        with self.assertRaises(OSError) as context:
+            os.kill(pid, 0)
+        self.assertEqual(context.exception.errno, errno.ESRCH)
+
+    def test_create(self):
+        path = self.backend.image_path('created.sparsebundle')
+        image = self.run_coroutine(self.async_hdiutil.create(path, size='10m', volname='Build'))
+        self.assertIsInstance(image, AsyncDiskImage)
+        self.assertEqual((image.type, image.volname, image.size), ('SPARSEBUNDLE', 'Build', 10000000))
+        self.assertTrue(os.path.isdir(path))
+
+    def test_create_validates_options(self):
+        with self.assertRaises(Exception):
+            self.run_coroutine(self.async_hdiutil.create(self.backend.image_path('bad.dmg'), fs='NotAFileSystem'))
+        self.assertEqual(self.calls('hdiutil', 'create'), 0)
+
+    def test_attach_and_detach(self):
+        image = AsyncDiskImage(self.async_hdiutil, self.image('a.dmg'))
+        self.assertFalse(self.run_coroutine(image.is_mounted()))
+        self.run_coroutine(image.attach())
+        self.assertTrue(self.run_coroutine(image.is_mounted()))
+        self.assertEqual(self.run_coroutine(image.mounting_point()), '/dev/disk2s1')
+        self.run_coroutine(image.detach())
+        self.assertFalse(self.run_coroutine(image.is_mounted()))
+
+    def test_load_reads_diskutil_info(self):
+        image = self.run_coroutine(self.async_hdiutil.load(self.image('Payload.dmg')))
+        self.assertEqual((image.volname, image.fs, image.size), ('Payload', 'HFS+', 100000000))
+        self.assertEqual(self.calls('hdiutil', 'attach'), 1)
+
+    def test_resize(self):
+        image = AsyncDiskImage(self.async_hdiutil, self.image('a.dmg'), size='10m')
+        self.run_coroutine(image.resize('20m'))
+        self.assertEqual(image.size, 20000000)
+        self.assertEqual(self.calls('hdiutil', 'resize'), 1)
+
+    def test_convert(self):
+        image = AsyncDiskImage(self.async_hdiutil, self.image('a.dmg'))
+        output = self.backend.image_path('a-udzo.dmg')
+        converted = self.run_coroutine(image.convert('UDZO', output))
+        self.assertEqual(converted.path, output)
+        self.assertTrue(os.path.exists(output))
+
+    def test_timeout_kills_child(self):
+        pids = self.slow_backend()
+        image = AsyncDiskImage(self.async_hdiutil, self.image('a.dmg'))
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_coroutine(image.attach(timeout=0.5))
+        self.assertKilled(pids)
+
+    def test_default_timeout(self):
+        pids = self.slow_backend()
+        hdiutil = AsyncHDIUtil(timeout=0.5)
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_coroutine(hdiutil.registry())
+        self.assertKilled(pids)
+
+    def test_cancellation_kills_child(self):
+        pids = self.slow_backend()
+        image = AsyncDiskImage(self.async_hdiutil, self.image('a.dmg'))
+        task = self.loop.create_task(image.attach())
+        self.loop.call_later(0.5, task.cancel)
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_coroutine(task)
+        self.assertKilled(pids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os, resource, unittest
+from support import BackendTestCase
+from build_cache import ImageBuilder, tree_hash
+from checksum import Checksummer
+
+# Source folders in these tests hold more files than the process may have open
+FD_LIMIT = 256
+FILES = 2 * FD_LIMIT
+
+
+class BuildCacheTestCase(BackendTestCase):
+
+    def setUp(self):
+        super(BuildCacheTestCase, self).setUp()
+        self.source = os.path.join(self.backend.directory, 'Payload')
+        for n in range(FILES):
+            directory = os.path.join(self.source, 'd{}'.format(n % 8))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(os.path.join(directory, 'f{}'.format(n)), 'wb') as f:
+                f.write('{}'.format(n).encode('ascii') * 100)
+        soft, hard = self._limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (FD_LIMIT, hard))
+
+    def tearDown(self):
+        resource.setrlimit(resource.RLIMIT_NOFILE, self._limits)
+        super(BuildCacheTestCase, self).tearDown()
+
+
+class TreeHashTest(BuildCacheTestCase):
+
+    def test_more_files_than_descriptors(self):
+        digest = tree_hash(self.source, Checksummer())
+        self.assertEqual(len(digest), 64)
+        self.assertEqual(tree_hash(self.source, Checksummer(workers=1)), digest)
+
+    def test_content_changes_hash(self):
+        digest = tree_hash(self.source, Checksummer())
+        with open(os.path.join(self.source, 'd0', 'f0'), 'ab') as f:
+            f.write(b'changed')
+        self.assertNotEqual(tree_hash(self.source, Checksummer()), digest)
+
+    def test_renames_change_hash(self):
+        digest = tree_hash(self.source, Checksummer())
+        os.rename(os.path.join(self.source, 'd0', 'f0'), os.path.join(self.source, 'd0', 'renamed'))
+        self.assertNotEqual(tree_hash(self.source, Checksummer()), digest)
+
+
+class ImageBuilderTest(BuildCacheTestCase):
+
+    def setUp(self):
+        super(ImageBuilderTest, self).setUp()
+        self.builder = ImageBuilder(os.path.join(self.backend.directory, 'cache'))
+
+    def test_build_then_hit(self):
+        first = self.builder.build(self.source, self.backend.image_path('first.dmg'), volname='Payload')
+        self.assertTrue(os.path.exists(first.path))
+        self.assertEqual(self.calls('hdiutil', 'create'), 1)
+
+        second = self.builder.build(self.source, self.backend.image_path('second.dmg'), volname='Payload')
+        self.assertTrue(os.path.exists(second.path))
+        self.assertEqual(self.calls('hdiutil', 'create'), 1)
+        self.assertEqual((self.builder.cache.hits, self.builder.cache.misses), (1, 1))
+
+    def test_options_are_part_of_the_key(self):
+        self.builder.build(self.source, self.backend.image_path('first.dmg'), volname='Payload')
+        self.builder.build(self.source, self.backend.image_path('second.dmg'), volname='Other')
+        self.assertEqual(self.calls('hdiutil', 'create'), 2)
+
+    def test_uncached_build(self):
+        self.builder.build(self.source, self.backend.image_path('first.dmg'), cached=False)
+        self.assertEqual(self.builder.cache.size, 0)
+        self.assertNotIn(self.builder.key(self.source, self.backend.image_path('first.dmg')), self.builder.cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import json, os, unittest
+from support import BackendTestCase
+from conversion import ConversionJob, ConversionQueue
+
+
+class ConversionTestCase(BackendTestCase):
+
+    def setUp(self):
+        super(ConversionTestCase, self).setUp()
+        self.journal = os.path.join(self.backend.directory, 'conversions.jsonl')
+
+    def converted(self, queue):
+        order = []
+        queue.on_complete = lambda job: order.append(os.path.basename(job.source))
+        return order
+
+
+class DefaultOutputTest(ConversionTestCase):
+
+    def test_convert_dmg_to_udif_format(self):
+        image = self.hdiutil.load(self.image('build.dmg'), lazy=True)
+        converted = image.convert('ULFO')
+        self.assertEqual(converted.path, self.backend.image_path('build-ulfo.dmg'))
+        self.assertTrue(os.path.exists(converted.path))
+
+    def test_submit_uses_converted_path(self):
+        queue = ConversionQueue()
+        job = queue.submit(self.image('build.sparsebundle'), 'UDZO')
+        self.assertEqual(job.output, self.hdiutil.load(job.source, lazy=True).converted_path('UDZO'))
+        self.assertEqual(job.output, self.backend.image_path('build-udzo.dmg'))
+        queue.close(wait=False)
+
+
+class PriorityTest(ConversionTestCase):
+
+    def test_priority_then_submission_order(self):
+        queue = ConversionQueue(workers=1)
+        order = self.converted(queue)
+        for name, priority in (('a.dmg', 0), ('b.dmg', 1), ('c.dmg', 0), ('d.dmg', 2), ('e.dmg', 1)):
+            queue.submit(self.image(name), 'UDZO', priority=priority)
+        with queue:
+            pass
+        self.assertEqual(order, ['d.dmg', 'b.dmg', 'e.dmg', 'a.dmg', 'c.dmg'])
+        self.assertEqual([job.state for job in queue.jobs], ['done'] * 5)
+
+
+class JournalTest(ConversionTestCase):
+
+    def test_pending_jobs_are_resubmitted(self):
+        queue = ConversionQueue(journal=self.journal)
+        first = queue.submit(self.image('a.dmg'), 'UDZO', priority=1)
+        second = queue.submit(self.image('b.dmg'), 'UDZO')
+        # Closed without running, as if the process had died
+        queue.close(wait=False)
+
+        queue = ConversionQueue(workers=1, journal=self.journal)
+        self.assertEqual([job.id for job in queue.jobs], [first.id, second.id])
+        self.assertEqual(queue.jobs[0].priority, 1)
+        with queue:
+            pass
+        self.assertTrue(all(job.state == 'done' for job in queue.jobs))
+
+        # Finished jobs are not resubmitted again
+        queue = ConversionQueue(journal=self.journal)
+        self.assertEqual(queue.jobs, [])
+        queue.close()
+
+    def test_partial_output_is_removed(self):
+        source = self.image('a.dmg')
+        job = ConversionJob(source, 'UDZO', self.image('a-udzo.dmg'))
+        existing = ConversionJob(self.image('b.dmg'), 'UDZO', self.image('kept.dmg'))
+        with open(self.journal, 'w') as f:
+            for entry in ({'event' : 'submit', 'job' : job.spec()},
+                          {'event' : 'start', 'id' : job.id, 'existed' : False},
+                          {'event' : 'submit', 'job' : existing.spec()},
+                          {'event' : 'start', 'id' : existing.id, 'existed' : True}):
+                f.write(json.dumps(entry) + '\n')
+            # A record cut short by the crash
+            f.write('{"event": "done", "id"')
+
+        queue = ConversionQueue(journal=self.journal)
+        self.assertEqual(len(queue.jobs), 2)
+        self.assertFalse(os.path.exists(job.output))
+        self.assertTrue(os.path.exists(existing.output))
+        queue.close(wait=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
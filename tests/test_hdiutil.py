@@ -0,0 +1,59 @@
+import os, unittest
+from support import BackendTestCase
+from PyHDIUtil import SparseBundle, UDIF
+from sparsebundle import create_sparsebundle
+
+
+class CreateTest(BackendTestCase):
+
+    def test_extension_picks_type(self):
+        image = self.hdiutil.create(path=self.backend.image_path('a.sparsebundle'), size='10m')
+        self.assertIsInstance(image, SparseBundle)
+        self.assertEqual(image.type, 'SPARSEBUNDLE')
+
+    def test_matching_type(self):
+        image = self.hdiutil.create(path=self.backend.image_path('a.dmg'), size='10m', type='UDIF')
+        self.assertIsInstance(image, UDIF)
+
+    def test_type_must_match_extension(self):
+        with self.assertRaises(Exception):
+            self.hdiutil.create(path=self.backend.image_path('a.dmg'), size='10m', type='SPARSE')
+        self.assertEqual(self.calls('hdiutil', 'create'), 0)
+        self.assertFalse(os.path.exists(self.backend.image_path('a.dmg')))
+
+
+class SparseBandSizeTest(BackendTestCase):
+
+    def setUp(self):
+        super(SparseBandSizeTest, self).setUp()
+        self.path = self.backend.image_path('bands.sparsebundle')
+        create_sparsebundle(self.path, 10000000, band_size=16384 * 512)
+
+    def test_lazy_load_reads_band_size(self):
+        image = self.hdiutil.load(self.path, lazy=True)
+        self.assertEqual(image.sparse_band_size, 16384)
+        self.assertEqual(self.calls(), 0)
+
+    def test_native_and_attached_loads_agree(self):
+        self.assertEqual(self.hdiutil.load(self.path, native=True).sparse_band_size, 16384)
+        self.assertEqual(self.hdiutil.load(self.path).sparse_band_size, 16384)
+
+    def test_new_bundles_default(self):
+        image = self.hdiutil.create(path=self.backend.image_path('new.sparsebundle'), size='10m')
+        self.assertEqual(image.sparse_band_size, SparseBundle.DEFAULT_BAND_SIZE)
+
+
+class AttachManyTest(BackendTestCase):
+
+    def test_one_info_snapshot(self):
+        images = [self.hdiutil.load(self.image('{}.dmg'.format(n)), lazy=True) for n in range(6)]
+        result = self.hdiutil.attach_many(images, max_workers=3)
+        self.assertTrue(result.ok)
+        self.assertEqual(self.calls('hdiutil', 'attach'), 6)
+        self.assertEqual(self.calls('hdiutil', 'isencrypted'), 6)
+        self.assertEqual(self.calls('hdiutil', 'info'), 1)
+        self.assertTrue(all(image.is_mounted() for image in images))
+
+
+if __name__ == '__main__':
+    unittest.main()
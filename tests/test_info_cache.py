@@ -0,0 +1,76 @@
+import time, unittest
+from support import BackendTestCase
+from PyHDIUtil import HDIUtil
+from utils import CommandEngine
+
+
+class InfoCacheTest(BackendTestCase):
+
+    fleet = 2
+
+    def test_images_share_one_snapshot(self):
+        first, second = [self.hdiutil.load(path, lazy=True) for path in self.backend.images]
+        self.assertTrue(first.is_mounted())
+        self.assertTrue(second.is_mounted())
+        self.assertEqual(first.mounting_point(), '/dev/disk2s1')
+        self.assertEqual(self.calls('hdiutil', 'info'), 1)
+
+    def test_hit_and_miss_counters(self):
+        image = self.hdiutil.load(self.backend.images[0], lazy=True)
+        for i in range(3):
+            image.info()
+        self.assertEqual(HDIUtil.info_cache.stats(), {'hits' : 2, 'misses' : 1, 'ttl' : HDIUtil.info_cache.ttl})
+        HDIUtil.info_cache.reset_stats()
+        self.assertEqual((HDIUtil.info_cache.hits, HDIUtil.info_cache.misses), (0, 0))
+
+    def test_snapshot_expires_after_ttl(self):
+        HDIUtil.info_cache.ttl = 0.05
+        image = self.hdiutil.load(self.backend.images[0], lazy=True)
+        image.info()
+        image.info()
+        self.assertEqual(self.calls('hdiutil', 'info'), 1)
+        time.sleep(0.1)
+        image.info()
+        self.assertEqual(self.calls('hdiutil', 'info'), 2)
+
+    def test_invalidated_by_attach(self):
+        image = self.hdiutil.load(self.image('new.dmg'), lazy=True)
+        self.assertFalse(image.is_mounted())
+        image.attach()
+        self.assertTrue(image.is_mounted())
+        self.assertEqual(HDIUtil.info_cache.misses, 2)
+
+    def test_invalidated_by_detach(self):
+        image = self.hdiutil.load(self.backend.images[0], lazy=True)
+        self.assertTrue(image.is_mounted())
+        image.detach()
+        self.assertFalse(image.is_mounted())
+        self.assertEqual(HDIUtil.info_cache.misses, 2)
+
+    def test_invalidated_by_create_and_resize(self):
+        image = self.hdiutil.create(path=self.backend.image_path('created.dmg'), size='10m')
+        misses = HDIUtil.info_cache.misses
+        image.info()
+        image.info()
+        self.assertEqual(HDIUtil.info_cache.misses, misses + 1)
+        image.size = '20m'
+        image.info()
+        self.assertEqual(HDIUtil.info_cache.misses, misses + 2)
+        self.assertEqual(self.calls('hdiutil', 'resize'), 1)
+
+    def test_unrelated_commands_keep_snapshot(self):
+        image = self.hdiutil.load(self.backend.images[0], lazy=True)
+        image.info()
+        CommandEngine.run('hdiutil', 'isencrypted', image.path)
+        image.info()
+        self.assertEqual(self.calls('hdiutil', 'info'), 1)
+
+    def test_invalidated_by_rename(self):
+        image = self.hdiutil.load(self.backend.images[0], lazy=True)
+        image.info()
+        CommandEngine.run('diskutil', 'rename', 'disk2s1', 'Renamed')
+        self.assertEqual(HDIUtil.info_cache.registry().by_volname('Renamed')[0]['image-path'], image.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
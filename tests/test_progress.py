@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import errno, io, os, sys, unittest
+from support import BackendTestCase
+from progress import ProgressEvent, ProgressParser, stream_command
+from utils import CommandError
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from async_hdiutil import AsyncHDIUtil
+
+# `hdiutil convert -puppetstrings` output recorded on macOS
+RECORDED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'puppetstrings-convert.txt')
+MBR = u'Reading Protective Master Boot Record (MBR : 0)'
+GPT = u'Reading GPT Header (Primary GPT Header : 1)'
+
+EXPECTED = [ProgressEvent('output', None, None, u'Preparing imaging engine…'),
+            ProgressEvent('percent', None, None, u'-1.000000'),
+            ProgressEvent('phase', None, MBR, MBR),
+            ProgressEvent('percent', 0.0, MBR, u'0.000000'),
+            ProgressEvent('message', 0.0, MBR, u'Checksumming…'),
+            ProgressEvent('percent', 25.5, MBR, u'25.500000'),
+            ProgressEvent('percent', 50.0, MBR, u'50.000000'),
+            ProgressEvent('phase', 50.0, GPT, GPT),
+            ProgressEvent('percent', 100.0, GPT, u'100.000000'),
+            ProgressEvent('message', 100.0, GPT, u'Finishing…'),
+            ProgressEvent('output', 100.0, GPT, u'created: /tmp/out.dmg')]
+
+
+def recorded():
+    with io.open(RECORDED, encoding='utf-8') as f:
+        return f.read()
+
+
+class ProgressParserTest(unittest.TestCase):
+
+    def test_parse_recorded_output(self):
+        self.assertEqual(ProgressParser().parse(recorded()), EXPECTED)
+
+    def test_feed_accepts_bytes(self):
+        parser = ProgressParser()
+        events = [parser.feed(line) for line in recorded().encode('utf-8').splitlines()]
+        self.assertEqual([event for event in events if event is not None], EXPECTED)
+
+    def test_blank_lines_are_skipped(self):
+        self.assertIsNone(ProgressParser().feed(u'   \n'))
+
+    def test_malformed_percent_is_output(self):
+        parser = ProgressParser()
+        parser.feed(u'PERCENT:12.5')
+        self.assertEqual(parser.feed(u'PERCENT:abc'), ProgressEvent('output', 12.5, None, u'PERCENT:abc'))
+
+    def test_percent_is_clamped(self):
+        self.assertEqual(ProgressParser().feed(u'PERCENT:100.5').percent, 100.0)
+
+
+class ReplayTestCase(BackendTestCase):
+
+    # Replays the recorded output for every long verb, delay seconds apart, and records pids
+    def replay(self, delay=0.0):
+        self.pids = os.path.join(self.backend.directory, 'pids')
+        os.environ.update({'FAKE_BACKEND_REPLAY' : RECORDED,
+                           'FAKE_BACKEND_LINE_DELAY' : str(delay),
+                           'FAKE_BACKEND_PIDS' : self.pids})
+
+    def assertKilled(self):
+        with open(self.pids) as f:
+            pid = int(f.read().split()[-1])
+        with self.assertRaises(OSError) as context:
+            os.kill(pid, 0)
+        self.assertEqual(context.exception.errno, errno.ESRCH)
+
+
+class ProgressStreamTest(ReplayTestCase):
+
+    def test_replayed_events(self):
+        self.replay()
+        stream = stream_command('hdiutil', 'compact', self.image('a.sparsebundle'))
+        events = []
+        result = stream.wait(events.append)
+        self.assertEqual(events, EXPECTED)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.stdout, u'Preparing imaging engine…\ncreated: /tmp/out.dmg')
+        self.assertIn('-puppetstrings', result.argv)
+
+    def test_pipes_are_closed(self):
+        stream = stream_command('hdiutil', 'compact', self.image('a.sparsebundle'))
+        stream.wait()
+        self.assertTrue(all(pipe.closed for pipe in (stream._proc.stdin, stream._proc.stdout, stream._proc.stderr)))
+
+    def test_failure_raises(self):
+        output = self.image('exists.dmg')
+        with self.assertRaises(CommandError):
+            stream_command('hdiutil', 'convert', self.image('a.dmg'), format='UDZO', o=output).wait()
+
+    def test_cancel_kills_child(self):
+        self.replay(delay=1.0)
+        stream = stream_command('hdiutil', 'compact', self.image('a.sparsebundle'))
+        events = []
+
+        def cancel_on_first(event):
+            events.append(event)
+            stream.cancel()
+
+        stream.wait(cancel_on_first)
+        self.assertTrue(stream.cancelled)
+        self.assertEqual(len(events), 1)
+        self.assertNotEqual(stream.result.returncode, 0)
+        self.assertKilled()
+
+    def test_abandoned_iteration_kills_child(self):
+        self.replay(delay=1.0)
+        stream = stream_command('hdiutil', 'compact', self.image('a.sparsebundle'))
+        iterator = iter(stream)
+        self.assertEqual(next(iterator), EXPECTED[0])
+        iterator.close()
+        self.assertTrue(stream.cancelled)
+        self.assertKilled()
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio API requires Python 3.5+')
+class AsyncProgressStreamTest(ReplayTestCase):
+
+    def setUp(self):
+        super(AsyncProgressStreamTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super(AsyncProgressStreamTest, self).tearDown()
+
+    def test_replayed_events(self):
+        self.replay()
+        stream = AsyncHDIUtil().stream('compact', self.image('a.sparsebundle'))
+        events = []
+        result = self.loop.run_until_complete(stream.wait(events.append))
+        self.assertEqual(events, EXPECTED)
+        self.assertTrue(result.ok)
+
+    def test_cancel_kills_child(self):
+        self.replay(delay=1.0)
+        stream = AsyncHDIUtil().stream('compact', self.image('a.sparsebundle'))
+        events = []
+
+        def cancel_on_first(event):
+            events.append(event)
+            stream.cancel()
+
+        self.loop.run_until_complete(stream.wait(cancel_on_first))
+        self.assertTrue(stream.cancelled)
+        self.assertEqual(len(events), 1)
+        self.assertKilled()
+
+    def test_timeout_kills_child(self):
+        self.replay(delay=1.0)
+        stream = AsyncHDIUtil(timeout=0.5).stream('compact', self.image('a.sparsebundle'))
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(stream.wait())
+        self.assertKilled()
+
+    def test_task_cancellation_kills_child(self):
+        self.replay(delay=1.0)
+        stream = AsyncHDIUtil().stream('compact', self.image('a.sparsebundle'))
+        task = self.loop.create_task(stream.wait())
+        self.loop.call_later(0.5, task.cancel)
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(task)
+        self.assertTrue(stream.cancelled)
+        self.assertKilled()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import os, shutil, tempfile, unittest
+import support  # puts the package on sys.path
+from segment import MANIFEST_SUFFIX, SegmentManifest, join, split, verify
+
+SEGMENT_SIZE = 1000
+SEGMENTS = 8
+
+
+class Interrupt(Exception):
+    pass
+
+
+# Progress callback that fails after count events, interrupting the split or join
+def interrupt_after(count):
+    events = []
+
+    def progress(event):
+        events.append(event)
+        if len(events) >= count:
+            raise Interrupt()
+    return progress
+
+
+class SegmentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='pyhdiutil-segment-')
+        self.parts = self.path('parts')
+        self.output = self.path('joined.dmg')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    # Writes an image of SEGMENTS segments, every byte fill unless the contents differ per segment
+    def image(self, fill=b'A', mtime=None):
+        path = self.path('build.dmg')
+        with open(path, 'wb') as f:
+            for n in range(SEGMENTS):
+                f.write(fill * (SEGMENT_SIZE - 1) + bytearray([n]))
+            f.write(fill * (SEGMENT_SIZE // 2))
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def contents(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class SplitTest(SegmentTestCase):
+
+    def test_split(self):
+        path = self.image()
+        manifest = split(path, SEGMENT_SIZE, directory=self.parts, workers=4)
+        self.assertTrue(manifest.complete)
+        self.assertEqual(manifest.path, os.path.join(self.parts, 'build.dmg' + MANIFEST_SUFFIX))
+        self.assertEqual(len(manifest.segments), SEGMENTS + 1)
+        self.assertEqual(manifest.segments[-1]['size'], SEGMENT_SIZE // 2)
+        data = b''.join(self.contents(manifest.segment_path(segment)) for segment in manifest.segments)
+        self.assertEqual(data, self.contents(path))
+
+    def test_resume(self):
+        path = self.image()
+        with self.assertRaises(Interrupt):
+            split(path, SEGMENT_SIZE, directory=self.parts, workers=1, progress=interrupt_after(2))
+        manifest_path = os.path.join(self.parts, 'build.dmg' + MANIFEST_SUFFIX)
+        pending = SegmentManifest.load(manifest_path).pending()
+        self.assertTrue(0 < len(pending) < SEGMENTS + 1)
+
+        events = []
+        manifest = split(path, SEGMENT_SIZE, directory=self.parts, workers=1, progress=events.append)
+        self.assertTrue(manifest.complete)
+        self.assertEqual(len(events), len(pending))
+        self.assertEqual(verify(manifest), [])
+
+    def test_changed_image_starts_over(self):
+        split(self.image(b'A', mtime=1000000), SEGMENT_SIZE, directory=self.parts)
+        manifest = split(self.image(b'B', mtime=2000000), SEGMENT_SIZE, directory=self.parts)
+        self.assertEqual(self.contents(manifest.segment_path(manifest.segments[0]))[:1], b'B')
+
+
+class VerifyTest(SegmentTestCase):
+
+    def test_damaged_segments(self):
+        manifest = split(self.image(), SEGMENT_SIZE, directory=self.parts)
+        with open(manifest.segment_path(manifest.segments[2]), 'r+b') as f:
+            f.write(b'X')
+        os.remove(manifest.segment_path(manifest.segments[5]))
+        self.assertEqual(verify(manifest.path), [manifest.segments[2]['name'], manifest.segments[5]['name']])
+
+
+class JoinTest(SegmentTestCase):
+
+    def test_join(self):
+        path = self.image()
+        manifest = split(path, SEGMENT_SIZE, directory=self.parts)
+        self.assertEqual(join(manifest, self.output, workers=4), self.output)
+        self.assertEqual(self.contents(self.output), self.contents(path))
+        self.assertFalse(os.path.exists(self.output + '.partial.json'))
+
+    def test_damaged_segment_raises(self):
+        manifest = split(self.image(), SEGMENT_SIZE, directory=self.parts)
+        with open(manifest.segment_path(manifest.segments[3]), 'r+b') as f:
+            f.write(b'X')
+        with self.assertRaises(Exception):
+            join(manifest, self.output)
+        self.assertFalse(os.path.exists(self.output))
+
+    def test_resume(self):
+        path = self.image()
+        manifest = split(path, SEGMENT_SIZE, directory=self.parts)
+        with self.assertRaises(Interrupt):
+            join(manifest, self.output, workers=1, progress=interrupt_after(3))
+        self.assertTrue(os.path.exists(self.output + '.partial'))
+
+        events = []
+        join(manifest, self.output, workers=1, progress=events.append)
+        self.assertTrue(3 <= SEGMENTS + 1 - len(events) < SEGMENTS + 1)
+        self.assertEqual(self.contents(self.output), self.contents(path))
+
+    def test_stale_partial_of_other_image(self):
+        # An interrupted join of one build, then a join of the next build to the same output
+        manifest = split(self.image(b'A', mtime=1000000), SEGMENT_SIZE, directory=self.parts)
+        with self.assertRaises(Interrupt):
+            join(manifest, self.output, workers=1, progress=interrupt_after(3))
+
+        path = self.image(b'B', mtime=2000000)
+        manifest = split(path, SEGMENT_SIZE, directory=self.parts)
+        events = []
+        join(manifest, self.output, workers=1, progress=events.append)
+        self.assertEqual(len(events), SEGMENTS + 1)
+        self.assertEqual(self.contents(self.output), self.contents(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
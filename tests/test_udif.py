@@ -0,0 +1,101 @@
+import binascii, os, shutil, tempfile, unittest, uuid, zlib
+from support import BackendTestCase
+from udif_fixtures import CHUNK_SECTORS, build_udif, chunk_data
+from udif import KOLY_SIZE, SECTOR_SIZE, is_udif, read_udif
+
+
+class FixtureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='pyhdiutil-udif-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+class ReadUDIFTest(FixtureTestCase):
+
+    def test_raw_image(self):
+        data_fork = build_udif(self.path('raw.dmg'), chunks=('raw', 'zero'), segment_id=uuid.UUID(int=7))
+        image = read_udif(self.path('raw.dmg'))
+        self.assertEqual(image.sector_count, 2 * CHUNK_SECTORS)
+        self.assertEqual(image.size, 2 * CHUNK_SECTORS * SECTOR_SIZE)
+        self.assertEqual(image.data_fork_length, len(data_fork))
+        self.assertEqual((image.format, image.fs), ('UDRW', 'HFS+'))
+        self.assertEqual(image.segment_id, uuid.UUID(int=7))
+        self.assertEqual(image.data_checksum_name, 'CRC32')
+        self.assertEqual(image.data_checksum, '{:08x}'.format(binascii.crc32(data_fork) & 0xffffffff))
+        self.assertEqual([chunk.type_name for chunk in image.chunks], ['raw', 'zero', 'terminator'])
+        self.assertEqual([(chunk.sector_number, chunk.sector_count) for chunk in image.chunks],
+                         [(0, CHUNK_SECTORS), (CHUNK_SECTORS, CHUNK_SECTORS), (2 * CHUNK_SECTORS, 0)])
+
+    def test_zlib_image(self):
+        data_fork = build_udif(self.path('udzo.dmg'), chunks=('zlib', 'zlib', 'raw'))
+        image = read_udif(self.path('udzo.dmg'))
+        self.assertEqual(image.format, 'UDZO')
+        self.assertEqual(len(image.partitions), 1)
+        # The chunk table locates every chunk's data in the data fork
+        for n, chunk in enumerate(image.chunks[:-1]):
+            payload = data_fork[chunk.compressed_offset:chunk.compressed_offset + chunk.compressed_length]
+            self.assertEqual(zlib.decompress(payload) if chunk.type_name == 'zlib' else payload, chunk_data(n))
+
+    def test_partition_filesystem(self):
+        build_udif(self.path('apfs.dmg'), partition='disk image (Apple_APFS : 4)')
+        self.assertEqual(read_udif(self.path('apfs.dmg')).fs, 'APFS')
+
+    def test_not_udif(self):
+        with open(self.path('plain.img'), 'wb') as f:
+            f.write(b'\0' * 4096)
+        with self.assertRaises(Exception):
+            read_udif(self.path('plain.img'))
+
+    def test_resource_fork_out_of_range(self):
+        build_udif(self.path('cut.dmg'))
+        with open(self.path('cut.dmg'), 'rb') as f:
+            contents = f.read()
+        # Drop the data fork, leaving offsets that point past the end of the file
+        with open(self.path('cut.dmg'), 'wb') as f:
+            f.write(contents[-KOLY_SIZE:])
+        with self.assertRaises(Exception):
+            read_udif(self.path('cut.dmg'))
+
+
+class IsUDIFTest(FixtureTestCase):
+
+    def test_udif(self):
+        build_udif(self.path('a.dmg'))
+        self.assertTrue(is_udif(self.path('a.dmg')))
+
+    def test_other_files(self):
+        with open(self.path('short'), 'wb') as f:
+            f.write(b'koly')
+        with open(self.path('zeros.dmg'), 'wb') as f:
+            f.write(b'\0' * 1024)
+        self.assertFalse(is_udif(self.path('short')))
+        self.assertFalse(is_udif(self.path('zeros.dmg')))
+        self.assertFalse(is_udif(self.path('missing.dmg')))
+
+
+class NativeLoadTest(BackendTestCase):
+
+    def test_load_native(self):
+        path = self.backend.image_path('native.dmg')
+        build_udif(path, chunks=('zlib', 'zero'))
+        image = self.hdiutil.load(path, native=True)
+        self.assertEqual((image.type, image.fs, image.size), ('UDIF', 'HFS+', 2 * CHUNK_SECTORS * SECTOR_SIZE))
+        self.assertIsNone(image.volname)
+        self.assertEqual(self.calls(), 0)
+
+    def test_lazy_record_reads_image_natively(self):
+        path = self.backend.image_path('lazy.dmg')
+        build_udif(path)
+        record = self.hdiutil.load(path, lazy=True).record()
+        self.assertEqual((record.type, record.format, record.fs, record.size), ('UDIF', 'UDRW', 'HFS+', CHUNK_SECTORS * SECTOR_SIZE))
+        self.assertEqual(self.calls('hdiutil', 'attach'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#
+# Builds small UDIF (.dmg) files for the tests, no hdiutil needed
+#
+## Usage: build_udif('/tmp/raw.dmg')
+##        build_udif('/tmp/udzo.dmg', chunks=('zlib', 'zero'), partition='disk image (Apple_APFS : 4)')
+##        python tests/udif_fixtures.py /tmp/udzo.dmg zlib zero
+## The image holds one blkx partition whose chunk table has one chunk of CHUNK_SECTORS sectors per
+## entry of chunks, 'raw', 'zlib' or 'zero', then a terminator. The data fork is followed by the
+## XML resource fork and the 512-byte koly trailer, as hdiutil lays them out
+#
+
+import binascii, os, plistlib, struct, sys, uuid, zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from udif import CHUNK_FORMAT, KOLY_FORMAT, MISH_FORMAT, SECTOR_SIZE
+from utils import Helpers
+
+CHUNK_SECTORS = 16
+CHUNK_TYPES = {'zero' : 0x00000000, 'raw' : 0x00000001, 'zlib' : 0x80000005, 'terminator' : 0xffffffff}
+CRC32 = 2
+
+
+# Sector contents of the nth chunk, compressible and different per chunk
+def chunk_data(n):
+    return struct.pack('>I', n + 1) * (CHUNK_SECTORS * SECTOR_SIZE // 4)
+
+
+def _checksum(value):
+    return struct.pack('>I', value & 0xffffffff) + b'\0' * 124
+
+
+## Writes the image to path and returns its data fork, for comparing chunks against
+def build_udif(path, chunks=('raw',), partition='disk image (Apple_HFS : 1)', segment_id=None):
+    data_fork = b''
+    entries = []
+    for n, kind in enumerate(chunks):
+        data = chunk_data(n)
+        payload = {'raw' : data, 'zlib' : zlib.compress(data), 'zero' : b''}[kind]
+        entries.append((CHUNK_TYPES[kind], n * CHUNK_SECTORS, CHUNK_SECTORS, len(data_fork), len(payload)))
+        data_fork += payload
+    sectors = len(chunks) * CHUNK_SECTORS
+    entries.append((CHUNK_TYPES['terminator'], sectors, 0, len(data_fork), 0))
+
+    mish = struct.pack(MISH_FORMAT, b'mish', 1, 0, sectors, 0, 0, 0, b'\0' * 24, CRC32, 32,
+                       _checksum(binascii.crc32(data_fork)), len(entries))
+    mish += b''.join(struct.pack(CHUNK_FORMAT, type, 0, start, count, offset, length) for type, start, count, offset, length in entries)
+    # plistlib on Python 2 writes bytes as <string> unless they are wrapped
+    blkx = {'Attributes' : '0x0050', 'CFName' : partition, 'Name' : partition, 'ID' : '0',
+            'Data' : plistlib.Data(mish) if str is bytes else mish}
+    xml = Helpers.write_plist({'resource-fork' : {'blkx' : [blkx]}})
+
+    segment_id = segment_id or uuid.UUID(int=1)
+    koly = struct.pack(KOLY_FORMAT, b'koly', 4, 512, 1, 0, 0, len(data_fork), 0, 0, 1, 1, segment_id.bytes,
+                       CRC32, 32, _checksum(binascii.crc32(data_fork)), len(data_fork), len(xml), b'\0' * 120,
+                       CRC32, 32, _checksum(binascii.crc32(mish)), 1, sectors, b'\0' * 12)
+    with open(path, 'wb') as f:
+        f.write(data_fork + xml + koly)
+    return data_fork
+
+
+if __name__ == '__main__':
+    build_udif(sys.argv[1], tuple(sys.argv[2:]) or ('raw',))
@@ -0,0 +1,199 @@
+#
+# Native reader for UDIF (.dmg) images: parses the koly trailer and the blkx resource
+# fork without spawning hdiutil, so it also works on hosts without hdiutil
+#
+## Usage: image = read_udif('~/images/build.dmg')
+##        image.size, image.format, image.checksum_name
+##        for partition in image.partitions: partition.chunks
+#
+
+import binascii, mmap, os, re, struct, uuid
+from utils import Helpers
+
+# The trailer occupies the last 512 bytes of every UDIF image
+KOLY_SIGNATURE = b'koly'
+KOLY_FORMAT = '>4sIIIQQQQQII16sII128sQQ120sII128sIQ12s'
+KOLY_SIZE = struct.calcsize(KOLY_FORMAT)
+
+# Each blkx entry's Data is a mish block table followed by its chunk entries
+MISH_SIGNATURE = b'mish'
+MISH_FORMAT = '>4sIQQQII24sII128sI'
+MISH_SIZE = struct.calcsize(MISH_FORMAT)
+CHUNK_FORMAT = '>IIQQQQ'
+CHUNK_SIZE = struct.calcsize(CHUNK_FORMAT)
+
+SECTOR_SIZE = 512
+
+# Chunk entry types
+CHUNK_TYPES = {0x00000000 : 'zero',
+               0x00000001 : 'raw',
+               0x00000002 : 'ignore',
+               0x80000004 : 'adc',
+               0x80000005 : 'zlib',
+               0x80000006 : 'bzip2',
+               0x80000007 : 'lzfse',
+               0x80000008 : 'lzma',
+               0x7ffffffe : 'comment',
+               0xffffffff : 'terminator'}
+
+# hdiutil format implied by the compression used in the chunk table
+COMPRESSION_FORMATS = {'adc' : 'UDCO',
+                       'zlib' : 'UDZO',
+                       'bzip2' : 'UDBZ',
+                       'lzfse' : 'ULFO',
+                       'lzma' : 'ULMO'}
+
+CHECKSUM_TYPES = {0 : 'none',
+                  2 : 'CRC32'}
+
+# Partition names as found in blkx entries, e.g. 'disk image (Apple_HFS : 4)', and the fs they hold
+PARTITION_FILESYSTEMS = {'Apple_HFS' : 'HFS+',
+                         'Apple_HFSX' : 'HFSX',
+                         'Apple_APFS' : 'APFS',
+                         'DOS_FAT_32' : 'MS-DOS',
+                         'Windows_FAT_32' : 'MS-DOS',
+                         'UDF' : 'UDF'}
+
+
+# Checksum fields are 128 bytes wide, only the first `bits` of them are used
+def _hex_checksum(data, bits):
+    return binascii.hexlify(data[:(bits + 7) // 8]).decode('ascii')
+
+
+class UDIFChunk(object):
+    __slots__ = ('type', 'comment', 'sector_number', 'sector_count', 'compressed_offset', 'compressed_length')
+
+    def __init__(self, type, comment, sector_number, sector_count, compressed_offset, compressed_length):
+        self.type = type
+        self.comment = comment
+        self.sector_number = sector_number
+        self.sector_count = sector_count
+        self.compressed_offset = compressed_offset
+        self.compressed_length = compressed_length
+
+    def __repr__(self):
+        return 'UDIFChunk({}, sectors={}+{}, offset={}, length={})'.format(
+            self.type_name, self.sector_number, self.sector_count, self.compressed_offset, self.compressed_length)
+
+    @property
+    def type_name(self): return CHUNK_TYPES.get(self.type, hex(self.type))
+
+
+## One blkx entry: a partition of the image and the chunk table describing its data
+class UDIFPartition(object):
+
+    def __init__(self, name, id, data):
+        self.name = name
+        self.id = id
+        if len(data) < MISH_SIZE:
+            raise Exception('Invalid blkx entry: block table truncated.')
+        (signature, self.version, self.sector_number, self.sector_count, self.data_offset, self.buffers_needed,
+         self.block_descriptors, _, self.checksum_type, checksum_size, checksum, count) = struct.unpack_from(MISH_FORMAT, data)
+        if signature != MISH_SIGNATURE:
+            raise Exception('Invalid blkx entry: missing mish signature.')
+        if len(data) < MISH_SIZE + count * CHUNK_SIZE:
+            raise Exception('Invalid blkx entry: chunk table truncated.')
+        self.checksum = _hex_checksum(checksum, checksum_size)
+        self.chunks = [UDIFChunk(*struct.unpack_from(CHUNK_FORMAT, data, MISH_SIZE + i * CHUNK_SIZE)) for i in range(count)]
+
+    def __repr__(self):
+        return 'UDIFPartition({!r}, sectors={}+{}, chunks={})'.format(self.name, self.sector_number, self.sector_count, len(self.chunks))
+
+    # File-system personality implied by the partition name, None if not recognized
+    @property
+    def fs(self):
+        for token in re.findall(r'\w+', self.name):
+            if token in PARTITION_FILESYSTEMS:
+                return PARTITION_FILESYSTEMS[token]
+
+
+## Parsed trailer and resource fork of a UDIF image
+class UDIFImage(object):
+
+    def __init__(self, path, trailer, xml=None):
+        self.path = path
+        (signature, self.version, self.header_size, self.flags, self.running_data_fork_offset,
+         self.data_fork_offset, self.data_fork_length, self.rsrc_fork_offset, self.rsrc_fork_length,
+         self.segment_number, self.segment_count, segment_id, self.data_checksum_type, data_checksum_size,
+         data_checksum, self.xml_offset, self.xml_length, _, self.checksum_type, checksum_size, checksum,
+         self.image_variant, self.sector_count, _) = struct.unpack(KOLY_FORMAT, trailer)
+        if signature != KOLY_SIGNATURE:
+            raise Exception('Not a UDIF disk image: ' + path)
+
+        self.segment_id = uuid.UUID(bytes=segment_id)
+        self.data_checksum = _hex_checksum(data_checksum, data_checksum_size)
+        self.checksum = _hex_checksum(checksum, checksum_size)
+
+        self.partitions = []
+        if xml:
+            plist = Helpers.read_plist(xml)
+            for entry in plist.get('resource-fork', {}).get('blkx', []):
+                # plistlib on Python 2 wraps <data> in a Data object
+                data = getattr(entry['Data'], 'data', entry['Data'])
+                self.partitions.append(UDIFPartition(entry.get('Name', entry.get('CFName', '')), int(entry.get('ID', 0)), data))
+
+    def __repr__(self):
+        return 'UDIFImage({!r}, format={}, size={}, partitions={})'.format(self.path, self.format, self.size, len(self.partitions))
+
+    # Logical size of the image in bytes
+    @property
+    def size(self): return self.sector_count * SECTOR_SIZE
+
+    @property
+    def checksum_name(self): return CHECKSUM_TYPES.get(self.checksum_type, 'type {}'.format(self.checksum_type))
+
+    @property
+    def data_checksum_name(self): return CHECKSUM_TYPES.get(self.data_checksum_type, 'type {}'.format(self.data_checksum_type))
+
+    @property
+    def chunks(self): return [chunk for partition in self.partitions for chunk in partition.chunks]
+
+    # Best guess at the hdiutil format; images without compressed chunks are reported as UDRW
+    @property
+    def format(self):
+        for chunk in self.chunks:
+            if chunk.type_name in COMPRESSION_FORMATS:
+                return COMPRESSION_FORMATS[chunk.type_name]
+        return 'UDRW'
+
+    # File-system personality of the first recognized partition
+    @property
+    def fs(self):
+        for partition in self.partitions:
+            if partition.fs:
+                return partition.fs
+
+
+# Reads the trailer and XML resource fork of a .dmg through one read-only mmap
+def read_udif(path):
+    path = os.path.expanduser(path)
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size < KOLY_SIZE:
+            raise Exception('Not a UDIF disk image: ' + path)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            trailer = mapped[file_size - KOLY_SIZE:]
+            if trailer[:4] != KOLY_SIGNATURE:
+                raise Exception('Not a UDIF disk image: ' + path)
+            xml_offset, xml_length = struct.unpack_from('>QQ', trailer, 216)
+            if xml_length and xml_offset + xml_length > file_size:
+                raise Exception('Invalid UDIF disk image, resource fork out of range: ' + path)
+            xml = mapped[xml_offset:xml_offset + xml_length] if xml_length else None
+        finally:
+            mapped.close()
+    return UDIFImage(path, trailer, xml)
+
+
+# True if the file ends with a koly trailer
+def is_udif(path):
+    path = os.path.expanduser(path)
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < KOLY_SIZE:
+                return False
+            f.seek(-KOLY_SIZE, os.SEEK_END)
+            return f.read(4) == KOLY_SIGNATURE
+    except (IOError, OSError):
+        return False
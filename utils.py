@@ -1,9 +1,12 @@
-import subprocess
+import json, mmap, os, subprocess, plistlib, threading, time
+
+# Monotonic clock where the interpreter provides one, used for TTLs and timings
+clock = getattr(time, 'monotonic', time.time)
 
 # Class consisting of various helper methods
 class Helpers:
     @staticmethod
-    def read_password(self):
+    def read_password():
         print('Enter a password:')
         p1 = input()                
         print('Reenter the password:')
@@ -53,10 +56,62 @@ class Helpers:
         except ValueError:
             return False    
     
+    # Parses plist output from hdiutil regardless of the plistlib version available
+    @staticmethod
+    def read_plist(data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if hasattr(plistlib, 'loads'):
+            return plistlib.loads(data)
+        return plistlib.readPlistFromString(data)
+
+    # Serializes data as an XML plist, the counterpart of read_plist
+    @staticmethod
+    def write_plist(data):
+        if hasattr(plistlib, 'dumps'):
+            return plistlib.dumps(data)
+        return plistlib.writePlistToString(data)
+
+    # Free bytes available to unprivileged users on the filesystem holding path
+    # Uncached, see CapacityMonitor for cached lookups and reservations
+    @staticmethod
+    def bytes_available(path='~'):
+        stat = os.statvfs(os.path.expanduser(path))
+        return stat.f_bavail * stat.f_frsize
+
+    # Name a file is written under before it is renamed over path, unique per process
+    @staticmethod
+    def temporary_path(path, suffix='tmp'):
+        return '{}.{}.{}'.format(path, os.getpid(), suffix)
+
+    # Writes data to path as JSON through a temporary file, so readers never see half a file
     @staticmethod
-    def bytes_available():
-        out = Helpers.run_command('du', '-sh ~').split('\t')[0]
-        return Helpers.get_bytes(out)
+    def write_json(path, data):
+        temporary = Helpers.temporary_path(path)
+        with open(temporary, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+        os.rename(temporary, path)
+
+    # Maps a file read-only, None if it is empty
+    @staticmethod
+    def map_file(path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Views into an mmap without copying, where the interpreter supports it
+    @staticmethod
+    def memory_view(mapped, start, end):
+        try:
+            return memoryview(mapped)[start:end]
+        except TypeError:
+            return mapped[start:end]
+
+    # Nanosecond mtime of an os.stat result where the platform reports one
+    @staticmethod
+    def mtime_ns(st):
+        return getattr(st, 'st_mtime_ns', int(st.st_mtime * 1000000000))
     # Generates a string containing a series of args and options formatted for bash
     @staticmethod
     def generate_command_str(*args, **kwargs):
@@ -72,6 +127,25 @@ class Helpers:
         command = ' '.join([args_str, kwargs_str])
         return command
         
+    # Generates an argv list from a series of args and options, no shell quoting required
+    # Usage: generate_command_args('hdiutil', 'info', plist=None) -> ['hdiutil', 'info', '-plist']
+    @staticmethod
+    def generate_command_args(*args, **kwargs):
+        argv = [str(arg) for arg in args]
+        for k, v in kwargs.items():
+            argv.append('-' + k)
+            if v:
+                argv.append(str(v))
+        return argv
+
+    # Parses the `key: value` lines printed by `diskutil info` into a dict
+    @staticmethod
+    def parse_diskutil_info(output):
+        if not isinstance(output, str):
+            output = output.decode('utf-8')
+        non_empty_lines = [line for line in output.splitlines() if line != '']
+        return {line.split(':')[0].lstrip() : line.split(':')[-1].strip() for line in non_empty_lines}
+
     # Runs command in new process via subprocess.Popen accepting popen options via options dict
     @staticmethod
     def system(command, **options):
@@ -103,4 +177,120 @@ class Helpers:
         }
         command = Helpers.generate_command_str(*args, **kwargs)
         return Helpers.system(command, **system_options)
-    
\ No newline at end of file
+    
+## Outcome of a command run by CommandEngine
+class CommandResult(object):
+    def __init__(self, argv, returncode, stdout, stderr, elapsed):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        # Wall time in seconds
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return 'CommandResult({!r}, returncode={}, elapsed={:.3f}s)'.format(self.argv, self.returncode, self.elapsed)
+
+    # Utility and verb, e.g. ('hdiutil', 'attach'), used to key metrics
+    @property
+    def utility(self): return self.argv[0].split('/')[-1]
+
+    @property
+    def subcommand(self): return self.argv[1] if len(self.argv) > 1 else None
+
+    @property
+    def ok(self): return self.returncode == 0
+
+
+# Raised by CommandEngine when a command exits non-zero, the result is kept on the exception
+class CommandError(Exception):
+    def __init__(self, result):
+        stderr = result.stderr if isinstance(result.stderr, str) else result.stderr.decode('utf-8', 'replace')
+        Exception.__init__(self, stderr.strip() or '{} exited with status {}'.format(' '.join(result.argv), result.returncode))
+        self.result = result
+
+
+## Runs commands from argv lists without a shell
+#
+## Usage: CommandEngine.run('hdiutil', 'attach', '~/my image.dmg', plist=None).stdout
+##        CommandEngine.add_post_hook(lambda result: histogram(result.subcommand).observe(result.elapsed))
+## Pre-hooks receive the argv list before execution, post-hooks the CommandResult after it,
+## including for commands that failed
+class CommandEngine(object):
+
+    pre_hooks = []
+    post_hooks = []
+
+    @classmethod
+    def add_pre_hook(cls, hook): cls.pre_hooks.append(hook)
+
+    @classmethod
+    def add_post_hook(cls, hook): cls.post_hooks.append(hook)
+
+    @classmethod
+    def remove_hook(cls, hook):
+        for hooks in (cls.pre_hooks, cls.post_hooks):
+            if hook in hooks:
+                hooks.remove(hook)
+
+    # Fire the registered hooks, used by the engine and by other runners such as AsyncHDIUtil
+    @classmethod
+    def before(cls, argv):
+        for hook in list(cls.pre_hooks):
+            hook(argv)
+
+    @classmethod
+    def after(cls, result):
+        for hook in list(cls.post_hooks):
+            hook(result)
+
+    # Builds argv from args and options like Helpers.generate_command_args and executes it
+    @classmethod
+    def run(cls, *args, **kwargs):
+        return cls.execute(Helpers.generate_command_args(*args, **kwargs))
+
+    # Executes an argv list, raising CommandError on a non-zero exit status when check is set
+    # A leading ~ in arguments is expanded, as a shell would
+    @classmethod
+    def execute(cls, argv, check=True):
+        argv = [os.path.expanduser(arg) if arg.startswith('~') else arg for arg in argv]
+        cls.before(argv)
+        start = clock()
+        try:
+            proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (out, err) = proc.communicate()
+        except OSError:
+            raise Exception('OSError, Command not found: ' + argv[0])
+        result = CommandResult(argv, proc.returncode, out, err, clock() - start)
+        cls.after(result)
+
+        if check and not result.ok:
+            raise CommandError(result)
+        return result
+
+
+## Post-hook collecting call counts and latency per utility and subcommand
+#
+## Usage: stats = CommandStats(); CommandEngine.add_post_hook(stats)
+##        stats.counts[('hdiutil', 'info')]
+class CommandStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, result):
+        key = (result.utility, result.subcommand)
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.latencies.setdefault(key, []).append(result.elapsed)
+            if not result.ok:
+                self.failures[key] = self.failures.get(key, 0) + 1
+
+    def reset(self):
+        self.counts = {}
+        self.failures = {}
+        self.latencies = {}
+
+    # Total number of commands executed
+    @property
+    def total(self): return sum(self.counts.values())